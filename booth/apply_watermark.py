@@ -1,5 +1,6 @@
 import cv2
-import numpy as np
+
+from common.compositing import PremultipliedAsset, alpha_to_fixed
 
 class ApplyWatermark:
     def __init__(self, watermark_path, watermark_position="lr", weight=1, h_size=0, offset_x=0, offset_y=0):
@@ -15,17 +16,18 @@ class ApplyWatermark:
             
         print("apply_watermark.py: Loaded", watermark_path, ", Shape:", watermark.shape)
         
-        watermark_alpha_1chan = np.array(watermark[:,:,3], dtype=np.float32) / 255 * weight
-        watermark_alpha = np.stack([watermark_alpha_1chan]*3, axis=-1)
-        self.watermark_alpha_inv = np.ones(watermark_alpha.shape, dtype=np.float32) - watermark_alpha
-        self.watermark_alphad = watermark[:,:,:3] * watermark_alpha
+        # Fixed point, premultiplied copies for color and single channel (gray) images
+        watermark_alpha = alpha_to_fixed(watermark[:,:,3], weight)
+        watermark_luma = cv2.cvtColor(watermark[:,:,:3], cv2.COLOR_RGB2GRAY)
+        self.watermark_asset = PremultipliedAsset(watermark[:,:,:3], watermark_alpha)
+        self.watermark_asset_gray = PremultipliedAsset(watermark_luma, watermark_alpha)
         
         self.watermark_position = watermark_position
         self.offset_x = offset_x
         self.offset_y = offset_y
 
     def apply_watermark(self, in_image):
-        watermark_dims = self.watermark_alphad.shape
+        watermark_dims = self.watermark_asset.shape
         if self.watermark_position[0] == "l": # lower
             start_y = in_image.shape[1] - watermark_dims[1] - self.offset_y
         elif self.watermark_position[0] == "u": # upper
@@ -43,9 +45,10 @@ class ApplyWatermark:
         end_x = start_x + watermark_dims[0]
         end_y = start_y + watermark_dims[1]
         
-        in_image_float = np.array(in_image[start_x:end_x,start_y:end_y,:3], dtype=np.float32)
-        in_image_float *= self.watermark_alpha_inv
-        in_image[start_x:end_x, start_y:end_y,:3] = in_image_float + self.watermark_alphad
+        if in_image.ndim == 2:
+            self.watermark_asset_gray.blend_into(in_image[start_x:end_x, start_y:end_y])
+        else:
+            self.watermark_asset.blend_into(in_image[start_x:end_x, start_y:end_y])
                 
     
 if __name__ == "__main__":
@@ -1,43 +1,45 @@
 import cv2
-from picamera2 import Picamera2, Preview, MappedArray
-from picamera2.previews.qt import QGlPicamera2
-import libcamera
-from libcamera import controls
 import time
-import subprocess
-from PyQt5 import QtCore
-from PyQt5.QtWidgets import QApplication
+import math
+import threading
 import numpy as np
 import os
 import random
 import glob
 import pickle
 from pprint import *
-from datetime import datetime
-from PIL import Image
 import piexif
 import sys
+from collections import deque
 
-from common.image_path_db import ImagePathDB
+from common.image_path_db import open_image_path_db
 from common.timers import Timers
+from common.network_monitor import NetworkMonitor
+from common.latency_tracer import LatencyTracer
 from common.common import load_config
 from apply_watermark import ApplyWatermark
 from overlay_manager import OverlayManager
+from led_animator import LedAnimator, LedChannel, LedCurve
+from capture_saver import CaptureSaver
+from undistorter import Undistorter
+from capture_frame import CaptureFrame
+from deferred_saver import DeferredSaver
+from display_renderer import DisplayRenderer
+from display_cache import DisplayCache
+from jpeg_encoders import get_encoder, ParallelJpegWriter
 import booth_states
 
-# Pi 5 stuff
-from gpiozero import Button
-from rpi_hardware_pwm import HardwarePWM
-
 # GPIO
 BUTTON_PIN = 14
 PWM_FREQ = 20000
 
 # Timing
 SHUTDOWN_HOLD_TIME = 3
+POLL_TIME_S = 0.025 # Main loop interval while something needs polling, like the countdown
 
-AWB_MODE = controls.AwbModeEnum.Indoor
-AE_MODE = controls.AeExposureModeEnum.Short
+# libcamera enum names, looked up through the hardware's controls
+AWB_MODE = "Indoor"
+AE_MODE = "Short"
 
 # Image and display
 DISPLAY_WIDTH=1024
@@ -69,6 +71,7 @@ FULL_CROP_RECTANGLE = (
         CROP_WIDTH,
         CROP_HEIGHT,
     )
+CAPTURE_SATURATION = 1.0
 
 # Overlay stuff
 colour = (255, 255, 255, 255)
@@ -90,11 +93,6 @@ wifi_text_scale = 0.75
 wifi_text_thickness = 1
 cv2.putText(NO_WIFI_OVERLAY, "Wifi not connected", wifi_text_origin, font, wifi_text_scale, colour, wifi_text_thickness)
     
-def close_window(event):
-    photo_booth.stop_pwm()
-    sys.exit(0)
-    
-    
 def load_lens_cal(cal_file):
     with open(cal_file, "rb") as file_obj:
         return pickle.load(file_obj)
@@ -118,16 +116,46 @@ def get_exif(w, h, datetime_stamp, postfix=""):
     
     
 class PhotoBooth:
-    def __init__(self, config):
+    def __init__(self, config, hardware=None):
         self._config = config
+        if hardware is None:
+            # Only importable on the Pi, sim_hardware.py has the fakes
+            from hardware import PiHardware
+            hardware = PiHardware()
+        self.hardware = hardware
+        self.clock = hardware.clock
+        self._awb_mode = getattr(hardware.controls.AwbModeEnum, AWB_MODE)
+        self._ae_mode = getattr(hardware.controls.AeExposureModeEnum, AE_MODE)
         
         if config.get("lens_cal_file", None):
             print("using calibration from ", config["lens_cal_file"])
             self._lens_cal = load_lens_cal(config["lens_cal_file"])
+            self._undistorter = Undistorter(
+                    self._lens_cal,
+                    lens_cal_file=config["lens_cal_file"],
+                    image_size=(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+                )
         else:
             self._lens_cal = None
+            self._undistorter = None
         
         self._continuous_cap = config.get("continuous_cap", False)
+        self._yuv_capture = config.get("yuv_capture", False)
+        self._burst_frames = max(1, config.get("burst_frames", 1))
+        # Zero shutter lag: a ring of the last few full res frames, the capture takes the one nearest the deadline.
+        # Bursts use the same ring, so they're taken around the deadline instead of after it
+        self._zsl_frames = config.get("zsl_frames", 0)
+        if self._burst_frames > 1:
+            self._zsl_frames = max(self._zsl_frames, self._burst_frames)
+        self._zsl_ring = deque()
+        self._zsl_running = False
+        self._zsl_start_time = None
+        self._zsl_capture_requested = False
+        self.capture_deadline = None
+        self._capture_size = (FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+        self._lores_size = PREV_STREAM_DIMS
+        self._lores_yuv = True
+        self.lores_array = None
         
         self._original_image_dir = config.get("original_image_dir", None)
         self._color_image_dir = config["color_image_dir"]
@@ -148,13 +176,30 @@ class PhotoBooth:
         self._brightness = float(config["brightness"])
         self._enable_multi_shot = config["enable_multi_shot"]
         
-        self.overlay_manager = OverlayManager(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+        self.overlay_manager = OverlayManager(DISPLAY_WIDTH, DISPLAY_HEIGHT, cache_budget_mb=config.get("overlay_cache_mb", 64))
+        self.display_renderer = DisplayRenderer(DISPLAY_WIDTH, DISPLAY_HEIGHT, DISPLAY_IMG_WIDTH, DISPLAY_IMG_HEIGHT)
         self.setup_overlays(config["overlays"])
         
-        self.photo_path_db = ImagePathDB(config["photo_path_db"])
-        self.qr_path_db = ImagePathDB(config["qr_path_db"])
+        self.photo_path_db = open_image_path_db(config["photo_path_db"], json_export_path=config.get("photo_db_json_export"))
+        self.qr_path_db = open_image_path_db(config["qr_path_db"])
+        
+        if config.get("display_cache_dir"):
+            self.display_cache = DisplayCache(
+                    config["display_cache_dir"],
+                    self.display_renderer,
+                    memory_budget_mb=config.get("display_cache_mb", 32)
+                )
+            self.backfill_display_cache()
+        else:
+            self.display_cache = None
         
         self.wifi_check = config["wifi_check"]
+        self.loop_events = hardware.create_loop_events()
+        if self.wifi_check:
+            self.network_monitor = NetworkMonitor(interval=config["wifi_check_time"])
+            self.network_monitor.subscribe(lambda status: self.loop_events.wake.emit())
+        else:
+            self.network_monitor = None
 
         for dir_i in [
                         self._gray_image_dir,
@@ -168,9 +213,20 @@ class PhotoBooth:
         self.exposure_settings = {
             "AnalogueGain": 4,
             "ExposureTime": 30000,
-            "AwbMode": AWB_MODE,
+            "AwbMode": self._awb_mode,
         }
         
+        # Per-stage capture timings, dumped every latency_trace_interval seconds if there's a path
+        self.tracer = LatencyTracer(
+                ring_size=config.get("latency_trace_size", 500),
+                dump_path=config.get("latency_trace_path"),
+                dump_interval=config.get("latency_trace_interval", 60),
+                clock=self.clock
+            )
+        self.capture_trace = None
+        self.trace_pending_display = None
+        self._button_edge_time = None
+        
         self.button = None
         self.pwm_button_led = None
         self.pwm_main_leds = None
@@ -178,9 +234,8 @@ class PhotoBooth:
         self.init_gpio()
         self.set_leds(idle=True)
         
-        self.timers = Timers()
-        self.timers.start("button_release", SHUTDOWN_HOLD_TIME)
-        self.timers.start("wifi_check", config["wifi_check_time"])
+        self.timers = Timers(clock=self.clock)
+        self.timers.setup("button_release", SHUTDOWN_HOLD_TIME)
         self._prev_saturation = 0 if config["display_gray"] else 1
         
         if "watermark" in config:
@@ -192,9 +247,23 @@ class PhotoBooth:
         else:
             self._watermarker = None
         
+        self.jpeg_writer = ParallelJpegWriter(
+                get_encoder(config.get("jpeg_encoder", "pil")),
+                num_workers=config.get("jpeg_encode_workers", 3)
+            )
+        self._photo_db_lock = threading.Lock()
+        if config.get("defer_variants", False):
+            self.deferred_saver = DeferredSaver(self.write_deferred_variants, config["deferred_spool_dir"])
+        else:
+            self.deferred_saver = None
+        self.capture_saver = CaptureSaver(self.write_capture, max_pending=config.get("max_pending_saves", 3))
+        
         self.picam2 = self.init_camera()
         self.qpicamera2 = self.init_preview()
 
+        self.extra_shots = 0
+        self._max_loop_sleep = config.get("max_loop_sleep", 0.5)
+        self._overlays_pending = True
         self.setup_states()
         
         self.state = None
@@ -223,17 +292,28 @@ class PhotoBooth:
         return prev_crop_rectangle
             
     def init_camera(self):
-        picam2 = Picamera2()
+        picam2 = self.hardware.create_camera()
         picam2.options["quality"] = 95
 
+        if self._yuv_capture:
+            # Half the buffer memory of RGB, and the Y plane is the gray image
+            main_config = {"format": "YUV420"}
+        else:
+            main_config = {}
         still_config = picam2.create_still_configuration(
+                main=main_config,
                 lores={"size": PREV_STREAM_DIMS},
                 display="lores",
-                buffer_count=3,
+                # The ring holds its frames out of the camera's buffers, plus the newest one while it's checked.
+                # The camera needs a couple more to keep running
+                buffer_count=max(3, self._zsl_frames + 3),
             )
 
         picam2.configure(still_config)
         got_config = picam2.camera_configuration()
+        self._capture_size = tuple(got_config["main"]["size"])
+        self._lores_size = tuple(got_config["lores"]["size"])
+        self._lores_yuv = got_config["lores"]["format"] == "YUV420"
 
         if not FOCUS_MODE:
             picam2.set_controls({
@@ -242,14 +322,14 @@ class PhotoBooth:
                 })
         picam2.set_controls({"AeEnable": True})
         picam2.set_controls({"ScalerCrop": self.get_prev_crop_rectangle(crop_to_screen=False)}) # Don't crop the initial preview
-        picam2.set_controls({"AeExposureMode": AE_MODE})
-        picam2.set_controls({"AwbMode": AWB_MODE})
+        picam2.set_controls({"AeExposureMode": self._ae_mode})
+        picam2.set_controls({"AwbMode": self._awb_mode})
         return picam2
     
     def set_cam_controls_capture(self):
         self.picam2.set_controls({
                 "ScalerCrop": FULL_CROP_RECTANGLE,
-                "Saturation": 1.0,
+                "Saturation": CAPTURE_SATURATION,
                 "Contrast": self._contrast,
                 "Brightness": self._brightness,
             })
@@ -259,23 +339,19 @@ class PhotoBooth:
                 "ScalerCrop": self.get_prev_crop_rectangle(crop_to_screen=crop_preview),
                 "Saturation": self._prev_saturation,
                 "AeEnable": True,
-                "AeExposureMode": AE_MODE,
-                "AwbMode": AWB_MODE
+                "AeExposureMode": self._ae_mode,
+                "AwbMode": self._awb_mode
             })
 
     def init_preview(self):
-        qpicamera2 = QGlPicamera2(
-                        self.picam2,
-                        width=DISPLAY_WIDTH,
-                        height=DISPLAY_HEIGHT,
-                        keep_ar=False,
-                        transform=libcamera.Transform(hflip=1)
-                    )
-        qpicamera2.timer = QtCore.QTimer()
-        qpicamera2.timer.start(25)
-        qpicamera2.timer.timeout.connect(self.main_loop)
+        qpicamera2 = self.hardware.create_preview(self.picam2, DISPLAY_WIDTH, DISPLAY_HEIGHT, hflip=True)
+        # Single shot, main_loop re-arms it for whatever is due next
+        self.loop_timer = self.hardware.create_timer(self.main_loop)
+        self.loop_timer.start(0)
+        self.loop_events.wake.connect(self.wake)
+        self.loop_events.frame_ready.connect(self.zsl_frame_done)
         qpicamera2.done_signal.connect(self.capture_done)
-        qpicamera2.mousePressEvent = close_window
+        qpicamera2.mousePressEvent = self.close_window
 
         self.picam2.start()
 
@@ -289,6 +365,24 @@ class PhotoBooth:
             image = cv2.imread(config["path"], cv2.IMREAD_UNCHANGED)
             self.overlay_manager.set_layer(image, name=name, size=config["size"], offset=config["offset"], weight=config["weight"])
         
+    def countdown_layer_sets(self):
+        # Every layer combination the countdown can show, given the current wifi state
+        countdown_names = [name for name in self.overlay_manager.layers if name.startswith("countdown_")]
+        base_sets = [set()]
+        if self._enable_multi_shot and ("three_shots" in self.overlay_manager.layers):
+            base_sets.append({"three_shots"})
+        if self.overlay_manager.layers["wifi"].is_active():
+            base_sets = [base | {"wifi"} for base in base_sets]
+        return [base | {name} for base in base_sets for name in countdown_names]
+
+    def precompute_countdown_overlays(self):
+        # One frame per call so a main loop tick never takes long
+        self._overlays_pending = False
+        for layer_names in self.countdown_layer_sets():
+            if self.overlay_manager.precompute(layer_names):
+                self._overlays_pending = True
+                return
+
     def set_capture_overlay(self):
         self.overlay_manager.set_main_image(CAPTURE_OVERLAY, exclusive = True)
 
@@ -297,13 +391,36 @@ class PhotoBooth:
         self.init_pwm()
         
     def init_button(self):
-        self.button = Button(BUTTON_PIN)
+        self.button = self.hardware.create_button(BUTTON_PIN)
+        self.button.when_pressed = self.button_pressed
+        self.button.when_released = self.loop_events.wake.emit
         
     def init_pwm(self):
-        self.pwm_button_led = HardwarePWM(pwm_channel=1, hz=PWM_FREQ, chip=2) # This is GPIO 13 on Pi 5
-        self.pwm_main_leds = HardwarePWM(pwm_channel=0, hz=PWM_FREQ, chip=2) # This is GPIO 12 on Pi 5
+        self.pwm_button_led = self.hardware.create_pwm(pwm_channel=1, hz=PWM_FREQ, chip=2) # This is GPIO 13 on Pi 5
+        self.pwm_main_leds = self.hardware.create_pwm(pwm_channel=0, hz=PWM_FREQ, chip=2) # This is GPIO 12 on Pi 5
         self.pwm_button_led.start(0)
         self.pwm_main_leds.start(0)
+        self.button_pulse_curve = LedCurve.pulse(self._button_pulse_time)
+        self.button_off_curve = LedCurve.constant(0)
+        self.main_idle_curve = LedCurve.constant(self._led_idle_dc)
+        self.main_capture_curve = LedCurve.constant(self._led_capture_dc)
+        self.led_animator = LedAnimator(
+                {
+                    "button": LedChannel(self.change_button_led_dc),
+                    "main": LedChannel(self.change_main_led_dc),
+                },
+                frame_time=self._config.get("led_frame_time", 0.02),
+                clock=self.clock
+            )
+        
+    def button_pressed(self):
+        # Called from the gpiozero thread, the countdown picks up the edge time for its trace
+        self._button_edge_time = self.clock()
+        self.loop_events.wake.emit()
+        
+    def take_button_edge(self):
+        edge_time, self._button_edge_time = self._button_edge_time, None
+        return edge_time
         
     def change_button_led_dc(self, duty_cycle):
         self.pwm_button_led.change_duty_cycle(duty_cycle)
@@ -314,27 +431,133 @@ class PhotoBooth:
     def is_button_pressed(self):
         return self.button.is_pressed
     
+    def can_start_capture(self):
+        # Backpressure: don't start another countdown while the save queue is full
+        return not self.capture_saver.is_full()
+    
+    def stop(self):
+        # Stops the background threads once whatever they have queued is written
+        self.stop_pwm()
+        self.stop_zsl_ring()
+        self.capture_saver.stop()
+        if self.deferred_saver is not None:
+            self.deferred_saver.stop()
+        self.jpeg_writer.shutdown()
+        self.tracer.stop()
+        
+    def close_window(self, event):
+        self.stop()
+        sys.exit(0)
+        
     def stop_pwm(self):
+        self.led_animator.stop()
         self.pwm_button_led.stop()
         self.pwm_main_leds.stop()
 
-    def set_leds(self, idle=True, fade=0):
-        if fade:
-            interval = self._led_capture_dc - self._led_idle_dc
-            fade = max(min(fade, 1), 0)
-            dc = min(100, interval * fade + self._led_idle_dc)
-            self.change_main_led_dc(dc)
+    def set_leds(self, idle=True):
+        if idle:
+            self.led_animator.play("main", self.main_idle_curve)
         else:
-            if idle:
-                self.change_main_led_dc(self._led_idle_dc)
-            else:
-                self.change_main_led_dc(self._led_capture_dc)
+            self.led_animator.play("main", self.main_capture_curve)
+            
+    def fade_leds(self, time_left, fade_s, end_s):
+        # Brighten the main LEDs from fade_s to end_s seconds before the capture
+        fade_curve = LedCurve.fade(
+                self._led_idle_dc,
+                min(100, self._led_capture_dc),
+                time_left - fade_s,
+                time_left - end_s
+            )
+        self.led_animator.play("main", fade_curve)
+    
+    def start_capture(self):
+        if self._zsl_frames:
+            # The frame may already be in the ring, otherwise the next one to arrive picks it
+            self._zsl_capture_requested = True
+            self.start_zsl_ring()
+            self.select_zsl_frame()
+        else:
+            # The lores frame is tiny and matches the capture, use it for the first display
+            self.picam2.capture_arrays(["main", "lores"], signal_function=self.qpicamera2.signal_done)
+    
+    def start_zsl_ring(self):
+        # Started at the control switch, frames from before it don't have the capture controls
+        if self._zsl_frames and not self._zsl_running:
+            self._zsl_running = True
+            self._zsl_start_time = self.clock()
+            self.picam2.capture_request(signal_function=self.loop_events.frame_ready.emit)
+            
+    def stop_zsl_ring(self):
+        self._zsl_running = False
+        self._zsl_capture_requested = False
+        while self._zsl_ring:
+            self._zsl_ring.popleft()[2].release()
+    
+    def zsl_frame_done(self, job):
+        request = self.picam2.wait(job)
+        if not self._zsl_running:
+            request.release()
+            return
+        metadata = request.get_metadata()
+        sensor_time = self.hardware.sensor_time(metadata["SensorTimestamp"])
+        if (sensor_time >= self._zsl_start_time) and self.has_capture_controls(metadata):
+            self._zsl_ring.append((sensor_time, metadata, request))
+        else:
+            request.release()
+        while len(self._zsl_ring) > self._zsl_frames:
+            self._zsl_ring.popleft()[2].release()
+        if not self.select_zsl_frame():
+            self.picam2.capture_request(signal_function=self.loop_events.frame_ready.emit)
+    
+    def has_capture_controls(self, metadata):
+        # Controls take a few frames to apply after the switch, so check the frame really got them.
+        # Anything the camera doesn't report is taken on trust
+        crop = metadata.get("ScalerCrop")
+        if (crop is not None) and (tuple(crop) != FULL_CROP_RECTANGLE):
+            return False
+        saturation = metadata.get("Saturation")
+        if (saturation is not None) and (abs(saturation - CAPTURE_SATURATION) > 0.01):
+            return False
+        return True
+    
+    def select_zsl_frame(self):
+        # Once enough frames have started after the deadline, the ones nearest it are all in the ring.
+        # With burst_frames, the sharpest of that many nearest the deadline is kept. Returns True once captured
+        if not self._zsl_capture_requested:
+            return False
+        num_after = sum(1 for frame in self._zsl_ring if frame[0] >= self.capture_deadline)
+        if num_after < self._burst_frames // 2 + 1:
+            return False
+        
+        self.capture_trace.mark("capture_done")
+        nearest = sorted(self._zsl_ring, key=lambda frame: abs(frame[0] - self.capture_deadline))[:self._burst_frames]
+        if len(nearest) > 1:
+            def score(frame):
+                with self.capture_trace.span("sharpness_score"):
+                    with self.hardware.MappedArray(frame[2], "lores") as mapped:
+                        return CaptureFrame(mapped.array, yuv420=self._lores_yuv, size=self._lores_size).sharpness()
+            nearest = sorted(nearest, key=score, reverse=True)
+        sensor_time, metadata, request = nearest[0]
+        self.image_array = request.make_array("main")
+        self.lores_array = request.make_array("lores")
+        print("ZSL kept the frame", int((sensor_time - self.capture_deadline) * 1000), "ms from the deadline,", len(self._zsl_ring), "in the ring")
+        self.stop_zsl_ring()
+        self.capture_complete(metadata)
+        return True
     
     def capture_done(self, job):
-        (self.image_array,), metadata = self.picam2.wait(job)
+        self.capture_trace.mark("capture_done")
+        (self.image_array, self.lores_array), metadata = self.picam2.wait(job)
+        self.capture_complete(metadata)
+        
+    def capture_complete(self, metadata):
+        # Time from the end of the countdown to the start of the kept frame's exposure
+        shutter_lag = self.hardware.sensor_time(metadata["SensorTimestamp"]) - self.capture_deadline
+        self.capture_trace.add("shutter_lag", abs(shutter_lag))
         self.set_leds(idle=True)
         self.qpicamera2.set_overlay(BLACK_OVERLAY)
         self.capture_completed = True
+        self.wake()
         
         self.exposure_settings["AnalogueGain"] = metadata["AnalogueGain"]
         self.exposure_settings["ExposureTime"] = metadata["ExposureTime"]
@@ -349,100 +572,275 @@ class PhotoBooth:
         print("Color gains", metadata["ColourGains"])
         print("Color temp", metadata["ColourTemperature"])
         print("Lux", metadata["Lux"])
+        print("Shutter lag", int(shutter_lag * 1000), "ms")
+    
+    def get_display_crop(self, image_width):
+        # The calibration roi, scaled to an image of the given width. Close enough to the undistorted framing
+        if not self._lens_cal:
+            return None
+        scale = image_width / self._capture_size[0]
+        return [int(val * scale) for val in self._lens_cal[1]]
     
     def save_capture(self):
-        orig_image = self.image_array
-        
-        if self._lens_cal:
-            newcameramtx, roi, mtx, dist = self._lens_cal
-            dst = cv2.undistort(orig_image, mtx, dist, None, newcameramtx)
-            x, y, w, h = roi
-            final_image = dst[y:y+h, x:x+w]
+        # Hand the frame off to the save thread and return an overlay to display right away
+        frame = CaptureFrame(self.image_array, yuv420=self._yuv_capture, size=self._capture_size)
+        self.image_array = None
+        photo_name = self.cap_timestamp_str
+        trace = self.capture_trace
+        self.capture_trace = None
+        self.capture_saver.submit(frame, photo_name, self.hardware.datetime_now(), trace, time.perf_counter())
+        
+        start_time = time.perf_counter()
+        if (self.lores_array is not None) and self._lores_yuv:
+            lores_frame = CaptureFrame(self.lores_array, yuv420=True, size=self._lores_size)
+            display_overlay = self.display_renderer.render_yuv420(
+                    lores_frame,
+                    gray=self._display_gray,
+                    crop=self.get_display_crop(lores_frame.width)
+                )
+        elif self._display_gray and frame.yuv420:
+            display_overlay = self.display_renderer.render(frame.gray(), crop=self.get_display_crop(frame.width))
         else:
-            final_image = orig_image
-            
-        gray_image = cv2.cvtColor(final_image, cv2.COLOR_RGB2GRAY)
-        gray_image = cv2.cvtColor(gray_image, cv2.COLOR_GRAY2BGR)
+            display_overlay = self.display_renderer.render(
+                    frame.rgb(),
+                    bgr=False,
+                    gray=self._display_gray,
+                    crop=self.get_display_crop(frame.width)
+                )
+        self.lores_array = None
+        trace.add("display_render", time.perf_counter() - start_time)
+        print("Display render time", int((time.perf_counter() - start_time) * 1000), "ms")
+        return display_overlay, photo_name, trace
+    
+    def rectify(self, image, trace, stage="undistort"):
+        if self._undistorter:
+            with trace.span(stage):
+                return self._undistorter.undistort(image)
+        elif self._watermarker is not None:
+            # Don't let the watermark end up on the original
+            return image.copy()
+        return image
+    
+    def write_capture(self, frame, photo_name, datetime_stamp, trace, submit_time):
+        # Runs on the capture saver thread
+        start_time = time.perf_counter()
+        # Time spent queued behind earlier captures, save_wait + save is capture to disk
+        trace.add("save_wait", start_time - submit_time)
+        postfixes = [postfix for postfix, dir_i in self.variant_dirs().items() if dir_i]
+        if self.deferred_saver is not None:
+            # Only the display variant is needed now, the rest get written when the booth is idle
+            deferred_postfixes = [postfix for postfix in postfixes if postfix != self._display_postfix]
+            postfixes = [self._display_postfix]
+        else:
+            deferred_postfixes = []
+        self.write_variants(frame, photo_name, datetime_stamp, postfixes, trace, parallel=True)
+        if deferred_postfixes:
+            self.deferred_saver.add_job(frame, photo_name, datetime_stamp, deferred_postfixes)
+        trace.add("save", time.perf_counter() - start_time)
+        print("Capture", photo_name, "timings:", trace.summary())
+        
+    def write_deferred_variants(self, frame, photo_name, datetime_stamp, postfixes):
+        # Runs on the deferred saver thread, which is already low priority
+        trace = self.tracer.start_trace(photo_name + " deferred")
+        self.write_variants(frame, photo_name, datetime_stamp, postfixes, trace, parallel=False)
+        
+    def backfill_display_cache(self):
+        # Photos from before a restart, newest first since the shuffle is most likely to hit those
+        photo_paths = []
+        for photo_name in sorted(self.photo_path_db.image_names(), reverse=True):
+            if self.photo_path_db.image_has_postfix(photo_name, self._display_postfix):
+                photo_paths.append((photo_name, self.photo_path_db.get_image_path(photo_name, self._display_postfix)))
+        self.display_cache.start_backfill(photo_paths)
+        
+    def variant_dirs(self):
+        return {
+            self._gray_postfix: self._gray_image_dir,
+            self._color_postfix: self._color_image_dir,
+            "_original": self._original_image_dir,
+        }
         
-        h, w = final_image.shape[:2]
-        datetime_stamp = datetime.now()
+    def write_variants(self, frame, photo_name, datetime_stamp, postfixes, trace, parallel=True):
+        final_image = None
+        gray_image = None
+        orig_image = None
+        rectified_frame = None
+        if frame.yuv420 and self._undistorter and ((self._gray_postfix in postfixes) or (self._color_postfix in postfixes)):
+            # Remap the YUV planes once, then both variants come from the undistorted frame
+            with trace.span("undistort"):
+                rectified_frame = CaptureFrame(self._undistorter.undistort_i420(frame), yuv420=True)
+            if self._gray_postfix in postfixes:
+                gray_image = rectified_frame.gray()
+            if self._color_postfix in postfixes:
+                with trace.span("color_convert"):
+                    final_image = rectified_frame.rgb()
+        elif frame.yuv420:
+            # The Y plane is the gray image, only convert to RGB for the color variants
+            if self._gray_postfix in postfixes:
+                gray_image = self.rectify(frame.gray(), trace, "undistort" + self._gray_postfix)
+            if self._color_postfix in postfixes:
+                with trace.span("color_convert"):
+                    rgb_image = frame.rgb()
+                final_image = self.rectify(rgb_image, trace, "undistort" + self._color_postfix)
+        elif (self._gray_postfix in postfixes) or (self._color_postfix in postfixes):
+            final_image = self.rectify(frame.rgb(), trace)
+            # Single channel, written as a grayscale JPEG
+            with trace.span("gray_convert"):
+                gray_image = cv2.cvtColor(final_image, cv2.COLOR_RGB2GRAY)
+        if "_original" in postfixes:
+            orig_image = frame.rgb()
+        
+        if rectified_frame is not None:
+            # Trimmed to even dimensions for the chroma planes
+            w, h = rectified_frame.width, rectified_frame.height
+        elif self._undistorter:
+            x, y, w, h = self._lens_cal[1]
+        else:
+            w, h = frame.width, frame.height
                     
         path_dict = {}
-        photo_name = self.cap_timestamp_str
-        for (cv_img, dir_i, postfix) in [
-                (gray_image, self._gray_image_dir, self._gray_postfix),
-                (final_image, self._color_image_dir, self._color_postfix),
-                (orig_image, self._original_image_dir, "_original")
+        encode_jobs = []
+        encode_spans = []
+        variant_dirs = self.variant_dirs()
+        for (cv_img, postfix) in [
+                (gray_image, self._gray_postfix),
+                (final_image, self._color_postfix),
+                (orig_image, "_original")
                 ]:
-            if dir_i:
+            dir_i = variant_dirs[postfix]
+            if dir_i and (postfix in postfixes):
                 exif_bytes = get_exif(w, h, datetime_stamp, postfix)
                 image_path = os.path.join(
                     dir_i,
                     photo_name + postfix + ".jpg"
                 )
                 if (self._watermarker is not None) and (postfix != "_original"):
-                    self._watermarker.apply_watermark(cv_img)
-                img = Image.fromarray(cv_img)
-                img.save(image_path, quality=95, exif=exif_bytes)
+                    with trace.span("watermark" + postfix):
+                        self._watermarker.apply_watermark(cv_img)
+                if (self.display_cache is not None) and (postfix == self._display_postfix):
+                    # Small copy for the shuffle, so it never has to decode the full photo
+                    with trace.span("display_derivative"):
+                        self.display_cache.write_derivative(photo_name, cv_img, bgr=False)
+                encode_jobs.append((cv_img, image_path, exif_bytes))
+                encode_spans.append(trace.span("encode" + postfix))
                 
                 path_dict[postfix] = image_path
-                
-        self.photo_path_db.add_image(photo_name, path_dict)
-        self.photo_path_db.update_file()
         
-        #return an image to display
-        if self._display_gray:
-            display_image = cv2.cvtColor(gray_image, cv2.COLOR_BGR2RGB)
+        if parallel:
+            # Encode all the variants at once
+            self.jpeg_writer.write(encode_jobs, quality=95, spans=encode_spans)
         else:
-            display_image = cv2.cvtColor(final_image, cv2.COLOR_BGR2RGB)
-        return display_image, photo_name
+            for ((cv_img, image_path, exif_bytes), span) in zip(encode_jobs, encode_spans):
+                with span:
+                    self.jpeg_writer.encoder.save(cv_img, image_path, 95, exif_bytes)
+                
+        with trace.span("db_write"), self._photo_db_lock:
+            self.photo_path_db.update_image(photo_name, path_dict)
+            self.photo_path_db.update_file()
         
     def check_shutdown_button(self):
         if self.is_button_pressed():
-            if self.timers.check("button_release"):
+            if not self.timers.is_armed("button_release"):
+                self.timers.start("button_release")
+            elif self.timers.check("button_release"):
                 self.stop_pwm()
                 print("Shutting down")
-                os.system("sudo shutdown now")
+                self.hardware.shutdown()
         else:
-            self.timers.restart("button_release")
+            self.timers.stop("button_release")
             
     def set_button_led(self):
-        pulse_time = time.perf_counter() % self._button_pulse_time
+        pulse_time = self.clock() % self._button_pulse_time
         half_pulse_time = self._button_pulse_time / 2
         if pulse_time > half_pulse_time:
             pulse_time = self._button_pulse_time - pulse_time
         ratio = pulse_time / half_pulse_time
         
+        # The animator does the actual fading, started at 0 so it stays in phase with the arrow
         if self.state == self.state_countdown:
-            self.change_button_led_dc(0)
+            self.led_animator.play("button", self.button_off_curve)
         elif (self.state == self.state_idle) or (self.state == self.state_display_capture):
-            pwm_ratio = np.exp(ratio * 3) / np.exp(3)
-            pwm_val = pwm_ratio * 100
-            self.change_button_led_dc(pwm_val)
+            self.led_animator.play("button", self.button_pulse_curve, start_time=0)
         return ratio
             
     def main_loop(self):
         self.timers.update_time()
+        self.timers.run_due()
         self.check_shutdown_button()
         
         if self.next_state != self.state:
-            print("Moving from", self.state, "to", self.next_state, "at", time.time() % 100)
+            print("Moving from", self.state, "to", self.next_state, "at", self.clock() % 100)
             if self.state:
                 self.state.exit()
             self.state = self.next_state
             self.state.enter()
         self.next_state = self.state.run()
         
+        if self.deferred_saver is not None:
+            self.deferred_saver.set_idle(self.is_idle())
+        
         # Update visuals
         button_brightness = self.set_button_led()
         self.set_arrow_overlay(button_brightness)
-        
-        if self.wifi_check and self.timers.check("wifi_check", auto_restart=True):
+        if self.wifi_check:
             self.set_wifi_overlay()
-            
+        
         new_overlay, overlay = self.overlay_manager.update_overlay()
         if new_overlay:
             self.qpicamera2.set_overlay(overlay)
+            if self.trace_pending_display is not None:
+                # Close enough, the preview draws it on its next frame
+                self.trace_pending_display.mark("first_display")
+                self.trace_pending_display = None
+            
+        self.schedule_main_loop()
+
+    def wake(self):
+        # Run the main loop as soon as Qt gets to it, e.g. on a button edge
+        self.loop_timer.start(0)
+
+    def needs_polling(self):
+        return (
+                (self.state in [self.state_countdown, self.state_capture])
+                or self._continuous_cap
+                or self._overlays_pending
+            )
+
+    def next_arrow_toggle(self, now):
+        # set_arrow_overlay flips the arrow when the pulse ratio crosses 0.5,
+        # which happens a quarter and three quarters of the way through each pulse
+        if self.state not in [self.state_idle, self.state_display_capture]:
+            return None
+        period = self._button_pulse_time
+        phase = now % period
+        for crossing in [period / 4, period * 3 / 4, period * 5 / 4]:
+            if crossing > phase:
+                return now - phase + crossing + 0.001
+
+    def schedule_main_loop(self):
+        now = self.clock()
+        if self.next_state != self.state:
+            delay = 0
+        elif self.needs_polling():
+            delay = POLL_TIME_S
+        else:
+            # Sleep until the next timer or arrow blink, but never so long that
+            # slow changes like a save finishing go unnoticed
+            deadlines = [self.timers.next_deadline(), self.next_arrow_toggle(now)]
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            delay = self._max_loop_sleep
+            if deadlines:
+                delay = min(delay, min(deadlines) - now)
+        # Rounding up so the timer that's due has actually expired when we wake
+        self.loop_timer.start(max(math.ceil(delay * 1000), 0))
+
+    def is_idle(self):
+        # Idle enough for background work: no countdown or capture, and not between shots
+        return (
+                (self.state in [self.state_idle, self.state_display_capture])
+                and (self.next_state == self.state)
+                and (self.extra_shots == 0)
+                and (self.capture_saver.pending_saves() == 0)
+            )
 
     def set_arrow_overlay(self, button_brightness):
         if self.state in [self.state_idle, self.state_display_capture]:
@@ -461,29 +859,16 @@ class PhotoBooth:
             self.overlay_manager.deactivate_layer(name="wifi")
 
     def check_wifi_connection(self):
-        try:
-            # Run the iwgetid command with the -r flag to get the SSID
-            ssid = subprocess.check_output(['iwgetid', '-r']).decode('utf-8').strip()
-            if ssid:
-                return ssid
-            else:
-                return None
-        except subprocess.CalledProcessError:
-            return None
+        # Cached by the network monitor thread, which wakes the main loop when it changes
+        return self.network_monitor.is_wifi_connected()
 
     def create_image_display_overlay(self, bgr_image):
-        new_dims = (DISPLAY_IMG_WIDTH, DISPLAY_IMG_HEIGHT)
-        rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
-        resized_image = cv2.resize(rgb_image, new_dims)
-        display_overlay = np.zeros((DISPLAY_HEIGHT, DISPLAY_WIDTH, 4), dtype=np.uint8)
-        display_overlay[:] = (0, 0, 0, 255)
-        display_overlay[BORDER_HEIGHT:BORDER_HEIGHT+DISPLAY_IMG_HEIGHT,BORDER_WIDTH:BORDER_WIDTH+DISPLAY_IMG_WIDTH,:3] = resized_image
-        return display_overlay
+        return self.display_renderer.render(bgr_image, bgr=True)
 
 
 
-config = load_config()
-app = QApplication([])
-photo_booth = PhotoBooth(config)
-app.exec()
+if __name__ == "__main__":
+    config = load_config()
+    photo_booth = PhotoBooth(config)
+    photo_booth.hardware.run()
 
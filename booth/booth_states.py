@@ -3,6 +3,10 @@ import time
 import cv2
 import os
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common.image_loader import load_image_resized
 
 # Capture sequence timing
 LED_FADE_S = 1.71 # How long before capture to start brightening LEDs
@@ -15,6 +19,13 @@ LED_FADE_S_EXTRA_SHOT = 0.51 # How long before capture to start brightening LEDs
 LED_END_S_EXTRA_SHOT = 0.31 # How long before capture to hit 100% brightness
 COUNT_S_EXTRA_SHOT = 3
 
+def lower_thread_priority(niceness=10):
+    # Background work shouldn't compete with the preview and the countdown
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError) as e:
+        print("Couldn't lower thread priority:", e)
+
 class State:
     def __init__(self, machine):
         self.machine = machine
@@ -50,7 +61,10 @@ class StateIdle(State):
         
     def run(self):
         if self.machine.is_button_pressed() or self.machine._continuous_cap:
-            return self.machine.state_countdown
+            if self.machine.can_start_capture():
+                return self.machine.state_countdown
+        # Fill the overlay cache so the countdown never composites
+        self.machine.precompute_countdown_overlays()
         return self
 
 
@@ -80,6 +94,16 @@ class StateCountdown(State):
             if self.machine._enable_multi_shot:
                 self.overlay_manager.activate_layer("three_shots")
             self.timers.start("capture_countdown", COUNT_S)
+        # The end of the countdown. Shutter lag is measured from it, and ZSL picks the frame nearest it
+        self.machine.capture_deadline = self.timers.end_times["capture_countdown"]
+        # Extra shots start on their own, only the first one comes from a button press
+        trace = self.machine.tracer.start_trace()
+        button_edge_time = self.machine.take_button_edge()
+        if self.set_ae and (button_edge_time is not None):
+            trace.mark("button_edge", button_edge_time)
+        trace.mark("countdown_start")
+        self.machine.capture_trace = trace
+        self.machine.fade_leds(self.timers.time_left("capture_countdown"), self.led_fade_s, self.led_end_s)
 
     def exit(self):
         print("Capturing at", self.timers.time_left("capture_countdown"))
@@ -99,18 +123,14 @@ class StateCountdown(State):
                         self.machine.extra_shots = 2
                         self.overlay_manager.deactivate_layer("three_shots")
                 
-        if self.timers.check("capture_countdown"):
+        time_left = self.timers.time_left("capture_countdown")
+        if time_left <= 0:
             return self.machine.state_capture
         else:
-            self.apply_timestamp_overlay()
-            time_left = self.timers.time_left("capture_countdown")
-            if time_left <= self.led_fade_s:
-                led_fade = (self.led_fade_s - time_left) / (self.led_fade_s - self.led_end_s)
-                self.machine.set_leds(fade=led_fade)
-                
+            self.apply_timestamp_overlay(time_left)
             if time_left <= self.exposure_set_s:
                 if not self.exposure_set:
-                    print("Setting exposure at", self.timers.time_left("capture_countdown"))
+                    print("Setting exposure at", time_left)
                     self.machine.picam2.set_controls(
                         self.machine.exposure_settings
                     )
@@ -123,14 +143,16 @@ class StateCountdown(State):
                     
             if time_left <= PRE_CONTROL_S:
                 if not self.mode_switched:
-                    print("Switching mode at", self.timers.time_left("capture_countdown"))
+                    print("Switching mode at", time_left)
                     self.machine.set_cam_controls_capture()
+                    self.machine.start_zsl_ring()
                     self.machine.set_capture_overlay()
+                    self.machine.capture_trace.mark("control_switch")
                     self.mode_switched = True
         return self
         
-    def apply_timestamp_overlay(self):
-        countdown = str(int(np.ceil(self.timers.time_left("capture_countdown"))))
+    def apply_timestamp_overlay(self, time_left):
+        countdown = str(int(np.ceil(time_left)))
         if countdown != self.countdown_timestamp:
             if self.countdown_layer_name:
                 self.overlay_manager.deactivate_layer(self.countdown_layer_name)
@@ -149,20 +171,23 @@ class StateCapture(State):
         super().__init__(machine)
 
     def enter(self):
-        cap_timestamp_str = time.strftime("%y%m%d_%H%M%S")
-        print("Captured", cap_timestamp_str)
+        cap_timestamp_str = self.machine.hardware.datetime_now().strftime("%y%m%d_%H%M%S")
+        print("Captured", cap_timestamp_str, "pending saves", self.machine.capture_saver.pending_saves())
         self.machine.cap_timestamp_str = cap_timestamp_str
         self.machine.capture_completed = False
-        self.machine.picam2.capture_arrays(["main"], signal_function=self.machine.qpicamera2.signal_done)
+        self.machine.capture_trace.name = cap_timestamp_str
+        self.machine.capture_trace.mark("capture_request")
+        self.machine.start_capture()
 
     def exit(self):
         return
         
     def run(self):
         if self.machine.capture_completed:
-            captured_display_image, captured_image_name = self.machine.save_capture()
-            self.machine.captured_display_image = captured_display_image
+            captured_display_overlay, captured_image_name, capture_trace = self.machine.save_capture()
+            self.machine.captured_display_overlay = captured_display_overlay
             self.machine.captured_image_name = captured_image_name
+            self.machine.captured_trace = capture_trace
             return self.machine.state_display_capture
         return self
     
@@ -170,39 +195,52 @@ class StateDisplayCapture(State):
     def __init__(self, machine):
         super().__init__(machine)
         self.timers.setup("display_capture_timeout", self.machine._config["display_timeout"])
-        self.timers.setup("qr_code_check", self.machine._config["qr_check_time"])
+        self._qr_check_time = self.machine._config["qr_check_time"]
+        self._qr_check = None
         self._displaying_qr_code = False
         self._display_overlay = None
+        # Prepares the next shuffle image off the Qt thread
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=1, initializer=lower_thread_priority)
+        self._prefetch = None
 
     def enter(self):
         self.timers.start("display_capture_timeout")
         self.timers.start("display_image_timeout", self.machine._display_first_image_time)
-        self.timers.start("qr_code_check")
-        self.display_image(self.machine.captured_display_image)
+        # Periodic callback, stays on its interval no matter when the main loop runs
+        self._qr_check = self.timers.call_every(self._qr_check_time, self.check_qr_code)
+        self.show_overlay(self.machine.captured_display_overlay)
+        # main_loop marks the first display once it hands this overlay to the preview
+        self.machine.trace_pending_display = self.machine.captured_trace
         self._display_image_name = self.machine.captured_image_name
+        self.start_prefetch()
 
     def exit(self):
-        return
+        self.timers.cancel(self._qr_check)
+        self._qr_check = None
         
     def run(self):
         if self.timers.check("display_capture_timeout"):
             return self.machine.state_idle
-        elif self.machine.is_button_pressed() or (self.machine.extra_shots > 0):
+        elif self.machine.extra_shots > 0:
+            return self.machine.state_countdown
+        elif self.machine.is_button_pressed() and self.machine.can_start_capture():
             return self.machine.state_countdown
         else:
-            if self.timers.check("qr_code_check", auto_restart=True):
-                if self._display_image_name and not self._displaying_qr_code:
-                    qr_code = self.get_qr_code(self._display_image_name)
-                    if qr_code is not None:
-                        print("FOUND QR CODE", self._display_image_name)
-                        self.add_qr_code(qr_code)
-            
             if self.timers.check("display_image_timeout"):
-                self.display_random_file()
+                if not self.show_prefetched():
+                    self.display_random_file()
+                self.start_prefetch()
                 self.timers.start("display_image_timeout", self.machine._display_shuffle_time)
 
         return self
     
+    def check_qr_code(self):
+        if self._display_image_name and not self._displaying_qr_code:
+            qr_code = self.get_qr_code(self._display_image_name)
+            if qr_code is not None:
+                print("FOUND QR CODE", self._display_image_name)
+                self.add_qr_code(qr_code)
+    
     def get_qr_code(self, image_name):
         if not self.machine.qr_path_db.try_update_from_file():
             print("Error updating qr path db")
@@ -212,27 +250,103 @@ class StateDisplayCapture(State):
             qr_image = cv2.imread(qr_path)
         return qr_image
     
+    def start_prefetch(self):
+        # Pick and prepare the next shuffle image now, so the swap is just a blit
+        photo_names = list(self.machine.photo_path_db.image_names())
+        if self._display_image_name in photo_names and len(photo_names) > 1:
+            photo_names.remove(self._display_image_name)
+        if not photo_names:
+            self._prefetch = None
+            return
+        name = photo_names[random.randrange(len(photo_names))]
+        photo_path = self.machine.photo_path_db.get_image_path(name, self.machine._display_postfix)
+        qr_path = None
+        if self.machine.qr_path_db.image_exists(name):
+            qr_path = self.machine.qr_path_db.get_image_path(name)
+        self._prefetch = self._prefetch_executor.submit(self.prepare_shuffle, name, photo_path, qr_path)
+        
+    def prepare_shuffle(self, name, photo_path, qr_path):
+        # Runs on the prefetch thread. Returns (name, overlay, has_qr), the overlay is ours to draw on
+        if self.machine.display_cache is not None:
+            overlay = self.machine.display_cache.get_overlay(name, photo_path)
+            if overlay is None:
+                return None
+            overlay = overlay.copy()
+        else:
+            if not os.path.exists(photo_path):
+                return None
+            renderer = self.machine.display_renderer
+            image = load_image_resized(photo_path, (renderer.image_width, renderer.image_height), cv2.IMREAD_UNCHANGED)
+            if image is None:
+                return None
+            overlay = renderer.render(image, bgr=True, buffer=renderer.new_buffer())
+        qr_code = cv2.imread(qr_path) if qr_path else None
+        if qr_code is not None:
+            self.draw_qr_code(overlay, qr_code)
+        return name, overlay, qr_code is not None
+        
+    def show_prefetched(self):
+        # False if there's nothing usable, and the caller should load one the slow way
+        prefetch, self._prefetch = self._prefetch, None
+        if (prefetch is None) or not prefetch.done():
+            return False
+        try:
+            prepared = prefetch.result()
+        except Exception as e:
+            print("Shuffle prefetch failed:", e)
+            return False
+        if prepared is None:
+            return False
+        name, overlay, has_qr = prepared
+        if not self.machine.photo_path_db.image_exists(name):
+            # Removed from the db since it was picked
+            return False
+        self._display_image_name = name
+        self._display_overlay = overlay
+        # If the QR code wasn't there yet, check_qr_code adds it when it shows up
+        self._displaying_qr_code = has_qr
+        self.overlay_manager.set_main_image(self._display_overlay, exclusive=False)
+        return True
+        
     def display_random_file(self):
         photo_names = list(self.machine.photo_path_db.image_names())
         num_files = len(photo_names)
+        if num_files == 0:
+            # The first capture may still be in the save queue
+            return
         name = photo_names[random.randrange(num_files)]
         photo_path = self.machine.photo_path_db.get_image_path(name, self.machine._display_postfix)
+        if self.machine.display_cache is not None:
+            overlay = self.machine.display_cache.get_overlay(name, photo_path)
+            if overlay is not None:
+                self._display_image_name = name
+                # The QR code gets drawn on the shown overlay, so show a copy of the cached one
+                self.show_overlay(self.machine.display_renderer.copy_to_buffer(overlay), self.get_qr_code(name))
+            return
         image = None
         if os.path.exists(photo_path):
             self._display_image_name = name
-            image = cv2.imread(photo_path)
+            # Gray photos are single channel JPEGs, keep them that way. Decoded at about display size
+            renderer = self.machine.display_renderer
+            image = load_image_resized(photo_path, (renderer.image_width, renderer.image_height), cv2.IMREAD_UNCHANGED)
         if image is not None:
             self.display_image(image, qr_code=self.get_qr_code(name))
     
-    def add_qr_code(self, qr_code):
-        self._displaying_qr_code = True
+    def draw_qr_code(self, overlay, qr_code):
         q_pos = self.machine._config["qr_pos"]
         resized_qrcode = cv2.resize(qr_code, (q_pos[2], q_pos[3]), cv2.INTER_NEAREST)
-        self._display_overlay[q_pos[1]:q_pos[1]+q_pos[3],q_pos[0]:q_pos[0]+q_pos[2],:3] = resized_qrcode
+        overlay[q_pos[1]:q_pos[1]+q_pos[3],q_pos[0]:q_pos[0]+q_pos[2],:3] = resized_qrcode
+        
+    def add_qr_code(self, qr_code):
+        self._displaying_qr_code = True
+        self.draw_qr_code(self._display_overlay, qr_code)
         self.overlay_manager.set_main_image(self._display_overlay, exclusive=False)
         
     def display_image(self, bgr_image, qr_code=None):
-        self._display_overlay = self.machine.create_image_display_overlay(bgr_image)
+        self.show_overlay(self.machine.create_image_display_overlay(bgr_image), qr_code)
+        
+    def show_overlay(self, display_overlay, qr_code=None):
+        self._display_overlay = display_overlay
         
         self._displaying_qr_code = False
         if qr_code is not None:
@@ -0,0 +1,78 @@
+import threading
+import cv2
+import numpy as np
+
+class CaptureFrame:
+    """
+    Wraps a captured main stream array so the gray and RGB versions are only
+    computed when something asks for them. In YUV420 mode the gray image is
+    just the Y plane, and RGB is only converted if a color variant needs it.
+    """
+    def __init__(self, array, yuv420=False, size=None):
+        self.array = array
+        self.yuv420 = yuv420
+        if yuv420:
+            # Planar I420: (h * 3 / 2, stride) where stride may be padded past the width
+            self.height = array.shape[0] * 2 // 3
+            self.width = size[0] if size is not None else array.shape[1]
+        else:
+            self.height, self.width = array.shape[:2]
+        self._rgb = None
+        self._lock = threading.Lock()
+
+    def save(self, path):
+        # Raw dump, no encoding, so it's cheap on the CPU
+        np.save(path, self.array)
+
+    @classmethod
+    def load(cls, path, yuv420=False, size=None):
+        return cls(np.load(path), yuv420=yuv420, size=size)
+
+    def gray(self):
+        # Returns a view into the capture in YUV mode, so copy before modifying it
+        if self.yuv420:
+            return self.array[:self.height, :self.width]
+        return cv2.cvtColor(self.rgb(), cv2.COLOR_RGB2GRAY)
+
+    def rgb(self):
+        if not self.yuv420:
+            return self.array
+        with self._lock:
+            if self._rgb is None:
+                self._rgb = cv2.cvtColor(self.i420(), cv2.COLOR_YUV2RGB_I420)
+            return self._rgb
+
+    def planes(self):
+        # Y, U and V views into the capture, without repacking
+        h, w = self.height, self.width
+        stride = self.array.shape[1]
+        flat = self.array.reshape(-1)
+        chroma_size = (h // 2) * (stride // 2)
+        y_plane = self.array[:h, :w]
+        u_plane = flat[h * stride:h * stride + chroma_size].reshape(h // 2, stride // 2)[:, :w // 2]
+        v_plane = flat[h * stride + chroma_size:h * stride + 2 * chroma_size].reshape(h // 2, stride // 2)[:, :w // 2]
+        return y_plane, u_plane, v_plane
+
+    def i420(self):
+        # Repack the planes without the stride padding, cvtColor needs them contiguous
+        h, w = self.height, self.width
+        if self.array.shape[1] == w:
+            return self.array
+        y_plane, u_plane, v_plane = self.planes()
+        packed = np.concatenate([y_plane.reshape(-1), u_plane.reshape(-1), v_plane.reshape(-1)])
+        return packed.reshape(h * 3 // 2, w)
+
+    def sharpness(self, crop_fraction=0.5):
+        # Variance of the Laplacian over the middle of the frame, where the faces are, higher is sharper.
+        # Every other row is plenty to compare frames of a burst, and keeps it to a couple of ms on the lores stream
+        h, w = self.height, self.width
+        y0 = int(h * (1 - crop_fraction) / 2)
+        x0 = int(w * (1 - crop_fraction) / 2)
+        if self.yuv420:
+            center = self.array[y0:h - y0:2, x0:w - x0]
+        else:
+            # Green is most of the luma, and skips converting the whole frame
+            center = np.ascontiguousarray(self.array[y0:h - y0:2, x0:w - x0, 1])
+        laplacian = cv2.Laplacian(center, cv2.CV_16S)
+        _, std_dev = cv2.meanStdDev(laplacian)
+        return float(std_dev[0, 0]) ** 2
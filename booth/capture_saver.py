@@ -0,0 +1,67 @@
+import queue
+import threading
+import time
+
+class CaptureSaver:
+    """
+    Runs capture saves (undistort, watermark, JPEG encode, DB update) on a
+    background thread so the Qt thread can keep drawing the preview.
+    The queue is bounded: once max_pending saves are outstanding, is_full()
+    returns True and submit() blocks until a slot frees up.
+    """
+    def __init__(self, save_function, max_pending=3):
+        self._save_function = save_function
+        self._max_pending = max_pending
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def submit(self, *args, block=True):
+        with self._lock:
+            self._pending += 1
+        try:
+            self._queue.put(args, block=block)
+        except queue.Full:
+            with self._lock:
+                self._pending -= 1
+            return False
+        return True
+
+    def pending_saves(self):
+        # Includes the save that's currently being written
+        with self._lock:
+            return self._pending
+
+    def is_full(self):
+        return self.pending_saves() >= self._max_pending
+
+    def wait_until_done(self, timeout=None):
+        start_time = time.perf_counter()
+        while self.pending_saves() > 0:
+            if (timeout is not None) and (time.perf_counter() - start_time > timeout):
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self, timeout=None):
+        # Finish whatever is queued, then shut the worker down
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _worker(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                break
+            start_time = time.perf_counter()
+            try:
+                self._save_function(*args)
+            except Exception as e:
+                print("capture_saver.py: Save failed:", e)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+            time_ms = int((time.perf_counter() - start_time) * 1000)
+            print("capture_saver.py: Save time", time_ms, "ms, pending", self.pending_saves())
@@ -0,0 +1,180 @@
+from collections import deque
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from capture_frame import CaptureFrame
+
+# Keep this many queued frames in RAM, older ones get reloaded from the spool
+MAX_FRAMES_IN_MEMORY = 3
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+# Tries per job before it's left in the spool for the next restart
+MAX_JOB_ATTEMPTS = 3
+
+class DeferredJob:
+    def __init__(self, photo_name, datetime_stamp, postfixes, yuv420, size, frame=None):
+        self.photo_name = photo_name
+        self.datetime_stamp = datetime_stamp
+        self.postfixes = list(postfixes)
+        self.yuv420 = yuv420
+        self.size = size
+        self.frame = frame
+        self.failures = 0
+
+    def to_dict(self):
+        return {
+            "photo_name": self.photo_name,
+            "datetime": self.datetime_stamp.strftime(DATETIME_FORMAT),
+            "postfixes": self.postfixes,
+            "yuv420": self.yuv420,
+            "size": list(self.size),
+        }
+
+    @classmethod
+    def from_dict(cls, job_dict):
+        return cls(
+                job_dict["photo_name"],
+                datetime.strptime(job_dict["datetime"], DATETIME_FORMAT),
+                job_dict["postfixes"],
+                job_dict["yuv420"],
+                tuple(job_dict["size"]),
+            )
+
+
+class DeferredSaver:
+    """
+    Writes the variants that aren't needed right away (everything except
+    the display variant) while the booth is idle. Each job's frame is spooled
+    to disk as a raw .npy with a .json job file next to it, so work that's
+    left over when the booth restarts gets picked up again.
+    """
+    def __init__(self, write_function, spool_dir, niceness=10):
+        self._write_function = write_function
+        self._spool_dir = spool_dir
+        self._niceness = niceness
+        self._jobs = deque()
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._stop = False
+        os.makedirs(spool_dir, exist_ok=True)
+        self.load_spooled_jobs()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def spool_paths(self, photo_name):
+        base_path = os.path.join(self._spool_dir, photo_name)
+        return base_path + ".npy", base_path + ".json"
+
+    def load_spooled_jobs(self):
+        for job_path in sorted(glob.glob(os.path.join(self._spool_dir, "*.json"))):
+            try:
+                with open(job_path, "r") as job_file:
+                    job = DeferredJob.from_dict(json.load(job_file))
+            except Exception as e:
+                print("deferred_saver.py: Couldn't load job", job_path, e)
+                continue
+            if os.path.isfile(self.spool_paths(job.photo_name)[0]):
+                self._jobs.append(job)
+        if self._jobs:
+            print("deferred_saver.py: Picked up", len(self._jobs), "unfinished jobs")
+
+    def add_job(self, frame, photo_name, datetime_stamp, postfixes):
+        job = DeferredJob(photo_name, datetime_stamp, postfixes, frame.yuv420, (frame.width, frame.height), frame)
+        frame_path, _ = self.spool_paths(photo_name)
+        frame.save(frame_path)
+        self.write_job_file(job)
+        with self._lock:
+            self._jobs.append(job)
+            # Let the older frames be reloaded from the spool instead of holding them in RAM
+            for old_job in list(self._jobs)[:-MAX_FRAMES_IN_MEMORY]:
+                old_job.frame = None
+
+    def write_job_file(self, job):
+        _, job_path = self.spool_paths(job.photo_name)
+        temp_path = job_path + ".tmp"
+        with open(temp_path, "w") as job_file:
+            json.dump(job.to_dict(), job_file)
+        os.replace(temp_path, job_path)
+
+    def remove_job_files(self, job):
+        for path in self.spool_paths(job.photo_name):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def pending_jobs(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def set_idle(self, idle):
+        # Called every main loop tick, deferred work only runs while this is set
+        if idle:
+            self._idle.set()
+        else:
+            self._idle.clear()
+
+    def stop(self):
+        self._stop = True
+        self._idle.set()
+        self._thread.join()
+
+    def _worker(self):
+        try:
+            # Lower this thread's priority so the preview and countdown always win
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self._niceness)
+        except (AttributeError, OSError) as e:
+            print("deferred_saver.py: Couldn't lower thread priority:", e)
+        while not self._stop:
+            if not self._idle.wait(timeout=0.5) or self._stop:
+                continue
+            with self._lock:
+                job = self._jobs[0] if self._jobs else None
+            if job is None:
+                time.sleep(0.5)
+                continue
+            try:
+                self.run_job_step(job)
+            except Exception as e:
+                self.job_failed(job, e)
+
+    def run_job_step(self, job):
+        # One variant at a time, so a button press only waits for one encode
+        frame = job.frame
+        if frame is None:
+            frame_path, _ = self.spool_paths(job.photo_name)
+            frame = CaptureFrame.load(frame_path, yuv420=job.yuv420, size=job.size)
+            job.frame = frame
+        postfix = job.postfixes[0]
+        start_time = time.perf_counter()
+        self._write_function(frame, job.photo_name, job.datetime_stamp, [postfix])
+        time_ms = int((time.perf_counter() - start_time) * 1000)
+        print("deferred_saver.py: Wrote", job.photo_name + postfix, "in", time_ms, "ms")
+        job.postfixes.pop(0)
+        if job.postfixes:
+            self.write_job_file(job)
+        else:
+            self.finish_job(job)
+
+    def job_failed(self, job, exception):
+        # The spool files stay put whatever happens, they're only removed once every variant is written
+        job.failures += 1
+        job.frame = None
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+                if job.failures < MAX_JOB_ATTEMPTS:
+                    # To the back, so one bad job doesn't hold up the rest
+                    self._jobs.append(job)
+        if job.failures < MAX_JOB_ATTEMPTS:
+            print("deferred_saver.py: Job", job.photo_name, "failed, will retry:", exception)
+        else:
+            print("deferred_saver.py: Job", job.photo_name, "failed", job.failures, "times, leaving it in the spool until the next restart:", exception)
+
+    def finish_job(self, job):
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+        job.frame = None
+        self.remove_job_files(job)
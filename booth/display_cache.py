@@ -0,0 +1,100 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+import cv2
+
+from common.image_loader import load_image_resized
+
+class DisplayCache:
+    """
+    Display-size copies of the saved photos for the shuffle. Each photo gets a
+    small JPEG the size of the display image area, written at capture time or
+    by the startup backfill, and the rendered RGBA overlays are kept in an LRU
+    capped by memory. A shuffle is then a small decode or just a lookup
+    instead of decoding the full 12MP JPEG.
+    """
+    def __init__(self, cache_dir, display_renderer, memory_budget_mb=32, niceness=10):
+        self._cache_dir = cache_dir
+        self._renderer = display_renderer
+        self._size = (display_renderer.image_width, display_renderer.image_height)
+        self._budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self._niceness = niceness
+        self._overlays = OrderedDict()
+        self._overlay_bytes = 0
+        self._lock = threading.Lock()
+        self._backfill_thread = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def derivative_path(self, photo_name):
+        return os.path.join(self._cache_dir, photo_name + ".jpg")
+
+    def has_derivative(self, photo_name):
+        return os.path.isfile(self.derivative_path(photo_name))
+
+    def write_derivative(self, photo_name, image, bgr=True):
+        # Gray images stay single channel. Written to a temp file so a shuffle never reads half of one
+        small = cv2.resize(image, self._size, interpolation=cv2.INTER_AREA)
+        if (not bgr) and (small.ndim == 3):
+            small = cv2.cvtColor(small, cv2.COLOR_RGB2BGR)
+        path = self.derivative_path(photo_name)
+        # The backfill and a shuffle can write the same photo at once
+        temp_path = f"{path}.{threading.get_native_id()}.tmp.jpg"
+        cv2.imwrite(temp_path, small, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        os.replace(temp_path, path)
+
+    def get_overlay(self, photo_name, photo_path=None):
+        # The rendered overlay for a photo, or None if it can't be loaded. Don't draw on it
+        with self._lock:
+            overlay = self._overlays.get(photo_name)
+            if overlay is not None:
+                self._overlays.move_to_end(photo_name)
+                return overlay
+        image = None
+        if self.has_derivative(photo_name):
+            image = cv2.imread(self.derivative_path(photo_name), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            if (photo_path is None) or not os.path.exists(photo_path):
+                return None
+            # Photo from before the cache existed and the backfill hasn't got to it yet
+            image = load_image_resized(photo_path, self._size, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                return None
+            self.write_derivative(photo_name, image)
+        overlay = self._renderer.render(image, bgr=True, buffer=self._renderer.new_buffer())
+        self.add_overlay(photo_name, overlay)
+        return overlay
+
+    def add_overlay(self, photo_name, overlay):
+        with self._lock:
+            if photo_name in self._overlays:
+                self._overlay_bytes -= self._overlays.pop(photo_name).nbytes
+            self._overlays[photo_name] = overlay
+            self._overlay_bytes += overlay.nbytes
+            while (self._overlay_bytes > self._budget_bytes) and (len(self._overlays) > 1):
+                _, old_overlay = self._overlays.popitem(last=False)
+                self._overlay_bytes -= old_overlay.nbytes
+
+    def start_backfill(self, photo_paths):
+        # photo_paths is [(photo_name, path)], written on a low priority thread
+        missing = [(name, path) for (name, path) in photo_paths if not self.has_derivative(name)]
+        if not missing:
+            return
+        print("display_cache.py: Backfilling", len(missing), "display images")
+        self._backfill_thread = threading.Thread(target=self._backfill, args=(missing,), daemon=True)
+        self._backfill_thread.start()
+
+    def _backfill(self, photo_paths):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self._niceness)
+        except (AttributeError, OSError) as e:
+            print("display_cache.py: Couldn't lower thread priority:", e)
+        start_time = time.perf_counter()
+        for (photo_name, path) in photo_paths:
+            if self.has_derivative(photo_name):
+                continue
+            image = load_image_resized(path, self._size, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                continue
+            self.write_derivative(photo_name, image)
+        print("display_cache.py: Backfill done in", int(time.perf_counter() - start_time), "s")
@@ -0,0 +1,94 @@
+import cv2
+import numpy as np
+
+class DisplayRenderer:
+    """
+    Renders images into the bordered RGBA display overlay. Images are shrunk
+    before any color conversion or channel reordering, and the result is
+    written into one of a few preallocated overlay buffers, so nothing
+    full-size gets converted or allocated on the way to the screen.
+    """
+    def __init__(self, display_width, display_height, image_width, image_height, num_buffers=2):
+        self.display_width = display_width
+        self.display_height = display_height
+        self.image_width = image_width
+        self.image_height = image_height
+        self.border_width = int((display_width - image_width) / 2)
+        self.border_height = int((display_height - image_height) / 2)
+        # The caller may still be showing the last overlay, so alternate between buffers
+        self._buffers = [
+            np.zeros((display_height, display_width, 4), dtype=np.uint8)
+            for _ in range(num_buffers)
+        ]
+        self._buffer_index = 0
+        self._background = np.zeros((display_height, display_width, 4), dtype=np.uint8)
+        self._background[:] = (0, 0, 0, 255)
+
+    def next_buffer(self, buffer=None):
+        # A caller that keeps the overlay around can pass in its own buffer instead
+        if buffer is None:
+            buffer = self._buffers[self._buffer_index]
+            self._buffer_index = (self._buffer_index + 1) % len(self._buffers)
+        # Clears anything drawn in the border, like a QR code
+        np.copyto(buffer, self._background)
+        return buffer
+
+    def new_buffer(self):
+        return np.empty((self.display_height, self.display_width, 4), dtype=np.uint8)
+
+    def copy_to_buffer(self, overlay):
+        # For showing a kept overlay without the QR code ending up in the original
+        buffer = self._buffers[self._buffer_index]
+        self._buffer_index = (self._buffer_index + 1) % len(self._buffers)
+        np.copyto(buffer, overlay)
+        return buffer
+
+    def image_area(self, buffer):
+        return buffer[
+                self.border_height:self.border_height + self.image_height,
+                self.border_width:self.border_width + self.image_width
+            ]
+
+    def shrink(self, image, size):
+        # INTER_LINEAR only reads the pixels it needs, INTER_AREA would average the whole frame
+        return cv2.resize(image, size, interpolation=cv2.INTER_LINEAR)
+
+    def render(self, image, bgr=True, crop=None, gray=False, buffer=None):
+        if crop is not None:
+            x, y, w, h = crop
+            image = image[y:y+h, x:x+w]
+        resized = self.shrink(image, (self.image_width, self.image_height))
+        if gray and resized.ndim == 3:
+            resized = cv2.cvtColor(resized[:, :, :3], cv2.COLOR_BGR2GRAY if bgr else cv2.COLOR_RGB2GRAY)
+        # Reordering whole RGBA pixels is much faster than writing into 3 of 4 channels
+        if resized.ndim == 2:
+            rgba = cv2.cvtColor(resized, cv2.COLOR_GRAY2RGBA)
+        elif bgr:
+            rgba = cv2.cvtColor(resized[:, :, :3], cv2.COLOR_BGR2RGBA)
+        else:
+            rgba = cv2.cvtColor(resized[:, :, :3], cv2.COLOR_RGB2RGBA)
+        buffer = self.next_buffer(buffer)
+        self.image_area(buffer)[:] = rgba
+        return buffer
+
+    def render_yuv420(self, frame, gray=False, crop=None):
+        # frame is a YUV420 CaptureFrame, e.g. the lores stream
+        y_plane, u_plane, v_plane = frame.planes()
+        if crop is not None:
+            x, y, w, h = [int(val / 2) * 2 for val in crop]
+            y_plane = y_plane[y:y+h, x:x+w]
+            u_plane = u_plane[y//2:(y+h)//2, x//2:(x+w)//2]
+            v_plane = v_plane[y//2:(y+h)//2, x//2:(x+w)//2]
+        if gray:
+            return self.render(y_plane)
+        # Shrink each plane to an even display size, then convert only those pixels
+        even_w = self.image_width + (self.image_width % 2)
+        even_h = self.image_height + (self.image_height % 2)
+        small_y = self.shrink(y_plane, (even_w, even_h))
+        small_u = self.shrink(u_plane, (even_w // 2, even_h // 2))
+        small_v = self.shrink(v_plane, (even_w // 2, even_h // 2))
+        i420 = np.concatenate([small_y.reshape(-1), small_u.reshape(-1), small_v.reshape(-1)])
+        rgba = cv2.cvtColor(i420.reshape(even_h * 3 // 2, even_w), cv2.COLOR_YUV2RGBA_I420)
+        buffer = self.next_buffer()
+        self.image_area(buffer)[:] = rgba[:self.image_height, :self.image_width]
+        return buffer
@@ -0,0 +1,77 @@
+import os
+import time
+from datetime import datetime
+
+from picamera2 import Picamera2, MappedArray
+from picamera2.previews.qt import QGlPicamera2
+import libcamera
+from libcamera import controls
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QApplication
+
+# Pi 5 stuff
+from gpiozero import Button
+from rpi_hardware_pwm import HardwarePWM
+
+# Everything the booth touches on the Pi. sim_hardware.py has the same
+# methods with fakes behind them, so the booth can run without any of this.
+
+
+class LoopEvents(QtCore.QObject):
+    # gpiozero and the network monitor call back from their own threads,
+    # emitting this queues the wake up onto the Qt loop
+    wake = QtCore.pyqtSignal()
+    # Zero shutter lag ring frames, the camera thread emits the job
+    frame_ready = QtCore.pyqtSignal(object)
+
+
+class PiHardware:
+    controls = controls
+    MappedArray = MappedArray
+
+    def __init__(self):
+        self.app = QApplication([])
+
+    def clock(self):
+        return time.perf_counter()
+
+    def datetime_now(self):
+        return datetime.now()
+
+    def sensor_time(self, sensor_timestamp):
+        # SensorTimestamp is CLOCK_MONOTONIC in ns, the same clock as perf_counter on Linux
+        return sensor_timestamp / 1e9
+
+    def create_camera(self):
+        return Picamera2()
+
+    def create_preview(self, picam2, width, height, hflip=True):
+        return QGlPicamera2(
+                picam2,
+                width=width,
+                height=height,
+                keep_ar=False,
+                transform=libcamera.Transform(hflip=int(hflip))
+            )
+
+    def create_timer(self, callback):
+        # Single shot, the main loop re-arms it for whatever is due next
+        timer = QtCore.QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(callback)
+        return timer
+
+    def create_loop_events(self):
+        return LoopEvents()
+
+    def create_button(self, pin):
+        return Button(pin)
+
+    def create_pwm(self, pwm_channel, hz, chip):
+        return HardwarePWM(pwm_channel=pwm_channel, hz=hz, chip=chip)
+
+    def shutdown(self):
+        os.system("sudo shutdown now")
+
+    def run(self):
+        return self.app.exec()
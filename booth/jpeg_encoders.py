@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import cv2
+import numpy as np
+import piexif
+from PIL import Image
+
+# Optional, faster on the Pi if libturbojpeg and PyTurboJPEG are installed
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY, TJSAMP_420, TJSAMP_GRAY
+except ImportError:
+    TurboJPEG = None
+
+# Images coming from the camera are RGB ordered, same as PIL expects
+
+class JpegEncoder:
+    name = "base"
+
+    def encode(self, image, quality):
+        raise NotImplementedError
+
+    def save(self, image, path, quality=95, exif_bytes=None):
+        jpeg_bytes = self.encode(image, quality)
+        if exif_bytes:
+            piexif.insert(exif_bytes, jpeg_bytes, path)
+        else:
+            with open(path, "wb") as jpeg_file:
+                jpeg_file.write(jpeg_bytes)
+
+
+class PILEncoder(JpegEncoder):
+    name = "pil"
+
+    def encode(self, image, quality):
+        jpeg_buffer = io.BytesIO()
+        Image.fromarray(image).save(jpeg_buffer, format="JPEG", quality=quality)
+        return jpeg_buffer.getvalue()
+
+    def save(self, image, path, quality=95, exif_bytes=None):
+        img = Image.fromarray(image)
+        if exif_bytes:
+            img.save(path, quality=quality, exif=exif_bytes)
+        else:
+            img.save(path, quality=quality)
+
+
+class OpenCVEncoder(JpegEncoder):
+    name = "opencv"
+
+    def encode(self, image, quality):
+        if image.ndim == 3:
+            # imencode expects BGR
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        success, jpeg_array = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not success:
+            raise ValueError("cv2.imencode failed")
+        return jpeg_array.tobytes()
+
+
+class TurboJPEGEncoder(JpegEncoder):
+    name = "turbojpeg"
+
+    def __init__(self):
+        if TurboJPEG is None:
+            raise ImportError("PyTurboJPEG is not installed")
+        self._turbo_jpeg = TurboJPEG()
+
+    def encode(self, image, quality):
+        if image.ndim == 2:
+            image = image[:, :, np.newaxis]
+        if image.shape[2] == 1:
+            return self._turbo_jpeg.encode(image, quality=quality, pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY)
+        return self._turbo_jpeg.encode(image, quality=quality, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+
+
+ENCODERS = {
+    PILEncoder.name: PILEncoder,
+    OpenCVEncoder.name: OpenCVEncoder,
+    TurboJPEGEncoder.name: TurboJPEGEncoder,
+}
+
+
+def get_encoder(name="pil"):
+    try:
+        return ENCODERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown jpeg encoder {name}, must be one of {list(ENCODERS.keys())}")
+    except ImportError as e:
+        print("jpeg_encoders.py: Couldn't load", name, "encoder, falling back to pil:", e)
+        return PILEncoder()
+
+
+class ParallelJpegWriter:
+    """
+    Encodes and writes several variants of a capture at the same time.
+    All the encoders release the GIL while encoding, so threads are enough
+    and the frames are shared with the workers without being copied.
+    """
+    def __init__(self, encoder, num_workers=3):
+        self.encoder = encoder
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="jpeg")
+
+    def write(self, jobs, quality=95, spans=None):
+        # jobs is a list of (image, path, exif_bytes). spans is an optional context manager per job, e.g. for timing
+        spans = spans or [None] * len(jobs)
+        futures = [
+            self._executor.submit(self._save, span, image, path, quality, exif_bytes)
+            for ((image, path, exif_bytes), span) in zip(jobs, spans)
+        ]
+        for future in futures:
+            future.result()
+
+    def _save(self, span, image, path, quality, exif_bytes):
+        if span is None:
+            return self.encoder.save(image, path, quality, exif_bytes)
+        with span:
+            self.encoder.save(image, path, quality, exif_bytes)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
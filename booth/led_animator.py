@@ -0,0 +1,141 @@
+import threading
+import time
+import numpy as np
+
+# Curves are sampled this many times per second into their lookup table
+LUT_RATE = 200
+
+class LedCurve:
+    """
+    A duty cycle animation compiled into a lookup table, so playing it back is
+    just an index. Build them with the pulse, fade and flash helpers below.
+    """
+    def __init__(self, values, duration, loop=False):
+        self.values = np.asarray(values, dtype=np.float32)
+        self.duration = duration
+        self.loop = loop
+
+    @classmethod
+    def from_function(cls, function, duration, loop=False):
+        # One-shot curves include their last sample so they end exactly on it
+        num_samples = max(int(duration * LUT_RATE), 1) + (0 if loop else 1)
+        times = np.arange(num_samples) / LUT_RATE
+        return cls(function(times), duration, loop)
+
+    @classmethod
+    def from_keyframes(cls, keyframes, loop=False):
+        # keyframes is [(time_s, duty_cycle), ...], linear in between and held after the last one
+        key_times, key_values = zip(*keyframes)
+        duration = max(key_times[-1], 1 / LUT_RATE)
+        return cls.from_function(lambda times: np.interp(times, key_times, key_values), duration, loop)
+
+    @classmethod
+    def constant(cls, duty_cycle):
+        return cls([duty_cycle], 0)
+
+    @classmethod
+    def pulse(cls, period, max_dc=100, steepness=3):
+        # Triangle wave through an exponential, the button's breathing effect
+        def pulse_function(times):
+            half_period = period / 2
+            ratio = times % period
+            ratio = np.where(ratio > half_period, period - ratio, ratio) / half_period
+            return np.exp(ratio * steepness) / np.exp(steepness) * max_dc
+        return cls.from_function(pulse_function, period, loop=True)
+
+    @classmethod
+    def fade(cls, start_dc, end_dc, start_s, end_s):
+        # Holds start_dc until start_s, ramps to end_dc at end_s and stays there
+        return cls.from_keyframes([(0, start_dc), (max(start_s, 0), start_dc), (max(end_s, start_s, 0), end_dc)])
+
+    @classmethod
+    def flash(cls, on_dc, off_dc, on_s, off_s, count=1):
+        keyframes = []
+        for i in range(count):
+            start = i * (on_s + off_s)
+            keyframes += [(start, on_dc), (start + on_s, on_dc), (start + on_s, off_dc), (start + on_s + off_s, off_dc)]
+        return cls.from_keyframes(keyframes)
+
+    def value_at(self, elapsed):
+        index = int(max(elapsed, 0) * LUT_RATE)
+        if self.loop:
+            index %= len(self.values)
+        else:
+            index = min(index, len(self.values) - 1)
+        return float(self.values[index])
+
+    def finished(self, elapsed):
+        return (not self.loop) and (elapsed >= self.duration)
+
+
+class LedChannel:
+    def __init__(self, write_function, duty_step=1):
+        self._write_function = write_function
+        self._duty_step = duty_step
+        self.curve = LedCurve.constant(0)
+        self.start_time = 0
+        self.last_written = None
+        self.writes = 0
+
+    def play(self, curve, start_time):
+        self.curve = curve
+        self.start_time = start_time
+
+    def is_static(self, now):
+        return self.curve.finished(now - self.start_time) and (self.last_written is not None)
+
+    def update(self, now):
+        # Only touch the PWM (a sysfs write) when the quantized duty cycle changes
+        duty_cycle = round(self.curve.value_at(now - self.start_time) / self._duty_step) * self._duty_step
+        duty_cycle = min(max(duty_cycle, 0), 100)
+        if duty_cycle != self.last_written:
+            self._write_function(duty_cycle)
+            self.last_written = duty_cycle
+            self.writes += 1
+
+
+class LedAnimator:
+    """
+    Plays LedCurves on named PWM channels from its own thread, so the LEDs
+    stay smooth no matter how long a main loop tick takes. Sleeps until the
+    next play() once every channel has settled. Curve times are on clock, so
+    they stay in step with the countdown even when it's simulated.
+    """
+    def __init__(self, channels, frame_time=0.02, clock=time.perf_counter):
+        self._channels = channels
+        self._frame_time = frame_time
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def play(self, name, curve, start_time=None):
+        if start_time is None:
+            start_time = self._clock()
+        with self._lock:
+            channel = self._channels[name]
+            if (channel.curve is curve) and (curve.loop or curve.duration == 0):
+                # Already playing, restarting a loop would make it jump
+                return
+            channel.play(curve, start_time)
+        self._wake.set()
+
+    def stop(self):
+        self._stop = True
+        self._wake.set()
+        self._thread.join()
+
+    def _worker(self):
+        while not self._stop:
+            now = self._clock()
+            with self._lock:
+                for channel in self._channels.values():
+                    channel.update(now)
+                all_static = all(channel.is_static(now) for channel in self._channels.values())
+            if all_static:
+                self._wake.wait()
+                self._wake.clear()
+            else:
+                time.sleep(self._frame_time)
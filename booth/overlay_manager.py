@@ -3,6 +3,8 @@ import numpy as np
 import time
 import cv2
 
+from common.compositing import PremultipliedAsset, alpha_to_fixed
+
 class Layer:
     def __init__(self, raw_image, size=None, offset=(0,0), weight=1):
         if size is not None:
@@ -11,21 +13,39 @@ class Layer:
             image = raw_image
         self.raw_image = image
         self._active = False
-        alpha_1chan = np.array(image[:,:,3], dtype=np.float32) / 255
-        alpha = np.stack([alpha_1chan]*3, axis=-1)
-        self.alpha_inv = np.ones(alpha.shape, dtype=np.float32) - alpha
-        self.rgb = image[:,:,:3] * alpha
-        self.alpha = np.ndarray.astype(image[:,:,3] * weight, np.float32)
+        # The color blend uses the raw alpha, the weight only scales what gets added to the overlay alpha
+        self.alpha = alpha_to_fixed(image[:,:,3], weight)
+        self.asset = PremultipliedAsset.for_overlay(image, self.alpha)
         self.offset = offset
+        self.bbox = self.get_bbox()
+        
+    def get_bbox(self):
+        # (start_x, start_y, end_x, end_y) of the pixels this layer actually changes, in overlay coordinates
+        start_x, start_y = self.offset
+        x, y, w, h = cv2.boundingRect(self.asset.alpha)
+        if (w == 0) or (h == 0):
+            return None
+        return (start_x + y, start_y + x, start_x + y + h, start_y + x + w)
         
-    def composite(self, image):
+    def composite(self, image, rect=None):
+        # Only blends the part of the layer inside rect, if given
+        if self.bbox is None:
+            return
         start_x, start_y = self.offset
-        end_x = self.rgb.shape[0] + start_x
-        end_y = self.rgb.shape[1] + start_y
-        image_alpha = image[start_x:end_x, start_y:end_y, 3]
-        image[start_x:end_x, start_y:end_y, :3] = (image[start_x:end_x, start_y:end_y, :3] * self.alpha_inv) + self.rgb
-        # Just add the alphas
-        image[start_x:end_x, start_y:end_y, 3] = np.clip(np.ndarray.astype(image_alpha, np.float32) + self.alpha, a_min=0, a_max=255) 
+        x0, y0, x1, y1 = self.bbox
+        if rect is not None:
+            x0, y0 = max(x0, rect[0]), max(y0, rect[1])
+            x1, y1 = min(x1, rect[2]), min(y1, rect[3])
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, image.shape[0]), min(y1, image.shape[1])
+        if (x1 <= x0) or (y1 <= y0):
+            return
+        # Blends the color and just adds the alphas
+        self.asset.blend_into(
+                image[x0:x1, y0:y1],
+                rows=slice(x0 - start_x, x1 - start_x),
+                cols=slice(y0 - start_y, y1 - start_y)
+            )
         
     def is_active(self):
         return self._active
@@ -37,66 +57,161 @@ class Layer:
         self._active = False
         
 
+# Past this many dirty rectangles it's cheaper to just redraw everything
+MAX_DIRTY_RECTS = 16
+
 class OverlayManager:
-    def __init__(self, display_width, display_height):
+    """
+    Keeps the composited overlay in a persistent buffer. Toggling a layer only
+    marks that layer's bounding box dirty, and update_overlay redraws just the
+    dirty rectangles from the main image instead of the whole frame.
+
+    Finished frames are also kept in an LRU cache keyed by the main image and
+    the set of active layers, so going back to a layer combination that was
+    already drawn (the arrow blinking, the countdown) is just a lookup.
+    """
+    def __init__(self, display_width, display_height, cache_budget_mb=64):
         self.layers = OrderedDict()
         self.main_image = None
         self.main_image_exclusive = False
         self.layers_changed = True
         self.display_width = display_width
         self.display_height = display_height
+        self._buffer = np.zeros((display_height, display_width, 4), dtype=np.uint8)
+        self._full_redraw = True
+        self._dirty_rects = []
+        # Main images can be reused buffers that get drawn into, so every
+        # set_main_image gets a new version instead of keying on the array itself
+        self._main_image_version = 0
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_budget_bytes = int(cache_budget_mb * 1024 * 1024)
         
     def set_layer(self, image, name, size=None, offset=(0,0), weight=1):
+        if name in self.layers:
+            self.mark_layer_dirty(self.layers[name])
+            self.evict_cached(lambda key: name in key[1])
         self.layers[name] = Layer(image, size, offset, weight)
         
+    def mark_layer_dirty(self, layer):
+        if layer.is_active() and (layer.bbox is not None):
+            self._dirty_rects.append(layer.bbox)
+            if len(self._dirty_rects) > MAX_DIRTY_RECTS:
+                self._full_redraw = True
+                self._dirty_rects = []
+                
+    def active_layer_names(self):
+        return frozenset(name for name, layer in self.layers.items() if layer.is_active())
+        
+    def main_image_key(self):
+        # None is the same blank image every time, so those frames can be reused across states
+        if self.main_image is None:
+            return None
+        return self._main_image_version
+        
+    def cache_key(self):
+        return (self.main_image_key(), self.active_layer_names())
+        
+    def add_cached(self, key, frame):
+        if frame.nbytes > self._cache_budget_bytes:
+            return
+        if key in self._cache:
+            self._cache_bytes -= self._cache.pop(key).nbytes
+        self._cache[key] = frame
+        self._cache_bytes += frame.nbytes
+        while self._cache_bytes > self._cache_budget_bytes:
+            _, old_frame = self._cache.popitem(last=False)
+            self._cache_bytes -= old_frame.nbytes
+            
+    def get_cached(self, key):
+        frame = self._cache.get(key)
+        if frame is not None:
+            self._cache.move_to_end(key)
+        return frame
+        
+    def evict_cached(self, condition):
+        for key in [key for key in self._cache if condition(key)]:
+            self._cache_bytes -= self._cache.pop(key).nbytes
+            
+    def precompute(self, layer_names):
+        # Composites layer_names over a blank main image into the cache, without touching
+        # the displayed buffer. Returns False if that frame was already cached
+        key = (None, frozenset(layer_names))
+        if (not key[1]) or (key in self._cache):
+            return False
+        frame = np.zeros((self.display_height, self.display_width, 4), dtype=np.uint8)
+        for name, layer in self.layers.items():
+            if name in key[1]:
+                layer.composite(frame)
+        self.add_cached(key, frame)
+        return True
+        
     def activate_layer(self, name):
         if not self.layers[name].is_active():
             self.layers_changed = True
             self.layers[name].activate()
+            self.mark_layer_dirty(self.layers[name])
         
     def deactivate_layer(self, name):
         if self.layers[name].is_active():
             self.layers_changed = True
+            self.mark_layer_dirty(self.layers[name])
             self.layers[name].deactivate()
         
     def set_main_image(self, image, exclusive):
         self.layers_changed = True
+        self._full_redraw = True
         self.main_image = image
         self.main_image_exclusive = exclusive
+        self._main_image_version += 1
+        # Frames drawn over older main images can never be shown again
+        self.evict_cached(lambda key: key[0] is not None)
+        
+    def redraw_rect(self, rect):
+        x0, y0, x1, y1 = rect
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.display_height), min(y1, self.display_width)
+        if (x1 <= x0) or (y1 <= y0):
+            return
+        if self.main_image is None:
+            self._buffer[x0:x1, y0:y1] = 0
+        else:
+            self._buffer[x0:x1, y0:y1] = self.main_image[x0:x1, y0:y1]
+        for layer in self.layers.values():
+            if layer.is_active():
+                layer.composite(self._buffer, (x0, y0, x1, y1))
+        
+    def update_buffer(self):
+        # Brings the buffer up to date. Dirty rects pile up while frames come from
+        # the cache, then all get redrawn the next time the buffer is used
+        if self._full_redraw:
+            self.redraw_rect((0, 0, self.display_height, self.display_width))
+        else:
+            for rect in self._dirty_rects:
+                self.redraw_rect(rect)
+        self._full_redraw = False
+        self._dirty_rects = []
         
     def update_overlay(self):
         if self.layers_changed:
-            start_time = time.time()
+            start_time = time.perf_counter()
             self.layers_changed = False
             if self.main_image_exclusive:
                 overlay = self.main_image
+                # The buffer doesn't match the layers anymore
+                self._full_redraw = True
+            elif (self.main_image is None) and not any(layer.is_active() for layer in self.layers.values()):
+                overlay = None
             else:
-                if self.main_image is None:
-                    is_empty = True
-                    overlay = np.zeros(
-                            (
-                                self.display_height,
-                                self.display_width,
-                                4
-                            ), 
-                            dtype=np.uint8
-                        )
-                else:
-                    is_empty = False
-                    overlay = self.main_image.copy()
-                
-                for layer in self.layers.values():
-                    if layer.is_active():
-                        is_empty = False
-                        layer.composite(overlay)
-                        
-                if is_empty:
-                    overlay = None
-            time_ms = int((time.time() - start_time)*1000)
-            print("Overlay update time", time_ms, "ms")
+                key = self.cache_key()
+                overlay = self.get_cached(key)
+                if overlay is None:
+                    self.update_buffer()
+                    overlay = self._buffer
+                    # The buffer keeps changing, so the cache gets its own copy
+                    self.add_cached(key, self._buffer.copy())
+            time_ms = (time.perf_counter() - start_time) * 1000
+            print("Overlay update time", f"{time_ms:.2f}", "ms")
             return True, overlay
         else:
             return False, None
-            
-        
-    
@@ -0,0 +1,446 @@
+import glob
+import math
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+from common.image_loader import load_image_resized
+from common.timers import Scheduler
+
+# Fakes for everything in hardware.py, so the booth states can run headless on
+# a simulated clock. Events run in order as fast as they can, or speed times
+# faster than real time, and there's no Qt, camera, GPIO or PWM involved.
+
+
+class SimClock:
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+class SimEventLoop:
+    """
+    Stands in for the Qt event loop. Calls run in deadline order on the
+    simulated clock, which jumps straight to the next deadline when speed is
+    None. call_soon can be used from other threads, like a queued Qt signal.
+    """
+    def __init__(self, clock, speed=None):
+        self.clock = clock
+        self._speed = speed
+        self.scheduler = Scheduler(clock=clock)
+        self._posted = []
+        self._posted_lock = threading.Lock()
+        self._posted_event = threading.Event()
+        self._stopped = False
+
+    def call_at(self, when, callback, *args):
+        return self.scheduler.call_at(when, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        return self.scheduler.call_later(delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        # Thread safe, runs on the loop at the current simulated time
+        with self._posted_lock:
+            self._posted.append((callback, args))
+        self._posted_event.set()
+
+    def cancel(self, call):
+        self.scheduler.cancel(call)
+
+    def stop(self):
+        self._stopped = True
+        self._posted_event.set()
+
+    def _drain_posted(self):
+        with self._posted_lock:
+            posted, self._posted = self._posted, []
+            self._posted_event.clear()
+        for (callback, args) in posted:
+            self.scheduler.call_at(self.clock.now, callback, *args)
+
+    def _wait_real_time(self, until, sim_start, real_start):
+        # Paced runs sleep until the simulated time comes around, but wake up early
+        # for posted calls. Returns False if it woke early
+        target = real_start + (until - sim_start) / self._speed
+        self._posted_event.wait(max(0, target - time.perf_counter()))
+        now = sim_start + (time.perf_counter() - real_start) * self._speed
+        self.clock.now = min(until, max(self.clock.now, now))
+        return self.clock.now >= until
+
+    def run_until(self, end_time):
+        self._stopped = False
+        sim_start = self.clock.now
+        real_start = time.perf_counter()
+        while not self._stopped:
+            self._drain_posted()
+            deadline = self.scheduler.next_deadline()
+            if (deadline is None) or (deadline > end_time):
+                # Nothing more to run before the end
+                if self._speed and math.isfinite(end_time):
+                    if not self._wait_real_time(end_time, sim_start, real_start):
+                        continue
+                if math.isfinite(end_time):
+                    self.clock.now = max(self.clock.now, end_time)
+                break
+            if deadline > self.clock.now:
+                if self._speed and not self._wait_real_time(deadline, sim_start, real_start):
+                    continue
+                self.clock.now = deadline
+            self.scheduler.run_due(self.clock.now)
+
+    def run_for(self, seconds):
+        self.run_until(self.clock.now + seconds)
+
+
+class SimSignal:
+    # Like a queued pyqtSignal, the slots run on the loop
+    def __init__(self, loop):
+        self._loop = loop
+        self._slots = []
+
+    def connect(self, slot):
+        self._slots.append(slot)
+
+    def emit(self, *args):
+        for slot in self._slots:
+            self._loop.call_soon(slot, *args)
+
+
+class SimTimer:
+    # Single shot QTimer
+    def __init__(self, loop, callback):
+        self._loop = loop
+        self._callback = callback
+        self._call = None
+
+    def start(self, msec=0):
+        self._loop.cancel(self._call)
+        self._call = self._loop.call_later(msec / 1000, self._callback)
+
+    def stop(self):
+        self._loop.cancel(self._call)
+        self._call = None
+
+
+class SimLoopEvents:
+    def __init__(self, loop):
+        self.wake = SimSignal(loop)
+        self.frame_ready = SimSignal(loop)
+
+
+class SimControls:
+    # The libcamera enums the booth uses, names are fine for the fake camera
+    class AwbModeEnum:
+        Indoor = "Indoor"
+        Auto = "Auto"
+
+    class AeExposureModeEnum:
+        Normal = "Normal"
+        Short = "Short"
+
+
+class SimJob:
+    def __init__(self, result):
+        self.result = result
+
+
+class SimRequest:
+    # A completed request holding one of the camera's buffers until it's released
+    def __init__(self, camera, arrays, metadata):
+        self._camera = camera
+        self._arrays = arrays
+        self._metadata = metadata
+        self.released = False
+
+    def make_array(self, name):
+        return self._arrays[name].copy()
+
+    def get_metadata(self):
+        return dict(self._metadata)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._camera.held_requests -= 1
+
+
+class SimMappedArray:
+    # picamera2.MappedArray, a view of the request's buffer with no copy
+    def __init__(self, request, stream):
+        self.array = request._arrays[stream]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.array = None
+
+
+class SimCamera:
+    """
+    Acts like the parts of Picamera2 the booth uses. Frames start every
+    1 / frame_rate seconds on the simulated clock, and a capture is ready once
+    the next whole frame has been read out. Frames are recorded JPEGs cycled
+    in order, or a synthetic frame with the capture number drawn on it. With
+    motion_blur, each frame gets a random horizontal blur up to that many
+    pixels, for trying out burst scoring. Like the real camera, controls only
+    reach the frames that start control_delay frames after they're set.
+    """
+    def __init__(self, loop, frame_paths=None, frame_rate=10, sensor_size=(4056, 3040), motion_blur=0, control_delay=2):
+        self._loop = loop
+        self._frame_paths = frame_paths or []
+        self._frame_rate = frame_rate
+        self._sensor_size = sensor_size
+        self._motion_blur = motion_blur
+        self._control_delay = control_delay
+        self._pending_controls = deque()
+        self.applied_controls = {"ScalerCrop": (0, 0) + tuple(sensor_size)}
+        self._configuration = None
+        self._synthetic_frame = None
+        self.options = {}
+        self.controls = {}
+        self.controls_history = []
+        self.started = False
+        self.num_captures = 0
+        self.held_requests = 0
+
+    def create_still_configuration(self, main={}, lores=None, display=None, buffer_count=1):
+        configuration = {
+            "main": {"size": self._sensor_size, "format": "RGB888"},
+            "buffer_count": buffer_count,
+            "display": display,
+        }
+        configuration["main"].update(main)
+        if lores is not None:
+            configuration["lores"] = {"size": self._sensor_size, "format": "YUV420"}
+            configuration["lores"].update(lores)
+        return configuration
+
+    def configure(self, configuration):
+        self._configuration = configuration
+
+    def camera_configuration(self):
+        return self._configuration
+
+    def set_controls(self, controls):
+        self.controls.update(controls)
+        self.controls_history.append((self._loop.clock.now, dict(controls)))
+        self._pending_controls.append((self._loop.clock.now + self._control_delay * self.frame_time(), dict(controls)))
+
+    def controls_at(self, sensor_time):
+        # Frames are captured in order, so controls that have reached the sensor can be applied for good
+        while self._pending_controls and (self._pending_controls[0][0] <= sensor_time):
+            self.applied_controls.update(self._pending_controls.popleft()[1])
+        return self.applied_controls
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def frame_time(self):
+        return 1 / self._frame_rate
+
+    def source_frame(self, index):
+        # Full size RGB
+        size = tuple(self._configuration["main"]["size"])
+        if self._frame_paths:
+            image = load_image_resized(self._frame_paths[index % len(self._frame_paths)], size)
+            return self.blur(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), index)
+        if self._synthetic_frame is None:
+            rng = np.random.default_rng(0)
+            small = rng.integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+            self._synthetic_frame = cv2.resize(small, size, interpolation=cv2.INTER_LINEAR)
+        frame = self._synthetic_frame.copy()
+        cv2.putText(frame, f"SIM {index}", (size[0] // 8, size[1] // 2), cv2.FONT_HERSHEY_DUPLEX, 20, (255, 255, 255), 40)
+        return self.blur(frame, index)
+
+    def blur(self, frame, index):
+        if not self._motion_blur:
+            return frame
+        length = int(np.random.default_rng(index).integers(1, self._motion_blur + 1))
+        if length == 1:
+            return frame
+        return cv2.blur(frame, (length, 1))
+
+    def stream_array(self, name, rgb):
+        stream = self._configuration[name]
+        size = tuple(stream["size"])
+        if size != (rgb.shape[1], rgb.shape[0]):
+            rgb = cv2.resize(rgb, size, interpolation=cv2.INTER_AREA)
+        if stream["format"] == "YUV420":
+            return cv2.cvtColor(rgb, cv2.COLOR_RGB2YUV_I420)
+        return rgb
+
+    def metadata(self, sensor_time):
+        controls = self.controls_at(sensor_time)
+        return {
+            "SensorTimestamp": int(sensor_time * 1e9),
+            "AnalogueGain": float(controls.get("AnalogueGain", 4)),
+            "ExposureTime": int(controls.get("ExposureTime", 30000)),
+            "AeEnable": controls.get("AeEnable", True),
+            "AeLocked": True,
+            "Saturation": controls.get("Saturation", 1),
+            "ScalerCrop": tuple(controls["ScalerCrop"]),
+            "ColourGains": (1.8, 1.6),
+            "ColourTemperature": 4000,
+            "Lux": 200.0,
+        }
+
+    def capture_arrays(self, names, signal_function=None):
+        # The next frame to start gets captured, it's ready a frame time later
+        now = self._loop.clock.now
+        frame_time = self.frame_time()
+        # Rounded so a request made right as a frame starts gets that frame, not the one after
+        sensor_time = math.ceil(round(now / frame_time, 6)) * frame_time
+        rgb = self.source_frame(self.num_captures)
+        self.num_captures += 1
+        job = SimJob(([self.stream_array(name, rgb) for name in names], self.metadata(sensor_time)))
+        if signal_function is not None:
+            self._loop.call_at(sensor_time + frame_time, signal_function, job)
+        return job
+
+    def capture_request(self, signal_function=None):
+        # Like capture_arrays, but the frame stays in its buffer until the request is released.
+        # The camera needs one buffer to keep running, so holding more than that stalls it
+        if self.held_requests >= self._configuration["buffer_count"] - 1:
+            raise RuntimeError(f"sim_hardware.py: {self.held_requests} requests held with {self._configuration['buffer_count']} buffers")
+        self.held_requests += 1
+        job = self.capture_arrays(["main", "lores"], signal_function)
+        arrays, metadata = job.result
+        job.result = SimRequest(self, dict(zip(["main", "lores"], arrays)), metadata)
+        return job
+
+    def wait(self, job):
+        return job.result
+
+
+class SimPreview:
+    # The QGlPicamera2 widget, keeps the overlays instead of drawing them
+    def __init__(self, loop, width, height):
+        self.width = width
+        self.height = height
+        self.done_signal = SimSignal(loop)
+        self.overlay = None
+        self.num_overlays = 0
+        self.mousePressEvent = None
+
+    def signal_done(self, job):
+        self.done_signal.emit(job)
+
+    def set_overlay(self, overlay):
+        self.overlay = overlay
+        self.num_overlays += 1
+
+    def showFullScreen(self):
+        return
+
+
+class SimButton:
+    # A gpiozero Button that scripts can press
+    def __init__(self, loop, pin):
+        self._loop = loop
+        self.pin = pin
+        self.is_pressed = False
+        self.when_pressed = None
+        self.when_released = None
+
+    def press(self):
+        self.is_pressed = True
+        if self.when_pressed is not None:
+            self.when_pressed()
+
+    def release(self):
+        self.is_pressed = False
+        if self.when_released is not None:
+            self.when_released()
+
+    def hold(self, when, duration=0.2):
+        # Press at simulated time when, and let go duration later
+        self._loop.call_at(when, self.press)
+        self._loop.call_at(when + duration, self.release)
+
+
+class SimPWM:
+    def __init__(self, pwm_channel, hz, chip):
+        self.pwm_channel = pwm_channel
+        self.hz = hz
+        self.chip = chip
+        self.duty_cycle = None
+        self.num_writes = 0
+
+    def start(self, duty_cycle):
+        self.change_duty_cycle(duty_cycle)
+
+    def change_duty_cycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.num_writes += 1
+
+    def stop(self):
+        self.duty_cycle = None
+
+
+class SimHardware:
+    controls = SimControls
+    MappedArray = SimMappedArray
+
+    def __init__(self, frames_dir=None, speed=None, frame_rate=10, start_datetime=None, motion_blur=0):
+        self.clock = SimClock()
+        self.loop = SimEventLoop(self.clock, speed=speed)
+        frame_paths = sorted(glob.glob(os.path.join(frames_dir, "*.jpg"))) if frames_dir else []
+        self._frame_paths = frame_paths
+        self._frame_rate = frame_rate
+        self._motion_blur = motion_blur
+        self._start_datetime = start_datetime or datetime.now()
+        self.camera = None
+        self.preview = None
+        self.buttons = {}
+        self.pwms = []
+        self.shutdown_requested = False
+
+    def datetime_now(self):
+        return self._start_datetime + timedelta(seconds=self.clock.now)
+
+    def sensor_time(self, sensor_timestamp):
+        # The fake camera stamps frames with the simulated clock
+        return sensor_timestamp / 1e9
+
+    def create_camera(self):
+        self.camera = SimCamera(self.loop, self._frame_paths, self._frame_rate, motion_blur=self._motion_blur)
+        return self.camera
+
+    def create_preview(self, picam2, width, height, hflip=True):
+        self.preview = SimPreview(self.loop, width, height)
+        return self.preview
+
+    def create_timer(self, callback):
+        return SimTimer(self.loop, callback)
+
+    def create_loop_events(self):
+        return SimLoopEvents(self.loop)
+
+    def create_button(self, pin):
+        self.buttons[pin] = SimButton(self.loop, pin)
+        return self.buttons[pin]
+
+    def create_pwm(self, pwm_channel, hz, chip):
+        pwm = SimPWM(pwm_channel, hz, chip)
+        self.pwms.append(pwm)
+        return pwm
+
+    def shutdown(self):
+        print("sim_hardware.py: Shutdown requested")
+        self.shutdown_requested = True
+        self.loop.stop()
+
+    def run(self):
+        self.loop.run_until(math.inf)
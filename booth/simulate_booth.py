@@ -0,0 +1,130 @@
+import cv2
+import numpy as np
+import os
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from common.common import load_config
+from common.image_path_db import open_image_path_db
+from booth import PhotoBooth
+from sim_hardware import SimHardware
+
+# Runs the booth headless on sim_hardware.py, from the booth directory like the real one:
+#   PYTHONPATH=<repo> python3 booth/simulate_booth.py -n 20
+
+def get_args():
+    parser = ArgumentParser(prog='Booth Simulator',
+                    description='Runs the booth states headless with a fake camera, button and LEDs, and reports capture latency')
+
+    parser.add_argument("-n", "--captures", type=int, default=10,
+                        help="Number of button presses")
+    parser.add_argument("-i", "--interval", type=float, default=15,
+                        help="Simulated seconds between button presses")
+    parser.add_argument("-s", "--speed", type=float, default=None,
+                        help="Run this many times faster than real time, as fast as possible if not given")
+    parser.add_argument("-f", "--frames-dir", type=str, default=None,
+                        help="Directory of recorded JPEGs for the camera, synthetic frames if not given")
+    parser.add_argument("--burst-frames", type=int, default=None,
+                        help="Override burst_frames from the config")
+    parser.add_argument("--zsl-frames", type=int, default=None,
+                        help="Override zsl_frames from the config")
+    parser.add_argument("--motion-blur", type=int, default=0,
+                        help="Blur each camera frame by a random amount up to this many pixels, to try out burst_frames")
+    parser.add_argument("-w", "--work-dir", type=str, default=None,
+                        help="Where photos and dbs get written, a temp dir if not given")
+    parser.add_argument("--config", type=str, default="config",
+                        help="Config name, same as the booth loads")
+    parser.add_argument("--multi-shot", action="store_true",
+                        help="Press again during each countdown to take three shots")
+    parser.add_argument("--drop-when-busy", action="store_true",
+                        help="Press even if the save queue is full, instead of waiting for it like a patient guest")
+
+    return parser.parse_args()
+
+
+def synthetic_overlay(path, size, name):
+    overlay = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+    cv2.rectangle(overlay, (0, 0), (size[0] - 1, size[1] - 1), (255, 255, 255, 255), 4)
+    cv2.putText(overlay, name, (10, size[1] // 2), cv2.FONT_HERSHEY_DUPLEX, 1, (255, 255, 255, 255), 2)
+    cv2.imwrite(path, overlay)
+
+
+def sim_config(config, work_dir):
+    # Everything the booth writes goes under work_dir, and anything missing from this machine is faked or left out
+    config = dict(config)
+    os.makedirs(work_dir, exist_ok=True)
+    for key in ["gray_image_dir", "color_image_dir", "original_image_dir", "qr_dir", "display_cache_dir", "deferred_spool_dir"]:
+        if config.get(key):
+            config[key] = os.path.join(work_dir, os.path.basename(config[key]))
+    for key in ["photo_path_db", "qr_path_db", "uploaded_path_db", "photo_db_json_export"]:
+        if config.get(key):
+            config[key] = os.path.join(work_dir, os.path.basename(config[key]))
+    if not os.path.exists(config["qr_path_db"]):
+        # The uploader writes this on the booth, nothing uploads here so it stays empty
+        open_image_path_db(config["qr_path_db"]).update_file()
+    config["latency_trace_path"] = os.path.join(work_dir, "latency.json")
+    config["wifi_check"] = False
+    if config.get("lens_cal_file") and not os.path.isfile(config["lens_cal_file"]):
+        config["lens_cal_file"] = None
+    overlay_dir = os.path.join(work_dir, "overlays")
+    os.makedirs(overlay_dir, exist_ok=True)
+    overlays = {}
+    for name, overlay_config in config["overlays"].items():
+        overlay_config = dict(overlay_config)
+        if not os.path.isfile(overlay_config["path"]):
+            overlay_config["path"] = os.path.join(overlay_dir, name + ".png")
+            synthetic_overlay(overlay_config["path"], overlay_config["size"], name)
+        overlays[name] = overlay_config
+    config["overlays"] = overlays
+    return config
+
+
+def press_button(photo_booth, button, hold_time, wait_for_saves):
+    if wait_for_saves:
+        # Real time passes here but simulated time doesn't, so saves look free to the booth
+        while not photo_booth.can_start_capture():
+            time.sleep(0.01)
+    button.press()
+    photo_booth.hardware.loop.call_later(hold_time, button.release)
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="booth_sim_")
+    config = sim_config(load_config(args.config), work_dir)
+    if args.burst_frames:
+        config["burst_frames"] = args.burst_frames
+    if args.zsl_frames is not None:
+        config["zsl_frames"] = args.zsl_frames
+    hardware = SimHardware(frames_dir=args.frames_dir, speed=args.speed, motion_blur=args.motion_blur)
+    photo_booth = PhotoBooth(config, hardware)
+    button = hardware.buttons[list(hardware.buttons)[0]]
+
+    # Let the overlay cache fill before the first press, like a booth that's been on a while
+    first_press = 2
+    for i in range(args.captures):
+        press_time = first_press + i * args.interval
+        hardware.loop.call_at(press_time, press_button, photo_booth, button, 0.2, not args.drop_when_busy)
+        if args.multi_shot:
+            hardware.loop.call_at(press_time + 1, press_button, photo_booth, button, 0.2, False)
+
+    start_time = time.perf_counter()
+    hardware.loop.run_until(first_press + args.captures * args.interval)
+    # Let the last countdown and its save finish
+    while (photo_booth.state != photo_booth.state_display_capture) or (photo_booth.extra_shots > 0):
+        hardware.loop.run_for(1)
+    photo_booth.capture_saver.wait_until_done()
+    real_time = time.perf_counter() - start_time
+    photo_booth.stop()
+
+    sim_time = hardware.clock.now
+    print()
+    print(f"Simulated {sim_time:.0f} s in {real_time:.1f} s ({sim_time / real_time:.1f}x real time)")
+    print(f"{hardware.camera.num_captures} frames captured, {len(list(photo_booth.photo_path_db.image_names()))} in the photo db, written to {work_dir}")
+    print(f"{hardware.preview.num_overlays} overlays shown, {sum(pwm.num_writes for pwm in hardware.pwms)} PWM writes")
+    print()
+    print(f"{'Stage':<24}{'count':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, stats in photo_booth.tracer.stage_stats().items():
+        print(f"{stage:<24}{stats['count']:>6}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}{stats['max']:>10.1f}")
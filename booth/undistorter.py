@@ -0,0 +1,119 @@
+import hashlib
+import os
+import time
+import cv2
+import numpy as np
+
+class Undistorter:
+    """
+    Undistorts captures with precomputed remap tables instead of calling
+    cv2.undistort every shot. The maps are cropped to the calibration roi, so
+    remap() writes the final cropped image directly. Maps are cached next to
+    the lens cal file, keyed by the calibration and the capture resolution.
+    """
+    def __init__(self, lens_cal, lens_cal_file=None, image_size=None):
+        self.newcameramtx, self.roi, self.mtx, self.dist = lens_cal
+        self._lens_cal_file = lens_cal_file
+        self._image_size = None
+        self._map1 = None
+        self._map2 = None
+        self._chroma_maps = None
+        if image_size is not None:
+            self.load_maps(image_size)
+
+    def cache_key(self, image_size):
+        key_hash = hashlib.sha1()
+        for array in [self.newcameramtx, self.mtx, self.dist]:
+            key_hash.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        key_hash.update(np.array(self.roi, dtype=np.int64).tobytes())
+        key_hash.update(np.array(image_size, dtype=np.int64).tobytes())
+        return key_hash.hexdigest()[:16]
+
+    def cache_path(self, image_size):
+        if not self._lens_cal_file:
+            return None
+        base_path = os.path.splitext(self._lens_cal_file)[0]
+        return f"{base_path}_remap_{image_size[0]}x{image_size[1]}_{self.cache_key(image_size)}.npz"
+
+    def build_maps(self, image_size):
+        map1, map2 = cv2.initUndistortRectifyMap(
+                self.mtx,
+                self.dist,
+                None,
+                self.newcameramtx,
+                image_size,
+                cv2.CV_16SC2
+            )
+        x, y, w, h = self.roi
+        # Copy so the full size maps can be freed
+        return map1[y:y+h, x:x+w].copy(), map2[y:y+h, x:x+w].copy()
+
+    def load_maps(self, image_size):
+        image_size = tuple(int(dim) for dim in image_size)
+        start_time = time.perf_counter()
+        cache_path = self.cache_path(image_size)
+        maps = None
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with np.load(cache_path) as cache:
+                    maps = (cache["map1"], cache["map2"])
+                source = "cache"
+            except Exception as e:
+                print("undistorter.py: Failed to load remap cache", cache_path, e)
+        if maps is None:
+            maps = self.build_maps(image_size)
+            source = "calibration"
+            if cache_path:
+                self.save_maps(cache_path, maps)
+        self._map1, self._map2 = maps
+        self._chroma_maps = None
+        self._image_size = image_size
+        time_ms = int((time.perf_counter() - start_time) * 1000)
+        print("undistorter.py: Loaded remap tables for", image_size, "from", source, "in", time_ms, "ms")
+
+    def save_maps(self, cache_path, maps):
+        # Write to a temp file then rename so a crash can't leave a half-written cache
+        temp_path = cache_path + ".tmp.npz"
+        try:
+            np.savez(temp_path, map1=maps[0], map2=maps[1])
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print("undistorter.py: Failed to save remap cache", cache_path, e)
+
+    def undistort(self, image):
+        image_size = (image.shape[1], image.shape[0])
+        if image_size != self._image_size:
+            self.load_maps(image_size)
+        return cv2.remap(image, self._map1, self._map2, cv2.INTER_LINEAR)
+
+    def chroma_maps(self):
+        # Half size maps for the U and V planes, derived from the full size ones.
+        # Each chroma sample sits in the middle of a 2x2 luma block, so average the block's
+        # source coordinates and convert them back to chroma coordinates
+        if self._chroma_maps is None:
+            h, w = self._map1.shape[:2]
+            map_x, map_y = cv2.convertMaps(self._map1[:h - h % 2, :w - w % 2], self._map2[:h - h % 2, :w - w % 2], cv2.CV_32FC1)
+            chroma_size = (map_x.shape[1] // 2, map_x.shape[0] // 2)
+            chroma_x = (cv2.resize(map_x, chroma_size, interpolation=cv2.INTER_AREA) - 0.5) / 2
+            chroma_y = (cv2.resize(map_y, chroma_size, interpolation=cv2.INTER_AREA) - 0.5) / 2
+            self._chroma_maps = cv2.convertMaps(chroma_x, chroma_y, cv2.CV_16SC2)
+        return self._chroma_maps
+
+    def undistort_i420(self, frame):
+        # Remaps a YUV420 CaptureFrame plane by plane, so the gray and color variants can both
+        # come from one undistorted frame. Returns a packed I420 array, trimmed to even dimensions
+        image_size = (frame.width, frame.height)
+        if image_size != self._image_size:
+            self.load_maps(image_size)
+        chroma_map1, chroma_map2 = self.chroma_maps()
+        h, w = chroma_map1.shape[0] * 2, chroma_map1.shape[1] * 2
+        y_plane, u_plane, v_plane = frame.planes()
+        out = np.empty((h * 3 // 2, w), dtype=np.uint8)
+        flat = out.reshape(-1)
+        chroma_size = (h // 2) * (w // 2)
+        cv2.remap(y_plane, self._map1[:h, :w], self._map2[:h, :w], cv2.INTER_LINEAR, dst=out[:h])
+        cv2.remap(u_plane, chroma_map1, chroma_map2, cv2.INTER_LINEAR,
+                dst=flat[h * w:h * w + chroma_size].reshape(h // 2, w // 2))
+        cv2.remap(v_plane, chroma_map1, chroma_map2, cv2.INTER_LINEAR,
+                dst=flat[h * w + chroma_size:].reshape(h // 2, w // 2))
+        return out
@@ -3,6 +3,8 @@ import os
 import socket
 import time
 
+from common.network_monitor import get_network_monitor
+
 
 def check_network_connection(host="8.8.8.8", port=53, timeout=3):
     """
@@ -10,9 +12,8 @@ def check_network_connection(host="8.8.8.8", port=53, timeout=3):
     Google's public DNS server at 8.8.8.8 over port 53 (DNS) is used as default.
     """
     try:
-        socket.setdefaulttimeout(timeout)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
+        # The timeout only applies to this socket, not the whole process
+        sock = socket.create_connection((host, port), timeout=timeout)
         sock.close()
         return True
     except socket.error as ex:
@@ -23,9 +24,15 @@ def check_network_connection(host="8.8.8.8", port=53, timeout=3):
 def wait_for_network_connection():
     """
     Wait indefinitely until the network is available.
+    Sleeps on the network monitor until a link comes up, then checks that
+    the internet is actually reachable.
     """
+    monitor = get_network_monitor()
     print("upload_to_s3.py: Waiting for network connection...")
-    while not check_network_connection():
+    while True:
+        monitor.wait_until_connected()
+        if check_network_connection():
+            break
         time.sleep(5)  # wait for 5 seconds before checking again
     print("upload_to_s3.py: Network connection established.")
 
@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+
+# Fixed point alpha compositing on uint8 images, shared by the watermarking
+# and the overlay layers. Alpha is stored as uint8 where 255 means 1.0 and the
+# asset color is stored premultiplied by it, so a blend is
+#   out = dst * (255 - alpha) / 255 + premultiplied
+# done in place with two saturating OpenCV ops. The result is within 1 of
+# the exact float blend and no float arrays get allocated.
+
+ALPHA_SCALE = 1 / 255
+
+
+def alpha_to_fixed(alpha, weight=1):
+    # uint8 alpha scaled by a float weight, rounded back to uint8
+    if weight == 1:
+        return np.ascontiguousarray(alpha, dtype=np.uint8)
+    return np.clip(np.rint(alpha.astype(np.float32) * weight), 0, 255).astype(np.uint8)
+
+
+def expand_channels(alpha, num_channels):
+    if num_channels == 0:
+        return np.ascontiguousarray(alpha)
+    return np.ascontiguousarray(np.repeat(alpha[:, :, np.newaxis], num_channels, axis=2))
+
+
+class PremultipliedAsset:
+    """
+    An image with an alpha channel, ready to blend onto a uint8 region in place.
+    color is (h, w, c) or (h, w) and alpha is (h, w) uint8. The region passed to
+    blend_into must have the same shape and be whole pixels (no channel slicing).
+    """
+    def __init__(self, color, alpha):
+        alpha = np.ascontiguousarray(alpha, dtype=np.uint8)
+        num_channels = color.shape[2] if color.ndim == 3 else 0
+        alpha_expanded = expand_channels(alpha, num_channels)
+        self.shape = color.shape
+        self.alpha = alpha
+        self.alpha_inv = 255 - alpha_expanded
+        self.premultiplied = cv2.multiply(np.ascontiguousarray(color), alpha_expanded, scale=ALPHA_SCALE)
+
+    @classmethod
+    def for_overlay(cls, rgba, added_alpha):
+        # For RGBA targets: blend the color channels, and saturating-add added_alpha to the target alpha
+        asset = cls(rgba[:, :, :3], rgba[:, :, 3])
+        asset.shape = rgba.shape
+        asset.alpha_inv = np.ascontiguousarray(np.dstack([asset.alpha_inv, np.full(asset.alpha.shape, 255, dtype=np.uint8)]))
+        asset.premultiplied = np.ascontiguousarray(np.dstack([asset.premultiplied, added_alpha]))
+        return asset
+
+    def blend_into(self, region, rows=slice(None), cols=slice(None)):
+        # rows and cols pick out part of the asset, for blending a clipped region
+        cv2.multiply(region, self.alpha_inv[rows, cols], dst=region, scale=ALPHA_SCALE)
+        cv2.add(region, self.premultiplied[rows, cols], dst=region)
@@ -0,0 +1,88 @@
+import cv2
+
+# libjpeg can scale by 1/2, 1/4 and 1/8 while decoding (in the DCT domain),
+# so a full 12MP photo that's only going to be shown at 724x543 never has to
+# be decoded at full size. The image is decoded at the smallest scale that's
+# still at least the target size, and an area resize does the rest.
+
+REDUCED_FLAGS = {
+    # scale: (color flag, gray flag)
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+}
+
+# Start of frame markers, they hold the image size. C4, C8 and CC are other segments
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_jpeg_info(path):
+    """
+    (width, height, channels) from a JPEG's headers without decoding it,
+    or None if it isn't a JPEG we can read.
+    """
+    try:
+        with open(path, "rb") as image_file:
+            if image_file.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                marker = image_file.read(2)
+                if (len(marker) < 2) or (marker[0] != 0xFF):
+                    return None
+                marker_type = marker[1]
+                while marker_type == 0xFF:
+                    # Fill bytes before the marker
+                    marker_type = image_file.read(1)[0]
+                if (marker_type == 0x01) or (0xD0 <= marker_type <= 0xD8):
+                    # Markers without a length
+                    continue
+                length = int.from_bytes(image_file.read(2), "big")
+                if marker_type in SOF_MARKERS:
+                    data = image_file.read(6)
+                    height = int.from_bytes(data[1:3], "big")
+                    width = int.from_bytes(data[3:5], "big")
+                    return width, height, data[5]
+                if marker_type == 0xDA:
+                    # Start of scan without a frame header
+                    return None
+                image_file.seek(length - 2, 1)
+    except (OSError, IndexError):
+        return None
+
+
+def reduced_scale(width, height, min_size):
+    # Biggest libjpeg scale that keeps both sides at least min_size (scaled sides round up)
+    min_width, min_height = min_size
+    for scale in sorted(REDUCED_FLAGS, reverse=True):
+        if (-(-width // scale) >= min_width) and (-(-height // scale) >= min_height):
+            return scale
+    return 1
+
+
+def load_image(path, min_size=None, flags=cv2.IMREAD_COLOR):
+    """
+    cv2.imread, but decoded at a reduced scale when the image is bigger than
+    min_size (width, height) needs. flags can be IMREAD_COLOR, IMREAD_GRAYSCALE
+    or IMREAD_UNCHANGED, where gray JPEGs stay single channel. Returns None
+    like imread if the image can't be loaded.
+    """
+    info = read_jpeg_info(path) if min_size is not None else None
+    if info is None:
+        return cv2.imread(path, flags)
+    width, height, channels = info
+    scale = reduced_scale(width, height, min_size)
+    if scale == 1:
+        return cv2.imread(path, flags)
+    gray = (flags == cv2.IMREAD_GRAYSCALE) or ((flags == cv2.IMREAD_UNCHANGED) and (channels == 1))
+    color_flag, gray_flag = REDUCED_FLAGS[scale]
+    return cv2.imread(path, gray_flag if gray else color_flag)
+
+
+def load_image_resized(path, size, flags=cv2.IMREAD_COLOR):
+    # Loads the image scaled to exactly size (width, height)
+    image = load_image(path, min_size=size, flags=flags)
+    if image is None:
+        return None
+    if (image.shape[1], image.shape[0]) != tuple(size):
+        image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA)
+    return image
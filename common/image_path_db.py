@@ -1,5 +1,7 @@
 import json
 import os
+import sqlite3
+import threading
 
 class ImagePathDB:
     def __init__(self, db_file_path, old_root=None):
@@ -17,6 +19,15 @@ class ImagePathDB:
             }
         elif isinstance(val, str):
             self.db[image_name] = os.path.relpath(val, start=self._root_folder)
+            
+    def update_image(self, image_name, path_dict):
+        # Add postfixes to an existing image without dropping the ones already there
+        new_paths = dict(self.db.get(image_name, {}))
+        new_paths.update({
+            postfix: os.path.relpath(path, start=self._root_folder)
+            for postfix, path in path_dict.items()
+        })
+        self.db[image_name] = new_paths
         
     def get_image_path(self, image_name, postfix=None, raw=False):
         if not postfix:
@@ -33,12 +44,19 @@ class ImagePathDB:
     def image_exists(self, image_name):
         return image_name in self.db.keys()
         
+    def image_has_postfix(self, image_name, postfix):
+        return postfix in self.db.get(image_name, {})
+        
     def image_names(self):
         return self.db.keys()
     
     def replace_db(self, db):
         self.db = db
         
+    def names_missing_from(self, other_db):
+        # Image names in this db but not other_db, newest first
+        return sorted(self.image_names() - other_db.image_names(), reverse=True)
+        
     def try_update_from_file(self, erase_old=False):
         try:
             with open(self._db_file_path, "r") as db_file:
@@ -52,5 +70,247 @@ class ImagePathDB:
         return True
             
     def update_file(self):
-        with open(self._db_file_path, "w") as db_file:
+        # Write then rename, so readers never see a half-written file
+        temp_path = self._db_file_path + ".tmp"
+        with open(temp_path, "w") as db_file:
             json.dump(self.db, db_file)
+        os.replace(temp_path, self._db_file_path)
+
+
+class JournaledImagePathDB(ImagePathDB):
+    """
+    Same API as ImagePathDB, stored as JSON lines with one record per image.
+    update_file appends the images that changed since the last call and
+    try_update_from_file only parses the lines added since the last read.
+    Once most of the journal is stale it's compacted to one line per image,
+    written to a temp file and renamed over the journal. Only one process
+    should write a journal.
+    """
+    def __init__(self, db_file_path, old_root=None, min_compact_records=500, compact_ratio=2):
+        self._changed = {}
+        self._needs_compact = False
+        self._read_offset = 0
+        self._file_id = None
+        self._num_records = 0
+        self._min_compact_records = min_compact_records
+        self._compact_ratio = compact_ratio
+        super().__init__(db_file_path, old_root)
+
+    def add_image(self, image_name, val):
+        super().add_image(image_name, val)
+        self._changed[image_name] = True
+
+    def update_image(self, image_name, path_dict):
+        super().update_image(image_name, path_dict)
+        self._changed[image_name] = True
+
+    def replace_db(self, db):
+        super().replace_db(db)
+        self._needs_compact = True
+
+    def apply_journal_bytes(self, data):
+        # Applies the complete lines in data and returns how many bytes they took.
+        # A line that's still being appended is left for the next read
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                self.db[record["name"]] = record["value"]
+                self._num_records += 1
+            except (ValueError, KeyError) as e:
+                print("image_path_db.py: Skipping bad journal line", line[:100], e)
+        return end
+
+    def reset_read(self):
+        self._read_offset = 0
+        self._num_records = 0
+
+    def try_update_from_file(self, erase_old=False):
+        try:
+            with open(self._db_file_path, "rb") as db_file:
+                stat = os.fstat(db_file.fileno())
+                file_id = (stat.st_dev, stat.st_ino)
+                if erase_old or (file_id != self._file_id) or (stat.st_size < self._read_offset):
+                    # New or compacted journal, read it from the start
+                    self.reset_read()
+                    if erase_old:
+                        self.db = {}
+                self._file_id = file_id
+                db_file.seek(self._read_offset)
+                data = db_file.read()
+        except OSError:
+            return False
+        self._read_offset += self.apply_journal_bytes(data)
+        return True
+
+    def journal_line(self, image_name):
+        return json.dumps({"name": image_name, "value": self.db[image_name]}) + "\n"
+
+    def should_compact(self):
+        return self._needs_compact or (
+                self._num_records > max(self._min_compact_records, self._compact_ratio * len(self.db))
+            )
+
+    def update_file(self):
+        if self.should_compact():
+            self.compact()
+            return
+        if not self._changed:
+            return
+        data = "".join(self.journal_line(image_name) for image_name in self._changed).encode()
+        # One write of whole lines, so a reader only ever sees complete records or nothing
+        with open(self._db_file_path, "ab") as db_file:
+            start = db_file.tell()
+            db_file.write(data)
+            stat = os.fstat(db_file.fileno())
+        if ((stat.st_dev, stat.st_ino) == self._file_id) and (start == self._read_offset):
+            # Nothing new from anyone else, don't read back our own records
+            self._read_offset = start + len(data)
+        self._num_records += len(self._changed)
+        self._changed = {}
+
+    def compact(self):
+        temp_path = self._db_file_path + ".tmp"
+        data = "".join(self.journal_line(image_name) for image_name in self.db).encode()
+        with open(temp_path, "wb") as db_file:
+            db_file.write(data)
+            db_file.flush()
+            os.fsync(db_file.fileno())
+            stat = os.fstat(db_file.fileno())
+        os.replace(temp_path, self._db_file_path)
+        self._file_id = (stat.st_dev, stat.st_ino)
+        self._read_offset = len(data)
+        self._num_records = len(self.db)
+        self._changed = {}
+        self._needs_compact = False
+        print("image_path_db.py: Compacted", self._db_file_path, "to", len(self.db), "records")
+
+
+class SqliteImagePathDB(ImagePathDB):
+    """
+    Same API as ImagePathDB, backed by SQLite in WAL mode so the booth and
+    the uploader can read and write their dbs at the same time. Every write
+    gets a revision number, so try_update_from_file only fetches the rows
+    changed since the last one it saw. db is still kept as an in-memory
+    mirror. json_export_path gets the plain JSON version on every
+    update_file, for readers like the kiosk that load the JSON over NFS.
+    """
+    def __init__(self, db_file_path, old_root=None, json_export_path=None):
+        self._json_export_path = json_export_path
+        self._changed = {}
+        self._replaced = False
+        self._revision = 0
+        self._attached = {}
+        self._lock = threading.Lock()
+        # Used from the save threads as well as the main thread, _lock keeps that in order
+        self._conn = sqlite3.connect(db_file_path, timeout=5, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, value TEXT NOT NULL, revision INTEGER NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS images_revision ON images (revision)")
+        self._conn.commit()
+        super().__init__(db_file_path, old_root)
+
+    def add_image(self, image_name, val):
+        super().add_image(image_name, val)
+        self._changed[image_name] = True
+
+    def update_image(self, image_name, path_dict):
+        super().update_image(image_name, path_dict)
+        self._changed[image_name] = True
+
+    def replace_db(self, db):
+        super().replace_db(db)
+        self._replaced = True
+
+    def latest_revision(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(revision), 0) FROM images").fetchone()[0]
+
+    def names_changed_since(self, revision):
+        # (names, latest revision) for the rows written after revision
+        with self._lock:
+            rows = self._conn.execute(
+                    "SELECT name, revision FROM images WHERE revision > ? ORDER BY revision",
+                    (revision,)
+                ).fetchall()
+        names = [name for name, _ in rows]
+        return names, (rows[-1][1] if rows else revision)
+
+    def try_update_from_file(self, erase_old=False):
+        revision = 0 if erase_old else self._revision
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                        "SELECT name, value, revision FROM images WHERE revision > ? ORDER BY revision",
+                        (revision,)
+                    ).fetchall()
+        except sqlite3.Error as e:
+            print("image_path_db.py: Couldn't read", self._db_file_path, e)
+            return False
+        if erase_old:
+            self.db = {}
+        for name, value, row_revision in rows:
+            self.db[name] = json.loads(value)
+            self._revision = max(self._revision, row_revision)
+        return True
+
+    def update_file(self):
+        if not (self._changed or self._replaced):
+            return
+        with self._lock:
+            with self._conn:
+                revision = self._conn.execute("SELECT COALESCE(MAX(revision), 0) + 1 FROM images").fetchone()[0]
+                if self._replaced:
+                    self._conn.execute("DELETE FROM images")
+                    names = list(self.db.keys())
+                else:
+                    names = list(self._changed.keys())
+                self._conn.executemany(
+                        "INSERT OR REPLACE INTO images (name, value, revision) VALUES (?, ?, ?)",
+                        [(name, json.dumps(self.db[name]), revision) for name in names]
+                    )
+        self._changed = {}
+        self._replaced = False
+        if self._json_export_path:
+            self.export_json(self._json_export_path)
+
+    def export_json(self, json_path):
+        # Paths are stored relative to the db's folder, so export next to it
+        temp_path = json_path + ".tmp"
+        with open(temp_path, "w") as json_file:
+            json.dump(self.db, json_file)
+        os.replace(temp_path, json_path)
+
+    def names_missing_from(self, other_db):
+        if not isinstance(other_db, SqliteImagePathDB):
+            return super().names_missing_from(other_db)
+        other_path = os.path.abspath(other_db._db_file_path)
+        with self._lock:
+            if other_path == os.path.abspath(self._db_file_path):
+                return []
+            if other_path not in self._attached:
+                alias = f"other_{len(self._attached)}"
+                self._conn.execute("ATTACH DATABASE ? AS " + alias, (other_path,))
+                self._attached[other_path] = alias
+            alias = self._attached[other_path]
+            # Both name columns are primary keys, so this is an index lookup per row
+            rows = self._conn.execute(
+                    f"SELECT name FROM images WHERE name NOT IN (SELECT name FROM {alias}.images) ORDER BY name DESC"
+                ).fetchall()
+        return [name for (name,) in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_image_path_db(db_file_path, old_root=None, json_export_path=None):
+    # .jsonl paths get the append-only journal, .sqlite paths SQLite, anything else the plain JSON file
+    if db_file_path.endswith(".jsonl"):
+        return JournaledImagePathDB(db_file_path, old_root)
+    if db_file_path.endswith(".sqlite"):
+        return SqliteImagePathDB(db_file_path, old_root, json_export_path)
+    return ImagePathDB(db_file_path, old_root)
@@ -0,0 +1,158 @@
+from collections import deque
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+PERCENTILES = [50, 95, 99]
+PROMETHEUS_METRIC = "booth_capture_stage_seconds"
+
+
+class CaptureTrace:
+    """
+    Timings for one capture. mark() is for points along the capture, like the
+    button edge or the capture request, and each mark's stage is the time since
+    the mark before it. span() and add() are for work with its own duration,
+    like undistorting or encoding, and can be called from any thread.
+    """
+    def __init__(self, tracer, name=None):
+        self.name = name
+        self.stages = {}
+        self._tracer = tracer
+        self._last_mark = None
+
+    def mark(self, stage, timestamp=None):
+        # timestamp is a tracer clock value, for events seen on another thread
+        timestamp = self._tracer.clock() if timestamp is None else timestamp
+        if self._last_mark is not None:
+            self.add(stage, timestamp - self._last_mark)
+        self._last_mark = timestamp
+
+    def add(self, stage, seconds):
+        self._tracer.record(self, stage, seconds)
+
+    @contextmanager
+    def span(self, stage):
+        # Always real time, even when marks come from a simulated clock
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def summary(self):
+        return ", ".join(f"{stage} {ms:.0f}" for stage, ms in self.stages.items()) + " ms"
+
+
+class LatencyTracer:
+    """
+    Keeps the last ring_size samples of every capture stage and the last few
+    traces, and works out p50/p95/p99 per stage from them. With a dump_path a
+    thread writes them out every dump_interval seconds: JSON, or a Prometheus
+    textfile (for node_exporter's textfile collector) if the path ends in .prom.
+    """
+    def __init__(self, ring_size=500, dump_path=None, dump_interval=60, recent_traces=20, clock=time.perf_counter):
+        self.clock = clock
+        self._ring_size = ring_size
+        self._dump_path = dump_path
+        self._dump_interval = dump_interval
+        self._samples = {}
+        # Totals since startup, Prometheus summaries count everything
+        self._counts = {}
+        self._sums = {}
+        self._traces = deque(maxlen=recent_traces)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if dump_path:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def start_trace(self, name=None):
+        trace = CaptureTrace(self, name)
+        with self._lock:
+            self._traces.append(trace)
+        return trace
+
+    def record(self, trace, stage, seconds):
+        with self._lock:
+            if stage not in self._samples:
+                self._samples[stage] = deque(maxlen=self._ring_size)
+                self._counts[stage] = 0
+                self._sums[stage] = 0.0
+            self._samples[stage].append(seconds)
+            self._counts[stage] += 1
+            self._sums[stage] += seconds
+            if trace is not None:
+                trace.stages[stage] = seconds * 1000
+
+    def stage_stats(self):
+        # {stage: {"count", "p50", "p95", "p99", "max"}} in ms, over the samples in the ring
+        with self._lock:
+            samples = {stage: np.array(values) * 1000 for stage, values in self._samples.items()}
+        stats = {}
+        for stage, values in samples.items():
+            stats[stage] = {"count": len(values)}
+            for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                stats[stage][f"p{percentile}"] = round(float(value), 2)
+            stats[stage]["max"] = round(float(values.max()), 2)
+        return stats
+
+    def recent_traces(self):
+        # Copies of the last few traces, oldest first
+        with self._lock:
+            return [{"name": trace.name, "stages_ms": dict(trace.stages)} for trace in self._traces]
+
+    def to_json(self):
+        return json.dumps({
+                "time": time.time(),
+                "stages_ms": self.stage_stats(),
+                "recent_captures": self.recent_traces(),
+            }, indent=2)
+
+    def to_prometheus(self):
+        with self._lock:
+            samples = {stage: np.array(values) for stage, values in self._samples.items()}
+            counts = dict(self._counts)
+            sums = dict(self._sums)
+        lines = [
+            f"# HELP {PROMETHEUS_METRIC} Photo booth capture latency by stage",
+            f"# TYPE {PROMETHEUS_METRIC} summary",
+        ]
+        for stage, values in samples.items():
+            for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                lines.append(f'{PROMETHEUS_METRIC}{{stage="{stage}",quantile="{percentile / 100}"}} {value:.6f}')
+            lines.append(f'{PROMETHEUS_METRIC}_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+            lines.append(f'{PROMETHEUS_METRIC}_count{{stage="{stage}"}} {counts[stage]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None):
+        path = path or self._dump_path
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+        # Written to a temp file first so a reader never sees half of it
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as dump_file:
+            dump_file.write(text)
+        os.replace(temp_path, path)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._try_dump()
+
+    def _try_dump(self):
+        try:
+            self.dump()
+        except Exception as e:
+            print("latency_tracer.py: Dump failed:", e)
+
+    def _worker(self):
+        while not self._stop.wait(self._dump_interval):
+            self._try_dump()
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+
+SYS_CLASS_NET = "/sys/class/net"
+PROC_NET_WIRELESS = "/proc/net/wireless"
+
+
+def read_text(path):
+    try:
+        with open(path, "r") as file_obj:
+            return file_obj.read().strip()
+    except OSError:
+        return None
+
+
+def read_wireless_links(proc_path=PROC_NET_WIRELESS):
+    """
+    Link quality of each associated wireless interface, from /proc/net/wireless.
+    The first two lines are headers, then "wlan0: 0000   70.  -40.  -256 ..."
+    """
+    links = {}
+    text = read_text(proc_path)
+    if not text:
+        return links
+    for line in text.splitlines()[2:]:
+        if ":" not in line:
+            continue
+        interface, fields = line.split(":", 1)
+        fields = fields.split()
+        try:
+            links[interface.strip()] = float(fields[1].rstrip("."))
+        except (IndexError, ValueError):
+            continue
+    return links
+
+
+class NetworkStatus:
+    def __init__(self, interfaces_up, wireless_links):
+        self.interfaces_up = sorted(interfaces_up)
+        self.wireless_links = wireless_links
+        self.timestamp = time.time()
+
+    def is_connected(self):
+        return len(self.interfaces_up) > 0
+
+    def is_wifi_connected(self):
+        return any(self.wireless_links.get(interface, 0) > 0 for interface in self.interfaces_up)
+
+    def __eq__(self, other):
+        # Link quality moves around all the time, only up/down changes count
+        return (
+                isinstance(other, NetworkStatus)
+                and (self.interfaces_up == other.interfaces_up)
+                and (self.is_wifi_connected() == other.is_wifi_connected())
+            )
+
+    def __repr__(self):
+        return f"NetworkStatus(up={self.interfaces_up}, wifi={self.is_wifi_connected()})"
+
+
+class NetworkMonitor:
+    """
+    Watches link state from its own thread by reading /sys/class/net and
+    /proc/net/wireless, so nothing forks or opens a socket. Callers read the
+    cached status, and subscribers get called (from the monitor thread) when
+    it changes.
+    """
+    def __init__(self, interval=2, sys_class_net=SYS_CLASS_NET, proc_net_wireless=PROC_NET_WIRELESS):
+        self._interval = interval
+        self._sys_class_net = sys_class_net
+        self._proc_net_wireless = proc_net_wireless
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._connected_event = threading.Event()
+        self._stop = threading.Event()
+        self._status = None
+        self.update()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def read_status(self):
+        interfaces_up = []
+        try:
+            interfaces = os.listdir(self._sys_class_net)
+        except OSError:
+            interfaces = []
+        for interface in interfaces:
+            if interface == "lo":
+                continue
+            interface_dir = os.path.join(self._sys_class_net, interface)
+            operstate = read_text(os.path.join(interface_dir, "operstate"))
+            # Some drivers report "unknown" but still show a carrier
+            if (operstate == "up") or ((operstate == "unknown") and (read_text(os.path.join(interface_dir, "carrier")) == "1")):
+                interfaces_up.append(interface)
+        return NetworkStatus(interfaces_up, read_wireless_links(self._proc_net_wireless))
+
+    def update(self):
+        status = self.read_status()
+        with self._lock:
+            changed = status != self._status
+            self._status = status
+            subscribers = list(self._subscribers)
+        if status.is_connected():
+            self._connected_event.set()
+        else:
+            self._connected_event.clear()
+        if changed:
+            print("network_monitor.py: Network status", status)
+            for callback in subscribers:
+                try:
+                    callback(status)
+                except Exception as e:
+                    print("network_monitor.py: Subscriber failed:", e)
+        return changed
+
+    def status(self):
+        with self._lock:
+            return self._status
+
+    def is_connected(self):
+        return self.status().is_connected()
+
+    def is_wifi_connected(self):
+        return self.status().is_wifi_connected()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def wait_until_connected(self, timeout=None):
+        return self._connected_event.wait(timeout)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _worker(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.update()
+            except Exception as e:
+                print("network_monitor.py: Update failed:", e)
+
+
+_shared_monitor = None
+_shared_monitor_lock = threading.Lock()
+
+def get_network_monitor():
+    # One monitor thread per process, started the first time anything asks
+    global _shared_monitor
+    with _shared_monitor_lock:
+        if _shared_monitor is None:
+            _shared_monitor = NetworkMonitor()
+        return _shared_monitor
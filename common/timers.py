@@ -1,13 +1,121 @@
+import heapq
+import itertools
+import math
 import time
 
+# Rebuild the heap once this many cancelled calls are sitting in it
+MAX_CANCELLED = 64
+
+class ScheduledCall:
+    def __init__(self, when, callback, args=(), interval=None):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+
+class Scheduler:
+    """
+    Priority queue of callbacks ordered by deadline. Nothing has to be polled:
+    run_due() runs whatever is due and next_deadline() says how long the
+    caller can sleep. Periodic calls are rescheduled from their due time
+    rather than from when they ran, so they don't drift.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def _push(self, call):
+        # The counter keeps calls with the same deadline in order and stops heapq comparing them
+        heapq.heappush(self._heap, (call.when, next(self._counter), call))
+
+    def call_at(self, when, callback, *args):
+        call = ScheduledCall(when, callback, args)
+        self._push(call)
+        return call
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self._clock() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args, first_delay=None):
+        if interval <= 0:
+            raise ValueError(f"Interval must be positive, got {interval}")
+        first_delay = interval if first_delay is None else first_delay
+        call = ScheduledCall(self._clock() + first_delay, callback, args, interval)
+        self._push(call)
+        return call
+
+    def cancel(self, call):
+        # Cancelled calls stay in the heap until they reach the top or the heap gets rebuilt
+        if (call is None) or call.cancelled:
+            return
+        call.cancelled = True
+        self._cancelled += 1
+        if self._cancelled > max(MAX_CANCELLED, len(self._heap) // 2):
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def next_deadline(self):
+        # Clock time of the soonest call, or None if nothing is scheduled
+        self._drop_cancelled()
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def run_due(self, now=None):
+        now = self._clock() if now is None else now
+        num_run = 0
+        while True:
+            self._drop_cancelled()
+            if (not self._heap) or (self._heap[0][0] > now):
+                return num_run
+            _, _, call = heapq.heappop(self._heap)
+            if call.interval is not None:
+                # Next slot on the original grid, skipping any that were missed
+                missed = math.floor((now - call.when) / call.interval)
+                call.when += (missed + 1) * call.interval
+                self._push(call)
+            else:
+                # A one shot call is done, cancelling it now is a no-op
+                call.cancelled = True
+            if call.callback is not None:
+                call.callback(*call.args)
+                num_run += 1
+
+
 class Timers:
-    def __init__(self):
+    """
+    Named countdown timers checked by polling, kept for the booth states.
+    Each start also puts a wake up in the scheduler so next_deadline covers
+    them along with the scheduled callbacks.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
         self.end_times = {}
         self.durations = {}
+        # Timers that haven't fired yet
+        self.armed = set()
+        self._wakeups = {}
         self.update_time()
+        self.scheduler = Scheduler(clock=self.now)
         
     def update_time(self):
-        self._now = time.perf_counter()
+        self._now = self._clock()
+        
+    def now(self):
+        return self._now
         
     def setup(self, timer, duration):
         self.durations[timer] = duration
@@ -23,6 +131,33 @@ class Timers:
                 raise ValueError(f"Timer duration not set for {timer}")
         end_time = self._now + timer_duration
         self.end_times[timer] = end_time
+        self.armed.add(timer)
+        self.scheduler.cancel(self._wakeups.get(timer))
+        self._wakeups[timer] = self.scheduler.call_at(end_time, None)
+        
+    def stop(self, timer):
+        self.armed.discard(timer)
+        self.scheduler.cancel(self._wakeups.pop(timer, None))
+        
+    def is_armed(self, timer):
+        return timer in self.armed
+        
+    def call_later(self, delay, callback, *args):
+        return self.scheduler.call_later(delay, callback, *args)
+        
+    def call_every(self, interval, callback, *args, first_delay=None):
+        return self.scheduler.call_every(interval, callback, *args, first_delay=first_delay)
+        
+    def cancel(self, call):
+        self.scheduler.cancel(call)
+        
+    def run_due(self):
+        # Runs the callbacks due at the last update_time, and clears the timer wake ups that passed
+        return self.scheduler.run_due(self._now)
+        
+    def next_deadline(self):
+        # Clock time of the next timer end or callback still to come, or None
+        return self.scheduler.next_deadline()
         
     def restart(self, timer):
         self.start(timer, duration=None)
@@ -38,7 +173,8 @@ class Timers:
         if self.time_left(timer) <= 0:
             if auto_restart:
                 self.restart(timer)
+            else:
+                self.armed.discard(timer)
             return True
         else:
             return False
-        
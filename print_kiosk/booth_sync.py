@@ -6,22 +6,23 @@ import glob
 import cv2
 import json
 
-from common.image_path_db import ImagePathDB
+from common.image_path_db import open_image_path_db
+from common.image_loader import load_image_resized
 
 WATCHDOG_TIMEOUT = 10
 CHECK_INTERVAL_S = 1
     
 def create_thumbnail(photo_path, thumbnail_path, size_x, size_y):
-    image = cv2.imread(photo_path)
-    if image is not None:
-        out = cv2.resize(image, dsize=(size_x, size_y))
+    # Decodes at 1/8 scale or so instead of the full photo
+    out = load_image_resized(photo_path, (size_x, size_y))
+    if out is not None:
         cv2.imwrite(thumbnail_path, out)
         return True
     else:
         return False
 
 class BoothSync:
-    def __init__(self, mount_addresses, mount_source, remote_photo_dir, photo_dir, print_postfixes, thumbnail_dir, local_test,  **kwargs):
+    def __init__(self, mount_addresses, mount_source, remote_photo_dir, photo_dir, print_postfixes, thumbnail_dir, local_test, photo_db_name="photo_db.json", **kwargs):
         self.stop_thread = False
         self._is_nfs_mounted = False
         self.mount_addresses = mount_addresses
@@ -33,7 +34,10 @@ class BoothSync:
         self.thumbnail_dir = thumbnail_dir
         self._is_syncing = False
         self.thumbnails = {}
-        self.photo_path_db = ImagePathDB(os.path.join(self.photo_dir, "photo_db.json"), old_root="/home/colin/booth_photos" if self.local_test else None)
+        self.photo_db_name = photo_db_name
+        self.photo_path_db = open_image_path_db(os.path.join(self.photo_dir, photo_db_name), old_root="/home/colin/booth_photos" if self.local_test else None)
+        self._remote_journal_id = None
+        self._remote_journal_offset = 0
         self.mount_check_thread = threading.Thread(target=self.check_nfs_mount)
         self.mount_check_thread.start()
         self.update_watchdog()
@@ -52,11 +56,16 @@ class BoothSync:
             ls_timeout = False
             try:
                 # Check if the mount point is available by looking up our Photo DB
-                output = subprocess.check_output(['cat', os.path.join(self.remote_photo_dir, "photo_db.json")], timeout=5)
-                new_db = json.loads(output.decode())
-                if old_db != new_db:
-                    print("New db found", time.time() % 1000)
-                    old_db = new_db
+                if self.photo_db_name.endswith(".jsonl"):
+                    new_db = None
+                    if self.read_remote_journal():
+                        print("New db records found", time.time() % 1000)
+                else:
+                    output = subprocess.check_output(['cat', os.path.join(self.remote_photo_dir, self.photo_db_name)], timeout=5)
+                    new_db = json.loads(output.decode())
+                    if old_db != new_db:
+                        print("New db found", time.time() % 1000)
+                        old_db = new_db
                 self._is_nfs_mounted = True
             except (subprocess.CalledProcessError) as exception:
                 print("NFS access failed", exception)
@@ -67,7 +76,8 @@ class BoothSync:
                 ls_timeout = True
 
             if self.is_nfs_mounted():
-                self.photo_path_db.replace_db(new_db)
+                if new_db is not None:
+                    self.photo_path_db.replace_db(new_db)
                 self.update_thumbnails()
                 
             # Unmount the directory if ls times out, cuz it can get stuck
@@ -91,6 +101,25 @@ class BoothSync:
             if (time.time() - self.watchdog_updated) > WATCHDOG_TIMEOUT:
                 raise ValueError("Booth sync thread watchdog timed out")
             
+    def read_remote_journal(self):
+        # Only fetches the journal lines added since the last check. Goes through
+        # subprocesses with timeouts like the JSON path, since NFS reads can hang
+        journal_path = os.path.join(self.remote_photo_dir, self.photo_db_name)
+        output = subprocess.check_output(['stat', '-c', '%d %i %s', journal_path], timeout=5)
+        device, inode, size = output.decode().split()
+        journal_id = (device, inode)
+        if (journal_id != self._remote_journal_id) or (int(size) < self._remote_journal_offset):
+            # The booth compacted the journal, read it from the start
+            self._remote_journal_id = journal_id
+            self._remote_journal_offset = 0
+            self.photo_path_db.replace_db({})
+        if int(size) == self._remote_journal_offset:
+            return False
+        data = subprocess.check_output(['tail', '-c', f"+{self._remote_journal_offset + 1}", journal_path], timeout=5)
+        num_bytes = self.photo_path_db.apply_journal_bytes(data)
+        self._remote_journal_offset += num_bytes
+        return num_bytes > 0
+        
     def is_nfs_mounted(self):
         return self._is_nfs_mounted
             
@@ -109,6 +138,9 @@ class BoothSync:
         image_paths = []
         for image_name in self.photo_path_db.image_names():
             for postfix in self.print_postfixes:
+                if not self.photo_path_db.image_has_postfix(image_name, postfix):
+                    # The booth hasn't written this variant yet
+                    continue
                 image_path = self.photo_path_db.get_image_path(image_name, postfix)
                 image_paths.append(image_path)
         return image_paths
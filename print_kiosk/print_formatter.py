@@ -1,6 +1,25 @@
 import cv2
 import numpy as np
 
+from common.image_loader import load_image
+
+def load_print_image(image_path, min_size=None):
+    # min_size (width, height) lets it decode at a reduced scale when the print is smaller than the photo
+    image = load_image(image_path, min_size=min_size, flags=cv2.IMREAD_COLOR)
+    if image is None:
+        raise FileNotFoundError(f"Couldn't load {image_path}")
+    return image
+
+
+def to_bgr(image):
+    # Gray photos are single channel JPEGs but prints are always laid out in color
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    elif image.shape[2] == 1:
+        return cv2.cvtColor(image[:, :, 0], cv2.COLOR_GRAY2BGR)
+    return image
+
+
 class PrintFormatter:
     def __init__(self, print_format, h_crop_2x6=1, v_crop_2x6=1, h_pad=0, logo_config=None, **kwargs):
         self.print_format = print_format
@@ -40,10 +59,18 @@ class PrintFormatter:
             crop_x2 = crop_x1 + int(image.shape[1] * x_ratio)
             crop_y1 = int(image.shape[0] * (1 - y_ratio) / 2)
             crop_y2 = crop_x1 + int(image.shape[0] * y_ratio)
-            cropped = image[crop_y1:crop_y2, crop_x1:crop_x2, :]
+            cropped = image[crop_y1:crop_y2, crop_x1:crop_x2]
             return cropped
     
-        images = [cv2.imread(im_path) for im_path in image_paths]
+        if self.print_format == "2x6":
+            # The strips are only 600 px wide, so the photos don't need decoding at full size
+            min_size = (int(np.ceil(600 / self._h_crop)), 0)
+        else:
+            min_size = None
+        images = [
+            to_bgr(im_path) if isinstance(im_path, np.ndarray) else load_print_image(im_path, min_size)
+            for im_path in image_paths
+        ]
         image_shape = images[0].shape
         for image in images[1:]:
             if image.shape != image_shape:
@@ -80,7 +107,7 @@ class PrintFormatter:
             y = y_padding
             for image in images:
                 cropped = crop_image(image, x_ratio=self._h_crop, y_ratio=self._v_crop)
-                resized = cv2.resize(cropped, (image_width, image_height))
+                resized = cv2.resize(cropped, (image_width, image_height), interpolation=cv2.INTER_AREA)
                 end_y = y + image_height
                 canvas[y : end_y, :, :] = resized
                 y += y_padding + image_height
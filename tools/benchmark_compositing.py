@@ -0,0 +1,105 @@
+import cv2
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common.compositing import PremultipliedAsset, alpha_to_fixed
+from argparse import ArgumentParser
+
+def get_args():
+    parser = ArgumentParser(prog='Compositing Benchmark',
+                    description='Compares the old float alpha blending against the fixed point compositing in common/compositing.py')
+
+    parser.add_argument("-n", "--iterations", type=int, default=20,
+                        help="Number of timed runs of each path")
+
+    return parser.parse_args()
+
+
+def synthetic_rgba(h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    image = cv2.resize(rng.integers(0, 256, (max(h // 16, 2), max(w // 16, 2), 4), dtype=np.uint8), (w, h))
+    return image
+
+
+class FloatBlend:
+    # The float32 path ApplyWatermark and Layer used before. Layers only weight the added alpha
+    def __init__(self, rgba, weight=1, layer=False):
+        alpha_1chan = np.array(rgba[:,:,3], dtype=np.float32) / 255 * (1 if layer else weight)
+        alpha = np.stack([alpha_1chan]*3, axis=-1)
+        self.alpha_inv = np.ones(alpha.shape, dtype=np.float32) - alpha
+        self.rgb = rgba[:,:,:3] * alpha
+        self.alpha = np.ndarray.astype(rgba[:,:,3] * weight, np.float32)
+
+    def blend(self, region):
+        region_float = np.array(region[:,:,:3], dtype=np.float32)
+        region_float *= self.alpha_inv
+        region[:,:,:3] = region_float + self.rgb
+
+    def composite(self, region):
+        region_alpha = region[:,:,3]
+        region[:,:,:3] = (region[:,:,:3] * self.alpha_inv) + self.rgb
+        region[:,:,3] = np.clip(np.ndarray.astype(region_alpha, np.float32) + self.alpha, a_min=0, a_max=255)
+
+
+class FixedBlend:
+    # The same setup as ApplyWatermark and Layer
+    def __init__(self, rgba, weight=1):
+        self.watermark_asset = PremultipliedAsset(rgba[:,:,:3], alpha_to_fixed(rgba[:,:,3], weight))
+        self.layer_asset = PremultipliedAsset.for_overlay(rgba, alpha_to_fixed(rgba[:,:,3], weight))
+
+    def blend(self, region):
+        self.watermark_asset.blend_into(region)
+
+    def composite(self, region):
+        self.layer_asset.blend_into(region)
+
+
+def time_ms(function, target, iterations):
+    times = []
+    for _ in range(iterations):
+        region = target.copy()
+        start_time = time.perf_counter()
+        function(region)
+        times.append((time.perf_counter() - start_time) * 1000)
+    return np.median(times), region
+
+
+def compare(label, float_function, fixed_function, target, iterations):
+    float_ms, float_out = time_ms(float_function, target, iterations)
+    fixed_ms, fixed_out = time_ms(fixed_function, target, iterations)
+    diff = np.abs(float_out.astype(np.int16) - fixed_out.astype(np.int16)).max()
+    print(f"{label:<32} float {float_ms:7.2f} ms   fixed {fixed_ms:7.2f} ms   ({float_ms / fixed_ms:.1f}x, max diff {diff})")
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    # Watermark: ~950 px wide logo on a full capture region
+    watermark = synthetic_rgba(400, 950, seed=1)
+    capture_region = synthetic_rgba(400, 950, seed=2)[:,:,:3].copy()
+    compare(
+            "Watermark 950x400 (color)",
+            FloatBlend(watermark, weight=0.8).blend,
+            FixedBlend(watermark, weight=0.8).blend,
+            capture_region,
+            args.iterations
+        )
+
+    # Overlay layers: a full screen layer and the arrow from config.yaml
+    overlay = synthetic_rgba(600, 1024, seed=3)
+    for (label, h, w, weight) in [
+            ("Full overlay layer 1024x600", 600, 1024, 1),
+            ("Arrow layer 434x150", 150, 434, 0.6),
+            ]:
+        layer = synthetic_rgba(h, w, seed=4)
+        compare(
+                label,
+                FloatBlend(layer, weight, layer=True).composite,
+                FixedBlend(layer, weight).composite,
+                overlay[:h, :w].copy(),
+                args.iterations
+            )
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from booth.jpeg_encoders import ENCODERS, ParallelJpegWriter
+from argparse import ArgumentParser
+
+# Size of the undistorted, roi-cropped capture
+IMG_WIDTH = 3805
+IMG_HEIGHT = 2690
+
+def get_args():
+    parser = ArgumentParser(prog='JPEG Encoder Benchmark',
+                    description='Times saving the gray, color and original variants of one capture with each encoder backend')
+
+    parser.add_argument("-n", "--iterations", type=int, default=3,
+                        help="Number of timed captures per backend")
+
+    parser.add_argument("-w", "--workers", type=int, default=3,
+                        help="Number of encode workers for the parallel runs")
+
+    parser.add_argument("-q", "--quality", type=int, default=95,
+                        help="JPEG quality")
+
+    return parser.parse_args()
+
+
+def synthetic_variants(w, h):
+    rng = np.random.default_rng(0)
+    color = cv2.resize(rng.integers(0, 256, (h // 8, w // 8, 3), dtype=np.uint8), (w, h))
+    # Single channel, like the booth's gray variant from capture to JPEG
+    gray = cv2.cvtColor(color, cv2.COLOR_RGB2GRAY)
+    original = cv2.resize(color, (4056, 3040))
+    return [gray, color, original]
+
+
+if __name__ == "__main__":
+    args = get_args()
+    variants = synthetic_variants(IMG_WIDTH, IMG_HEIGHT)
+
+    print(f"Capture: 3 variants, {IMG_WIDTH}x{IMG_HEIGHT} (+ 4056x3040 original), quality {args.quality}")
+    with tempfile.TemporaryDirectory() as out_dir:
+        jobs = [
+            (image, os.path.join(out_dir, f"variant_{i}.jpg"), None)
+            for i, image in enumerate(variants)
+        ]
+        for name, encoder_class in ENCODERS.items():
+            try:
+                encoder = encoder_class()
+            except ImportError as e:
+                print(f"{name:>10}: skipped ({e})")
+                continue
+            for num_workers in [1, args.workers]:
+                writer = ParallelJpegWriter(encoder, num_workers=num_workers)
+                writer.write(jobs, quality=args.quality) # Warm up
+                times = []
+                for _ in range(args.iterations):
+                    start_time = time.perf_counter()
+                    writer.write(jobs, quality=args.quality)
+                    times.append((time.perf_counter() - start_time) * 1000)
+                writer.shutdown()
+                total_bytes = sum(os.path.getsize(path) for (_, path, _) in jobs)
+                print(f"{name:>10}: {num_workers} worker(s) {np.median(times):7.1f} ms per capture, {total_bytes / 1e6:.1f} MB")
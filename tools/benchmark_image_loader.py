@@ -0,0 +1,100 @@
+import cv2
+import multiprocessing
+import numpy as np
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common.image_loader import load_image, load_image_resized
+from argparse import ArgumentParser
+
+def get_args():
+    parser = ArgumentParser(prog='Image Loader Benchmark',
+                    description='Compares full size decoding against the reduced decoding in common/image_loader.py')
+
+    parser.add_argument("-i", "--image", type=str, default=None,
+                        help="JPEG to load, a synthetic 4056x3040 photo is used if not given")
+    parser.add_argument("-n", "--iterations", type=int, default=5,
+                        help="Number of timed loads of each path")
+
+    return parser.parse_args()
+
+
+def synthetic_photo(path, gray=False):
+    rng = np.random.default_rng(0)
+    image = cv2.resize(rng.integers(0, 256, (190, 254, 3), dtype=np.uint8), (4056, 3040), interpolation=cv2.INTER_CUBIC)
+    if gray:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+
+# The three call sites, before and after
+def shuffle_before(path):
+    return cv2.resize(cv2.imread(path, cv2.IMREAD_UNCHANGED), (724, 543), interpolation=cv2.INTER_LINEAR)
+
+def shuffle_after(path):
+    return load_image_resized(path, (724, 543), cv2.IMREAD_UNCHANGED)
+
+def thumbnail_before(path):
+    return cv2.resize(cv2.imread(path), dsize=(300, 225))
+
+def thumbnail_after(path):
+    return load_image_resized(path, (300, 225))
+
+def print_before(path):
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+def print_after(path):
+    # 2x6 strips with h_crop 0.9
+    return load_image(path, min_size=(int(np.ceil(600 / 0.9)), 0))
+
+
+def measure(function, path, iterations, results):
+    # Runs in its own process so ru_maxrss is just this path's peak
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        image = function(path)
+        times.append((time.perf_counter() - start_time) * 1000)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((np.median(times), (peak_rss - start_rss) / 1024, image.shape))
+
+
+def run(function, path, iterations):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(function, path, iterations, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.image:
+            paths = [("photo", args.image)]
+        else:
+            paths = [
+                ("color", os.path.join(temp_dir, "color.jpg")),
+                ("gray", os.path.join(temp_dir, "gray.jpg")),
+            ]
+            synthetic_photo(paths[0][1])
+            synthetic_photo(paths[1][1], gray=True)
+
+        for (label, path) in paths:
+            print(f"{label} photo {path}")
+            for (name, before, after) in [
+                    ("Booth shuffle 724x543", shuffle_before, shuffle_after),
+                    ("Kiosk thumbnail 300x225", thumbnail_before, thumbnail_after),
+                    ("Print 2x6 strip", print_before, print_after),
+                    ]:
+                before_ms, before_mb, before_shape = run(before, path, args.iterations)
+                after_ms, after_mb, after_shape = run(after, path, args.iterations)
+                print(f"    {name:<26} before {before_ms:6.1f} ms {before_mb:6.1f} MB peak   after {after_ms:6.1f} ms {after_mb:6.1f} MB peak   {before_ms / after_ms:.1f}x  {after_shape}")
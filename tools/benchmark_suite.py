@@ -0,0 +1,358 @@
+import contextlib
+import cv2
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from booth.apply_watermark import ApplyWatermark
+from booth.overlay_manager import OverlayManager
+from booth.undistorter import Undistorter
+from booth.capture_frame import CaptureFrame
+from booth.display_renderer import DisplayRenderer
+from booth.jpeg_encoders import ENCODERS, TurboJPEG
+from print_kiosk.booth_sync import create_thumbnail
+from print_kiosk.print_formatter import PrintFormatter
+from common.image_path_db import ImagePathDB, JournaledImagePathDB, SqliteImagePathDB
+from common.common import load_config_file
+from argparse import ArgumentParser
+
+# Same sizes as booth.py
+FULL_IMG_WIDTH = 4056
+FULL_IMG_HEIGHT = 3040
+LORES_SIZE = (FULL_IMG_WIDTH // 2, FULL_IMG_HEIGHT // 2)
+DISPLAY_WIDTH = 1024
+DISPLAY_HEIGHT = 600
+DISPLAY_IMG_WIDTH = 724
+DISPLAY_IMG_HEIGHT = 543
+
+DB_SIZES = [100, 1000, 10000]
+DB_BACKENDS = {
+    "json": (ImagePathDB, ".json"),
+    "jsonl": (JournaledImagePathDB, ".jsonl"),
+    "sqlite": (SqliteImagePathDB, ".sqlite"),
+}
+
+def get_args():
+    parser = ArgumentParser(prog='Benchmark Suite',
+                    description='Times the image and db hot paths on synthetic inputs at the real sizes and saves the results as JSON')
+
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="JSON file to write, benchmark_<commit>.json if not given")
+    parser.add_argument("-c", "--compare", type=str, default=None,
+                        help="Earlier results JSON to compare against")
+    parser.add_argument("-k", "--filter", type=str, nargs="+", default=None,
+                        help="Only run benchmarks whose name contains one of these")
+    parser.add_argument("--min-rounds", type=int, default=5,
+                        help="Timed runs of each benchmark, at least")
+    parser.add_argument("--min-time", type=float, default=1.0,
+                        help="Keep running each benchmark for at least this many seconds")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Flag benchmarks whose median got this much slower than the compared results")
+
+    return parser.parse_args()
+
+
+def synthetic_rgb(w, h, channels=3, seed=0):
+    # Smooth noise, closer to a photo than white noise for the JPEG encoders
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (max(h // 16, 2), max(w // 16, 2), channels), dtype=np.uint8)
+    image = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    return image if channels > 1 else image.reshape(h, w)
+
+
+def synthetic_lens_cal(w, h):
+    mtx = np.array([
+            [3000, 0, w / 2],
+            [0, 3000, h / 2],
+            [0, 0, 1]
+        ], dtype=np.float64)
+    dist = np.array([[-0.25, 0.08, 0, 0, 0]], dtype=np.float64)
+    newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (w, h), 1, (w, h))
+    return [newcameramtx, roi, mtx, dist]
+
+
+def write_photo(path, seed=0):
+    cv2.imwrite(path, synthetic_rgb(FULL_IMG_WIDTH, FULL_IMG_HEIGHT, seed=seed), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return path
+
+
+# Each setup takes the work dir and returns {name: function to time}
+
+def setup_watermark(work_dir):
+    watermark_path = os.path.join(work_dir, "watermark.png")
+    cv2.imwrite(watermark_path, synthetic_rgb(1200, 400, channels=4, seed=1))
+    watermarker = ApplyWatermark(watermark_path, weight=1, h_size=950, offset_x=100, offset_y=90)
+    color_image = synthetic_rgb(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+    gray_image = cv2.cvtColor(color_image, cv2.COLOR_RGB2GRAY)
+    return {
+        "watermark/color": lambda: watermarker.apply_watermark(color_image),
+        "watermark/gray": lambda: watermarker.apply_watermark(gray_image),
+    }
+
+
+def booth_overlay_manager(cache_budget_mb):
+    # The booth's wifi layer plus the overlay layout from config.yaml, made up where the pngs aren't on this machine
+    overlay_manager = OverlayManager(DISPLAY_WIDTH, DISPLAY_HEIGHT, cache_budget_mb=cache_budget_mb)
+    no_wifi_overlay = np.zeros((DISPLAY_HEIGHT, DISPLAY_WIDTH, 4), dtype=np.uint8)
+    cv2.putText(no_wifi_overlay, "Wifi not connected", (412, 25), cv2.FONT_HERSHEY_DUPLEX, 0.75, (255, 255, 255, 255), 1)
+    overlay_manager.set_layer(no_wifi_overlay, name="wifi")
+    for i, (name, config) in enumerate(load_config_file("config.yaml")["overlays"].items()):
+        image = cv2.imread(config["path"], cv2.IMREAD_UNCHANGED) if os.path.isfile(config["path"]) else None
+        if image is None:
+            image = synthetic_rgb(config["size"][0], config["size"][1], channels=4, seed=i)
+        overlay_manager.set_layer(image, name=name, size=config["size"], offset=config["offset"], weight=config["weight"])
+    return overlay_manager
+
+
+def countdown_step(overlay_manager):
+    countdown_names = [name for name in overlay_manager.layers if name.startswith("countdown_")]
+    step = [0]
+    def run():
+        overlay_manager.deactivate_layer(countdown_names[step[0] % len(countdown_names)])
+        step[0] += 1
+        overlay_manager.activate_layer(countdown_names[step[0] % len(countdown_names)])
+        overlay_manager.update_overlay()
+    overlay_manager.activate_layer("three_shots")
+    overlay_manager.activate_layer(countdown_names[0])
+    overlay_manager.update_overlay()
+    return run
+
+
+def setup_overlay(work_dir):
+    uncached = booth_overlay_manager(cache_budget_mb=0)
+    cached = booth_overlay_manager(cache_budget_mb=64)
+    countdown_names = [name for name in cached.layers if name.startswith("countdown_")]
+    for name in countdown_names:
+        cached.precompute({"three_shots", name})
+
+    photo_overlay = DisplayRenderer(DISPLAY_WIDTH, DISPLAY_HEIGHT, DISPLAY_IMG_WIDTH, DISPLAY_IMG_HEIGHT).render(
+            synthetic_rgb(DISPLAY_IMG_WIDTH, DISPLAY_IMG_HEIGHT), bgr=True
+        )
+    over_photo = booth_overlay_manager(cache_budget_mb=0)
+    over_photo.set_main_image(photo_overlay, exclusive=False)
+    over_photo.update_overlay()
+    def arrow_blink():
+        if over_photo.layers["arrow"].is_active():
+            over_photo.deactivate_layer("arrow")
+        else:
+            over_photo.activate_layer("arrow")
+        over_photo.update_overlay()
+    def new_main_image():
+        over_photo.set_main_image(photo_overlay, exclusive=False)
+        over_photo.update_overlay()
+    return {
+        "overlay/countdown_step_uncached": countdown_step(uncached),
+        "overlay/countdown_step_cached": countdown_step(cached),
+        "overlay/arrow_blink_over_photo": arrow_blink,
+        "overlay/set_main_image": new_main_image,
+    }
+
+
+def setup_save_capture(work_dir):
+    lens_cal_file = os.path.join(work_dir, "lens_cal.bin")
+    undistorter = Undistorter(
+            synthetic_lens_cal(FULL_IMG_WIDTH, FULL_IMG_HEIGHT),
+            lens_cal_file=lens_cal_file,
+            image_size=(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+        )
+    rgb_image = synthetic_rgb(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+    gray_image = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+    yuv_array = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2YUV_I420)
+    benchmarks = {
+        "save/undistort_color": lambda: undistorter.undistort(rgb_image),
+        "save/undistort_gray": lambda: undistorter.undistort(gray_image),
+        "save/rgb_to_gray": lambda: cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY),
+        # A new frame each time, CaptureFrame keeps the converted RGB
+        "save/yuv420_to_rgb": lambda: CaptureFrame(yuv_array, yuv420=True, size=(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)).rgb(),
+    }
+    for encoder_name, encoder_class in ENCODERS.items():
+        if (encoder_name == "turbojpeg") and (TurboJPEG is None):
+            continue
+        encoder = encoder_class()
+        for (variant, image) in [("color", rgb_image), ("gray", gray_image)]:
+            path = os.path.join(work_dir, f"encode_{encoder_name}_{variant}.jpg")
+            benchmarks[f"save/encode_{encoder_name}_{variant}"] = (
+                lambda encoder=encoder, image=image, path=path: encoder.save(image, path, 95)
+            )
+    return benchmarks
+
+
+def setup_display(work_dir):
+    renderer = DisplayRenderer(DISPLAY_WIDTH, DISPLAY_HEIGHT, DISPLAY_IMG_WIDTH, DISPLAY_IMG_HEIGHT)
+    shuffle_color = synthetic_rgb(DISPLAY_IMG_WIDTH, DISPLAY_IMG_HEIGHT)
+    shuffle_gray = cv2.cvtColor(shuffle_color, cv2.COLOR_BGR2GRAY)
+    full_rgb = synthetic_rgb(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+    lores_frame = CaptureFrame(
+            cv2.cvtColor(synthetic_rgb(*LORES_SIZE), cv2.COLOR_RGB2YUV_I420),
+            yuv420=True,
+            size=LORES_SIZE
+        )
+    return {
+        # create_image_display_overlay, with the shuffle's display size images
+        "display/image_overlay_color": lambda: renderer.render(shuffle_color, bgr=True),
+        "display/image_overlay_gray": lambda: renderer.render(shuffle_gray, bgr=True),
+        # The first display of a capture
+        "display/capture_full_rgb": lambda: renderer.render(full_rgb, bgr=False, gray=True),
+        "display/capture_lores_yuv420": lambda: renderer.render_yuv420(lores_frame, gray=True),
+    }
+
+
+def setup_kiosk(work_dir):
+    photo_paths = [write_photo(os.path.join(work_dir, f"print_{i}.jpg"), seed=i) for i in range(4)]
+    thumbnail_path = os.path.join(work_dir, "thumbnail.png")
+    print_config = load_config_file("print_config.yaml")
+    benchmarks = {
+        "kiosk/create_thumbnail": lambda: create_thumbnail(photo_paths[0], thumbnail_path, 300, 225),
+    }
+    for print_format in ["2x6", "4x3", "3x2"]:
+        formatter = PrintFormatter(
+                print_format,
+                h_crop_2x6=print_config.get("h_crop_2x6", 1),
+                v_crop_2x6=print_config.get("v_crop_2x6", 1),
+                h_pad=print_config.get("h_pad", 0)
+            )
+        image_paths = photo_paths[:formatter.num_photos()]
+        benchmarks[f"kiosk/format_print_{print_format}"] = (
+            lambda formatter=formatter, image_paths=image_paths: formatter.format_print(image_paths)
+        )
+    return benchmarks
+
+
+def fill_db(db, num_photos):
+    for i in range(num_photos):
+        update_db(db, i)
+    db.update_file()
+
+
+def update_db(db, index):
+    photo_name = f"240101_{index:06d}"
+    root = os.path.split(db._db_file_path)[0]
+    db.update_image(photo_name, {
+        postfix: os.path.join(root, postfix.strip("_"), photo_name + postfix + ".jpg")
+        for postfix in ["_gray", "_color", "_original"]
+    })
+
+
+def load_db(db_class, path):
+    db = db_class(path)
+    if hasattr(db, "close"):
+        db.close()
+
+
+def setup_db(work_dir):
+    benchmarks = {}
+    for backend, (db_class, extension) in DB_BACKENDS.items():
+        for num_photos in DB_SIZES:
+            db_dir = os.path.join(work_dir, f"db_{backend}_{num_photos}")
+            os.makedirs(db_dir, exist_ok=True)
+            path = os.path.join(db_dir, "photo_db" + extension)
+            fill_db(db_class(path), num_photos)
+            db = db_class(path)
+            next_index = [num_photos]
+            def update(db=db, next_index=next_index):
+                # A new capture, what write_variants does under the db lock
+                update_db(db, next_index[0])
+                next_index[0] += 1
+                db.update_file()
+            benchmarks[f"db/{backend}_load_{num_photos}"] = lambda db_class=db_class, path=path: load_db(db_class, path)
+            benchmarks[f"db/{backend}_update_{num_photos}"] = update
+    return benchmarks
+
+
+SETUPS = [setup_watermark, setup_overlay, setup_save_capture, setup_display, setup_kiosk, setup_db]
+
+
+def time_benchmark(function, min_rounds, min_time):
+    function() # Warm up
+    times = []
+    start_time = time.perf_counter()
+    while (len(times) < min_rounds) or (time.perf_counter() - start_time < min_time):
+        run_start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - run_start) * 1000)
+    times = np.array(times)
+    return {
+        "rounds": len(times),
+        "min_ms": float(times.min()),
+        "median_ms": float(np.median(times)),
+        "mean_ms": float(times.mean()),
+        "stddev_ms": float(times.std()),
+        "p95_ms": float(np.percentile(times, 95)),
+        "max_ms": float(times.max()),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL
+            ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, old_results, threshold):
+    old_medians = {benchmark["name"]: benchmark["stats"]["median_ms"] for benchmark in old_results["benchmarks"]}
+    print()
+    print(f"Compared with {old_results.get('commit', '?')} from {old_results.get('datetime', '?')}")
+    regressions = 0
+    for benchmark in results["benchmarks"]:
+        old_median = old_medians.get(benchmark["name"])
+        if old_median is None:
+            continue
+        ratio = benchmark["stats"]["median_ms"] / old_median
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(f"    {benchmark['name']:<40} {old_median:9.2f} -> {benchmark['stats']['median_ms']:9.2f} ms  {ratio:5.2f}x{flag}")
+    print(f"{regressions} regressions past {threshold * 100:.0f}%")
+    return regressions
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "datetime": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "benchmarks": [],
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for setup in SETUPS:
+            # The code under test prints timings of its own, keep them out of the results
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                benchmarks = setup(work_dir)
+            for name, function in benchmarks.items():
+                if args.filter and not any(pattern in name for pattern in args.filter):
+                    continue
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    stats = time_benchmark(function, args.min_rounds, args.min_time)
+                results["benchmarks"].append({"name": name, "group": name.split("/")[0], "stats": stats})
+                print(f"{name:<40} median {stats['median_ms']:9.2f} ms  p95 {stats['p95_ms']:9.2f} ms  ({stats['rounds']} rounds)")
+
+    output_path = args.output or f"benchmark_{commit}.json"
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print("Saved", output_path)
+
+    if args.compare:
+        with open(args.compare, "r") as compare_file:
+            compare(results, json.load(compare_file), args.threshold)
@@ -0,0 +1,114 @@
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common.timers import Scheduler, Timers
+from argparse import ArgumentParser
+
+def get_args():
+    parser = ArgumentParser(prog='Timer Benchmark',
+                    description='Compares polling named Timers every tick against the heap Scheduler in common/timers.py')
+
+    parser.add_argument("-n", "--num-timers", type=int, nargs="+", default=[10, 100, 500, 1000],
+                        help="Numbers of timers to benchmark with")
+    parser.add_argument("-t", "--ticks", type=int, default=2000,
+                        help="Number of simulated main loop ticks")
+    parser.add_argument("--tick-time", type=float, default=0.025,
+                        help="Simulated seconds between ticks")
+
+    return parser.parse_args()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def intervals(num_timers, seed=0):
+    # Periods from 0.1 to 10 s, like the booth's qr, wifi and display timers
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0.1, 10, num_timers)
+
+
+def bench_polling(num_timers, ticks, tick_time):
+    # Every tick checks every timer, what main_loop did with wifi_check and qr_code_check
+    timers = Timers()
+    timers._now = 0.0
+    names = [f"timer_{i}" for i in range(num_timers)]
+    for name, interval in zip(names, intervals(num_timers)):
+        timers.start(name, interval)
+    fired = 0
+    start_time = time.perf_counter()
+    for tick in range(ticks):
+        timers._now = tick * tick_time
+        for name in names:
+            if timers.check(name, auto_restart=True):
+                fired += 1
+    return (time.perf_counter() - start_time) / ticks * 1e6, fired
+
+
+def bench_min_deadline(num_timers, ticks, tick_time):
+    # Scanning every end time for the next deadline, instead of a heap
+    end_times = {f"timer_{i}": interval for i, interval in enumerate(intervals(num_timers))}
+    start_time = time.perf_counter()
+    for tick in range(ticks):
+        min(end_times.values())
+    return (time.perf_counter() - start_time) / ticks * 1e6
+
+
+def bench_scheduler(num_timers, ticks, tick_time):
+    # Periodic callbacks, each tick runs what's due and asks for the next deadline
+    clock = FakeClock()
+    scheduler = Scheduler(clock=clock)
+    fired = [0]
+    def callback():
+        fired[0] += 1
+    for interval in intervals(num_timers):
+        scheduler.call_every(interval, callback)
+    start_time = time.perf_counter()
+    for tick in range(ticks):
+        clock.now = tick * tick_time
+        scheduler.run_due()
+        scheduler.next_deadline()
+    return (time.perf_counter() - start_time) / ticks * 1e6, fired[0]
+
+
+def bench_scheduler_sleeping(num_timers, ticks, tick_time):
+    # Only waking at the deadlines, like the event driven main loop
+    clock = FakeClock()
+    scheduler = Scheduler(clock=clock)
+    for interval in intervals(num_timers):
+        scheduler.call_every(interval, lambda: None)
+    end_time = ticks * tick_time
+    wakeups = 0
+    start_time = time.perf_counter()
+    while True:
+        deadline = scheduler.next_deadline()
+        if deadline > end_time:
+            break
+        clock.now = deadline
+        scheduler.run_due()
+        wakeups += 1
+    return (time.perf_counter() - start_time) * 1e6, wakeups
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    print(f"{args.ticks} ticks every {args.tick_time * 1000:.0f} ms ({args.ticks * args.tick_time:.0f} s simulated)")
+    for num_timers in args.num_timers:
+        poll_us, poll_fired = bench_polling(num_timers, args.ticks, args.tick_time)
+        scan_us = bench_min_deadline(num_timers, args.ticks, args.tick_time)
+        heap_us, heap_fired = bench_scheduler(num_timers, args.ticks, args.tick_time)
+        sleep_us, wakeups = bench_scheduler_sleeping(num_timers, args.ticks, args.tick_time)
+        print(f"{num_timers:5d} timers:")
+        print(f"    Poll every timer       {poll_us:8.1f} us/tick ({poll_fired} fired)")
+        print(f"    Scan for next deadline {scan_us:8.1f} us/tick")
+        print(f"    Scheduler per tick     {heap_us:8.1f} us/tick ({heap_fired} fired)")
+        print(f"    Scheduler sleeping     {sleep_us / 1000:8.1f} ms total for {wakeups} wakeups vs {args.ticks} ticks")
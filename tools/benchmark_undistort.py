@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from booth.undistorter import Undistorter
+from argparse import ArgumentParser
+
+FULL_IMG_WIDTH = 4056
+FULL_IMG_HEIGHT = 3040
+
+def get_args():
+    parser = ArgumentParser(prog='Undistort Benchmark',
+                    description='Compares cv2.undistort against the cached remap tables on a synthetic frame')
+
+    parser.add_argument("-c", "--lens_cal_file",
+                        help="Lens calibration .bin to use (default: a synthetic calibration)")
+
+    parser.add_argument("-n", "--iterations", type=int, default=5,
+                        help="Number of timed runs of each path")
+
+    return parser.parse_args()
+
+
+def synthetic_lens_cal(w, h):
+    mtx = np.array([
+            [3000, 0, w / 2],
+            [0, 3000, h / 2],
+            [0, 0, 1]
+        ], dtype=np.float64)
+    dist = np.array([[-0.25, 0.08, 0, 0, 0]], dtype=np.float64)
+    newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (w, h), 1, (w, h))
+    return [newcameramtx, roi, mtx, dist]
+
+
+def synthetic_frame(w, h):
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (h // 8, w // 8, 3), dtype=np.uint8)
+    return cv2.resize(frame, (w, h), interpolation=cv2.INTER_LINEAR)
+
+
+def time_ms(function, iterations):
+    times = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - start_time) * 1000)
+    return result, np.median(times)
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    if args.lens_cal_file:
+        with open(args.lens_cal_file, "rb") as file_obj:
+            lens_cal = pickle.load(file_obj)
+    else:
+        lens_cal = synthetic_lens_cal(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+    newcameramtx, roi, mtx, dist = lens_cal
+    frame = synthetic_frame(FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+    image_size = (FULL_IMG_WIDTH, FULL_IMG_HEIGHT)
+
+    def undistort_path():
+        dst = cv2.undistort(frame, mtx, dist, None, newcameramtx)
+        x, y, w, h = roi
+        return dst[y:y+h, x:x+w]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_cal_file = os.path.join(cache_dir, "lens_cal.bin")
+
+        start_time = time.perf_counter()
+        undistorter = Undistorter(lens_cal, lens_cal_file=cache_cal_file, image_size=image_size)
+        cold_ms = (time.perf_counter() - start_time) * 1000
+
+        start_time = time.perf_counter()
+        Undistorter(lens_cal, lens_cal_file=cache_cal_file, image_size=image_size)
+        warm_ms = (time.perf_counter() - start_time) * 1000
+
+        old_image, old_ms = time_ms(undistort_path, args.iterations)
+        new_image, new_ms = time_ms(lambda: undistorter.undistort(frame), args.iterations)
+
+    diff = np.abs(old_image.astype(np.int16) - new_image.astype(np.int16))
+    print(f"Frame {FULL_IMG_WIDTH}x{FULL_IMG_HEIGHT}, roi {tuple(roi)}")
+    print(f"Map build + cache write: {cold_ms:.1f} ms")
+    print(f"Map load from cache:     {warm_ms:.1f} ms")
+    print(f"cv2.undistort + crop:    {old_ms:.1f} ms")
+    print(f"Cached remap:            {new_ms:.1f} ms ({old_ms / new_ms:.1f}x)")
+    print(f"Max pixel difference {diff.max()}, mean {diff.mean():.3f}")
@@ -0,0 +1,395 @@
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from argparse import ArgumentParser
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(REPO_DIR)
+
+from common.common import load_config
+from common.image_path_db import open_image_path_db
+
+# Runs the booth on sim_hardware.py, the uploader against a local fake photo
+# service and BoothSync against the booth's photo directory instead of NFS,
+# each in its own process like on the Pis, for thousands of captures. Samples
+# of each metric are taken over time and any metric that drifts from start to
+# end gets flagged, since that's what goes wrong late in a long event.
+#   python3 tools/soak_test.py -n 2000
+
+BOOTH_DIR = os.path.join(REPO_DIR, "booth")
+UPLOADER_DIR = os.path.join(REPO_DIR, "uploader")
+
+# Metrics that should stay flat however many photos there are. Counts like the
+# number of thumbnails grow by design, they're only reported
+TRENDED_METRICS = {
+    "booth": ["capture_to_disk_ms", "save_wait_ms", "deferred_backlog", "rss_mb"],
+    "uploader": ["time_to_qr_s", "db_parse_ms", "rss_mb"],
+    "kiosk": ["thumbnail_lag_s", "db_parse_ms", "rss_mb"],
+}
+# Changes smaller than this are noise, whatever the percentage
+METRIC_FLOORS = {"capture_to_disk_ms": 20, "save_wait_ms": 20, "deferred_backlog": 5, "rss_mb": 10, "time_to_qr_s": 0.5, "db_parse_ms": 2, "thumbnail_lag_s": 0.5}
+
+
+def get_args():
+    parser = ArgumentParser(prog='Soak Test',
+                    description='Drives simulated captures through the booth, uploader and kiosk sync for hours and flags metrics that drift')
+
+    parser.add_argument("-n", "--captures", type=int, default=1000,
+                        help="Number of button presses")
+    parser.add_argument("-d", "--duration", type=float, default=None,
+                        help="Stop pressing after this many real seconds, even if not all captures are done")
+    parser.add_argument("-i", "--interval", type=float, default=15,
+                        help="Simulated seconds between button presses")
+    parser.add_argument("-r", "--real-interval", type=float, default=1.0,
+                        help="Real seconds between button presses, so the booth has some idle time for deferred variants")
+    parser.add_argument("-f", "--frames-dir", type=str, default=None,
+                        help="Directory of recorded JPEGs for the camera, synthetic frames if not given")
+    parser.add_argument("-w", "--work-dir", type=str, default=None,
+                        help="Where photos, dbs and results get written, a temp dir if not given")
+    parser.add_argument("--config", type=str, default="config",
+                        help="Config name, same as the booth loads")
+    parser.add_argument("--db", type=str, choices=["json", "jsonl", "sqlite"], default=None,
+                        help="Photo db backend, whatever the config uses if not given")
+    parser.add_argument("--upload-latency", type=float, default=0.2,
+                        help="Seconds the fake photo service takes per upload")
+    parser.add_argument("--sample-interval", type=float, default=10,
+                        help="Real seconds between RSS and db parse samples")
+    parser.add_argument("--drain", type=float, default=30,
+                        help="Real seconds to let the uploader and kiosk catch up after the last capture")
+    parser.add_argument("--warmup", type=float, default=60,
+                        help="Real seconds at the start left out of the trends, while caches fill")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25,
+                        help="Flag a metric if its median changes by more than this fraction from the start to the end")
+
+    return parser.parse_args()
+
+
+def rss_mb():
+    # Current resident set, ru_maxrss would only ever show the peak
+    with open("/proc/self/statm") as statm:
+        resident_pages = int(statm.read().split()[1])
+    return resident_pages * resource.getpagesize() / 1e6
+
+
+class Sampler:
+    # Puts (process, metric, time, value) on the results queue, the periodic ones every interval
+    def __init__(self, results, process_name, interval):
+        self.results = results
+        self.process_name = process_name
+        self.interval = interval
+        self.last_sample_time = 0
+
+    def put(self, metric, value):
+        self.results.put((self.process_name, metric, time.time(), value))
+
+    def due(self):
+        if time.time() - self.last_sample_time < self.interval:
+            return False
+        self.last_sample_time = time.time()
+        return True
+
+
+def booth_process(work_dir, args, results, stop_event):
+    # Same imports as running booth.py from its own directory
+    sys.path.insert(0, BOOTH_DIR)
+    from booth import PhotoBooth
+    from sim_hardware import SimHardware
+    from simulate_booth import sim_config, press_button
+
+    config = sim_config(load_config(args.config), work_dir)
+    if args.db:
+        db_name = "photo_db." + args.db
+        config["photo_path_db"] = os.path.join(work_dir, db_name)
+        config["photo_db_json_export"] = os.path.join(work_dir, "photo_db.json") if args.db == "sqlite" else None
+    sampler = Sampler(results, "booth", args.sample_interval)
+    sampler.put("config", config)
+
+    hardware = SimHardware(frames_dir=args.frames_dir)
+    photo_booth = PhotoBooth(config, hardware)
+    button = hardware.buttons[list(hardware.buttons)[0]]
+    hardware.loop.run_for(2)
+
+    seen_names = set()
+    def collect_traces():
+        for trace in photo_booth.tracer.recent_traces():
+            stages = trace["stages_ms"]
+            if (trace["name"] in seen_names) or ("save" not in stages):
+                continue
+            seen_names.add(trace["name"])
+            sampler.put("capture_to_disk_ms", stages.get("save_wait", 0) + stages["save"])
+            sampler.put("save_wait_ms", stages.get("save_wait", 0))
+            sampler.put("captures", len(seen_names))
+
+    start_time = time.time()
+    for i in range(args.captures):
+        if stop_event.is_set() or (args.duration and (time.time() - start_time > args.duration)):
+            break
+        press_button(photo_booth, button, 0.2, True)
+        hardware.loop.run_for(args.interval)
+        collect_traces()
+        if sampler.due():
+            sampler.put("rss_mb", rss_mb())
+            if photo_booth.deferred_saver is not None:
+                # Deferred variants only get written while the booth is idle, so this grows if it never is
+                sampler.put("deferred_backlog", photo_booth.deferred_saver.pending_jobs())
+        # Idle between guests at real speed, the main loop has to keep ticking for the deferred saver to see it
+        idle_end = time.time() + args.real_interval
+        while time.time() < idle_end:
+            time.sleep(0.1)
+            hardware.loop.run_for(0.1)
+
+    while (photo_booth.state != photo_booth.state_display_capture) or (photo_booth.extra_shots > 0):
+        hardware.loop.run_for(1)
+    photo_booth.capture_saver.wait_until_done()
+    collect_traces()
+    sampler.put("rss_mb", rss_mb())
+    photo_booth.stop()
+    sampler.put("done", len(seen_names))
+
+
+class LocalPhotoService:
+    # Stands in for SmugMug or S3, copies uploads into a directory after a network-ish delay
+    def __init__(self, service_dir, latency):
+        self.service_dir = service_dir
+        self.latency = latency
+        os.makedirs(service_dir, exist_ok=True)
+
+    def upload_photo(self, photo_path, photo_name):
+        time.sleep(self.latency)
+        shutil.copy(photo_path, self.service_dir)
+        return "http://localhost/photos/" + photo_name
+
+    def create_album(self, album_name):
+        return
+
+
+def uploader_process(work_dir, config, args, results, stop_event):
+    # Same imports as running upload_photos.py from its own directory
+    sys.path.insert(0, UPLOADER_DIR)
+    sampler = Sampler(results, "uploader", args.sample_interval)
+    try:
+        from uploader.upload_photos import upload_new_photos, open_uploaded_db
+    except ImportError as e:
+        sampler.put("error", f"can't import upload_photos ({e})")
+        return
+
+    photo_db = open_image_path_db(config["photo_path_db"])
+    qr_db = open_image_path_db(config["qr_path_db"])
+    service = LocalPhotoService(os.path.join(work_dir, "service"), args.upload_latency)
+    display_postfix = config["gray_postfix"] if config.get("display_gray", True) else config["color_postfix"]
+    uploaded_db = open_uploaded_db(config, photo_db, qr_db)
+    error_photos = []
+    num_qrs = 0
+
+    while not stop_event.is_set():
+        start_time = time.perf_counter()
+        photo_db.try_update_from_file()
+        if sampler.due():
+            sampler.put("db_parse_ms", (time.perf_counter() - start_time) * 1000)
+            sampler.put("rss_mb", rss_mb())
+        qr_names = set(qr_db.image_names())
+        upload_new_photos(photo_db, qr_db, uploaded_db, service, config, error_photos)
+        for photo_name in set(qr_db.image_names()) - qr_names:
+            # From the booth writing the display photo to the QR code being there to show
+            photo_time = os.stat(photo_db.get_image_path(photo_name, display_postfix)).st_mtime
+            qr_time = os.stat(qr_db.get_image_path(photo_name)).st_mtime
+            sampler.put("time_to_qr_s", qr_time - photo_time)
+            num_qrs += 1
+        sampler.put("qrs", num_qrs)
+        time.sleep(0.25)
+    sampler.put("rss_mb", rss_mb())
+
+
+def kiosk_process(work_dir, config, args, results, stop_event):
+    from print_kiosk.booth_sync import BoothSync
+
+    sampler = Sampler(results, "kiosk", args.sample_interval)
+    # The kiosk reads the JSON export of an SQLite db
+    remote_db_path = config.get("photo_db_json_export") or config["photo_path_db"]
+    remote_photo_dir = os.path.dirname(remote_db_path) + "/"
+    photo_dir = os.path.join(work_dir, "kiosk_photos") + "/"
+    thumbnail_dir = os.path.join(work_dir, "kiosk_thumbnails")
+    for image_dir_key in ["gray_image_dir", "color_image_dir"]:
+        os.makedirs(os.path.join(photo_dir, os.path.relpath(config[image_dir_key], remote_photo_dir)), exist_ok=True)
+    os.makedirs(thumbnail_dir, exist_ok=True)
+
+    # Until the first capture there's nothing to sync, like an unmounted share
+    while not os.path.isfile(remote_db_path):
+        if stop_event.wait(0.5):
+            return
+    booth_sync = BoothSync(
+            mount_addresses=[],
+            mount_source=None,
+            remote_photo_dir=remote_photo_dir,
+            photo_dir=photo_dir,
+            print_postfixes=[config["color_postfix"], config["gray_postfix"]],
+            thumbnail_dir=thumbnail_dir,
+            local_test=False,
+            photo_db_name=os.path.basename(remote_db_path),
+        )
+
+    seen_paths = set()
+    while not stop_event.wait(0.5):
+        # The kiosk GUI keeps the sync thread's watchdog happy
+        booth_sync.update_watchdog()
+        try:
+            thumbnails = list(booth_sync.thumbnails.items())
+        except RuntimeError:
+            # Changed size under us, the sync thread is adding some
+            continue
+        for image_path, thumbnail_path in thumbnails:
+            if image_path in seen_paths:
+                continue
+            seen_paths.add(image_path)
+            remote_path = os.path.join(remote_photo_dir, os.path.relpath(image_path, photo_dir))
+            # From the booth writing the photo to its thumbnail being ready to print from
+            sampler.put("thumbnail_lag_s", os.stat(thumbnail_path).st_mtime - os.stat(remote_path).st_mtime)
+        sampler.put("thumbnails", len(seen_paths))
+        if sampler.due():
+            start_time = time.perf_counter()
+            if remote_db_path.endswith(".jsonl"):
+                open_image_path_db(remote_db_path)
+            else:
+                with open(remote_db_path) as db_file:
+                    json.load(db_file)
+            sampler.put("db_parse_ms", (time.perf_counter() - start_time) * 1000)
+            sampler.put("rss_mb", rss_mb())
+    booth_sync.shutdown()
+    sampler.put("rss_mb", rss_mb())
+
+
+def trend(samples, threshold, floor):
+    # Compares the median of the first fifth of the run to the last fifth, and fits a line for the rate.
+    # Medians so a few slow outliers don't count as a trend
+    if len(samples) < 10:
+        return None
+    times = np.array([sample[0] for sample in samples])
+    values = np.array([sample[1] for sample in samples], dtype=np.float64)
+    fifth = len(values) // 5
+    first = float(np.median(values[:fifth]))
+    last = float(np.median(values[-fifth:]))
+    slope = np.polyfit(times - times[0], values, 1)[0]
+    change = (last - first) / max(abs(first), 1e-9)
+    flagged = (abs(change) > threshold) and (abs(last - first) > floor)
+    return {
+        "count": len(values),
+        "first": first,
+        "last": last,
+        "change": change,
+        "per_hour": float(slope * 3600),
+        "flagged": bool(flagged),
+    }
+
+
+def print_status(start_time, latest):
+    status = [f"{time.time() - start_time:>6.0f} s"]
+    for process_name, metric in [("booth", "captures"), ("uploader", "qrs"), ("kiosk", "thumbnails")]:
+        status.append(f"{metric} {latest.get((process_name, metric), 0)}")
+    for process_name in TRENDED_METRICS:
+        status.append(f"{process_name} {latest.get((process_name, 'rss_mb'), 0):.0f} MB")
+    print("soak_test.py:", ", ".join(status))
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="booth_soak_")
+    booth_dir = os.path.join(work_dir, "booth")
+    # Separate interpreters, so each one's RSS is its own like on the Pis
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    stop_event = context.Event()
+    processes = [context.Process(target=booth_process, args=(booth_dir, args, results, stop_event), name="booth")]
+    processes[0].start()
+
+    samples = {}
+    latest = {}
+    errors = []
+    start_time = time.time()
+    last_status_time = start_time
+    done_time = None
+    while True:
+        try:
+            process_name, metric, sample_time, value = results.get(timeout=1)
+            if metric == "config":
+                # The uploader and kiosk need to know where the booth is writing
+                processes.append(context.Process(target=uploader_process, args=(work_dir, value, args, results, stop_event), name="uploader"))
+                processes.append(context.Process(target=kiosk_process, args=(work_dir, value, args, results, stop_event), name="kiosk"))
+                processes[-2].start()
+                processes[-1].start()
+            elif metric == "done":
+                done_time = time.time()
+            elif metric == "error":
+                print(f"soak_test.py: {process_name} skipped, {value}")
+                errors.append(f"{process_name}: {value}")
+            else:
+                samples.setdefault((process_name, metric), []).append((sample_time, value))
+                latest[(process_name, metric)] = value
+        except queue.Empty:
+            pass
+        except KeyboardInterrupt:
+            print("soak_test.py: Stopping")
+            stop_event.set()
+            done_time = done_time or time.time()
+            args.drain = 0
+
+        if time.time() - last_status_time > 30:
+            print_status(start_time, latest)
+            last_status_time = time.time()
+        if processes[0].exitcode not in [None, 0] and done_time is None:
+            errors.append(f"booth: exited with {processes[0].exitcode}")
+            done_time = time.time()
+        if (done_time is not None) and (time.time() - done_time > args.drain):
+            stop_event.set()
+            if not any(process.is_alive() for process in processes):
+                break
+
+    # Whatever got queued while the processes were finishing
+    while True:
+        try:
+            process_name, metric, sample_time, value = results.get(timeout=0.5)
+        except queue.Empty:
+            break
+        if metric not in ["config", "done", "error"]:
+            samples.setdefault((process_name, metric), []).append((sample_time, value))
+            latest[(process_name, metric)] = value
+    print_status(start_time, latest)
+
+    report = {}
+    print()
+    print(f"{'Metric':<30}{'count':>7}{'first':>10}{'last':>10}{'change':>9}{'per hour':>11}")
+    for process_name, metrics in TRENDED_METRICS.items():
+        for metric in metrics:
+            key = f"{process_name}.{metric}"
+            trend_samples = [sample for sample in samples.get((process_name, metric), []) if sample[0] >= start_time + args.warmup]
+            result = trend(trend_samples, args.threshold, METRIC_FLOORS[metric])
+            report[key] = result
+            if result is None:
+                print(f"{key:<30}{'too few samples':>22}")
+                continue
+            print(f"{key:<30}{result['count']:>7}{result['first']:>10.2f}{result['last']:>10.2f}{result['change']:>8.0%}{result['per_hour']:>11.2f}",
+                  "  NOT FLAT" if result["flagged"] else "")
+
+    results_path = os.path.join(work_dir, "soak.json")
+    with open(results_path, "w") as results_file:
+        json.dump({
+                "args": vars(args),
+                "duration_s": time.time() - start_time,
+                "errors": errors,
+                "trends": report,
+                "samples": {f"{process_name}.{metric}": values for (process_name, metric), values in samples.items()},
+            }, results_file)
+    flagged = [key for key, result in report.items() if result and result["flagged"]]
+    print()
+    print("soak_test.py: Results written to", results_path)
+    if flagged:
+        print("soak_test.py: Not flat:", ", ".join(flagged))
+    sys.exit(1 if (flagged or errors) else 0)
@@ -4,7 +4,7 @@ import os
 import time
 from datetime import datetime
 from common.common import load_config
-from common.image_path_db import ImagePathDB
+from common.image_path_db import open_image_path_db
 from uploader.photo_service import PhotoService
 from uploader.google_photos_upload import GooglePhotos
 from uploader.smugmug import SmugMug
@@ -57,19 +57,80 @@ def attempt_upload(photo_name, postfix, error_photos, photo_db, service):
     return success, image_url
 
 
-def main():
-    config = load_config()
-    display_gray = config.get("display_gray", True)
-    qr_db = ImagePathDB(config["qr_path_db"])
-    photo_db = ImagePathDB(config["photo_path_db"])
+def open_uploaded_db(config, photo_db, qr_db):
+    # Photos whose other variant has been uploaded. It's a file rather than a list in memory, so
+    # photos whose other variant was still waiting when the uploader stopped get picked up after a restart
+    uploaded_db_path = config.get("uploaded_path_db") or os.path.join(os.path.dirname(config["qr_path_db"]), "uploaded_db.json")
+    is_new = not os.path.exists(uploaded_db_path)
+    uploaded_db = open_image_path_db(uploaded_db_path)
+    if is_new:
+        # Before this db existed the other variant went up right after the QR code whenever it was there, count those as done
+        other_postfix = get_postfixes(config)[1]
+        for photo_name in qr_db.image_names():
+            if photo_db.image_has_postfix(photo_name, other_postfix):
+                uploaded_db.add_image(photo_name, photo_db.get_image_path(photo_name, other_postfix))
+        uploaded_db.update_file()
+    return uploaded_db
+
 
+def get_postfixes(config):
+    # The display postfix is the one the QR code links to
     color_postfix = config["color_postfix"]
     gray_postfix = config["gray_postfix"]
+    if config.get("display_gray", True):
+        return gray_postfix, color_postfix
+    return color_postfix, gray_postfix
+
+
+def upload_new_photos(photo_db, qr_db, uploaded_db, service, config, error_photos):
+    # One pass of the upload loop. Returns False if there were photos to upload but uploading is disabled
     qr_dir = config["qr_dir"]
-    display_postfix = gray_postfix if display_gray else color_postfix
-    other_postfix = color_postfix if display_gray else gray_postfix
+    display_postfix, other_postfix = get_postfixes(config)
     
-    print("upload_photos.py: Saving QR codes to", qr_dir)
+    # Newest first. With the SQLite backend this is an indexed query instead of a set difference
+    missing_qr_names = photo_db.names_missing_from(qr_db)
+    
+    if len(missing_qr_names):
+        print()
+        print("upload_photos.py: Missing qr codes")
+        print(missing_qr_names)
+        
+        if not config.get("enable_upload", True):
+            print("upload_photos.py: Upload disabled, skipping")
+            return False
+
+    for photo_name in missing_qr_names:
+        # First upload the photo that the QR code will link to. If it fails, go to the next photo
+        upload_success, qr_target = attempt_upload(photo_name, display_postfix, error_photos, photo_db, service)
+        if not upload_success:
+            continue
+        
+        os.makedirs(qr_dir, exist_ok=True)
+        qr_path = os.path.join(qr_dir, photo_name + ".png")
+        create_qr_code(qr_target, qr_path)
+        qr_db.add_image(photo_name, qr_path)
+        qr_db.update_file()
+        print("upload_photos.py: Qr target", qr_target)
+        print("upload_photos.py: Qr path", qr_path)
+            
+    # Then the other variant of every photo with a QR code, which the booth may only write later when it's idle.
+    # Ones that failed are left until the next restart rather than retried every pass
+    for photo_name in qr_db.names_missing_from(uploaded_db):
+        if not photo_db.image_has_postfix(photo_name, other_postfix) or ((photo_name + other_postfix) in error_photos):
+            continue
+        upload_success, _ = attempt_upload(photo_name, other_postfix, error_photos, photo_db, service)
+        if upload_success:
+            uploaded_db.add_image(photo_name, photo_db.get_image_path(photo_name, other_postfix))
+            uploaded_db.update_file()
+    return True
+
+
+def main():
+    config = load_config()
+    qr_db = open_image_path_db(config["qr_path_db"])
+    photo_db = open_image_path_db(config["photo_path_db"])
+    
+    print("upload_photos.py: Saving QR codes to", config["qr_dir"])
     
     wait_for_network_connection()
     
@@ -84,41 +145,14 @@ def main():
     service.create_album(album_title)
                 
     error_photos = []
+    uploaded_db = open_uploaded_db(config, photo_db, qr_db)
         
     while True:
         # Returns list of photo file names
         photo_db.try_update_from_file()
-        missing_qr_names = list(photo_db.image_names() - qr_db.image_names())
-        missing_qr_names.sort() # Sort from oldest to newest
-        missing_qr_names = missing_qr_names[::-1] # Reverse order so we start from newest
-        
-        if len(missing_qr_names):
-            print()
-            print("upload_photos.py: Missing qr codes")
-            print(missing_qr_names)
-            
-            if not config.get("enable_upload", True):
-                print("upload_photos.py: Upload disabled, skipping")
-                time.sleep(1)
-                continue
-    
-        for photo_name in missing_qr_names:
-            # First upload the photo that the QR code will link to. If it fails, go to the next photo
-            upload_success, qr_target = attempt_upload(photo_name, display_postfix, error_photos, photo_db, service)
-            if not upload_success:
-                continue
-            
-            os.makedirs(config["qr_dir"], exist_ok=True)
-            qr_path = os.path.join(qr_dir, photo_name + ".png")
-            create_qr_code(qr_target, qr_path)
-            qr_db.add_image(photo_name, qr_path)
-            qr_db.update_file()
-            print("upload_photos.py: Qr target", qr_target)
-            print("upload_photos.py: Qr path", qr_path)
-                
-            # Then if that succeeds, try to upload the other photo
-            attempt_upload(photo_name, other_postfix, error_photos, photo_db, service)
-            
+        if not upload_new_photos(photo_db, qr_db, uploaded_db, service, config, error_photos):
+            time.sleep(1)
+            continue
         time.sleep(0.25)
             
 if __name__ == "__main__":